@@ -15,7 +15,7 @@ const doSearch = (query, setSearchResults, setLoading) => {
   abortController = new window.AbortController();
   setLoading(true);
   // const searchUrl = REACT_APP_PROXY + "/coops/?contains=" + encodeURIComponent(query);
-  const searchUrl = REACT_APP_PROXY + "/coops/no_coords";
+  const searchUrl = REACT_APP_PROXY + "/coops/no_coords?paginate=false";
   fetch(searchUrl, {
     method: "GET",
     signal: abortController.signal,
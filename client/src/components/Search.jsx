@@ -30,7 +30,8 @@ const buildSearchUrl = (coopSearchSettings, setSearchUrl) => {
   let searchUrl = REACT_APP_PROXY + "/coops/";
 
   // compile individual search settings into a list
-  let individualSearchSettings = [];
+  // The search results page shows every match, so opt out of pagination
+  let individualSearchSettings = ["paginate=false"];
   if ("name" in coopSearchSettings && coopSearchSettings.name != "") {
     individualSearchSettings.push(
       "name=" + encodeURIComponent(coopSearchSettings.name)
@@ -27,7 +27,7 @@ const ListPeople = (props) => {
 
   useEffect(() => {
     if (coop == null) {
-      fetch(REACT_APP_PROXY + "/people?coop=" + id)
+      fetch(REACT_APP_PROXY + "/people?paginate=false&coop=" + id)
         .then((response) => {
           return response.json();
         })
@@ -2,3 +2,4 @@ import pymysql
 pymysql.version_info = (1, 3, 13, "final", 0)
 pymysql.install_as_MySQLdb()
 
+default_app_config = 'directory.apps.DirectoryConfig'
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class DirectoryConfig(AppConfig):
+    name = 'directory'
+
+    def ready(self):
+        # Connect the map snapshot invalidation receivers
+        from directory import signals
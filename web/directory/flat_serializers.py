@@ -0,0 +1,350 @@
+"""
+Hand-built read serializers.  With no "fields"/"expand" selection each
+produces exactly what its DRF counterpart in directory/serializers.py
+produces (see tests/test_flat_serializers.py), but renders plain dicts
+straight from the instances, skipping DRF's per-field machinery.
+
+A representation is described once, as a Shape: its fields in output
+order, some of them relations to nested Shapes.  The same description
+drives rendering and the query plan, so a request that leaves out a
+relation (or doesn't expand it) neither queries nor serializes it:
+
+    ?fields=id,name,addresses.latitude,addresses.longitude
+        only these fields; naming a nested field implies its relation
+    ?expand=addresses,addresses.locality
+        only these relations are nested objects; the rest are rendered
+        as their primary key(s).  Without "expand" everything is nested.
+"""
+from operator import attrgetter
+
+from django.db.models import Prefetch
+from rest_framework.exceptions import ValidationError
+
+from address.models import Address
+from directory.instrumentation import timed
+from directory.models import ContactMethod, Coop, CoopType
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _choice(value):
+    return value if value in ('', None) else str(value)
+
+
+def _parse_paths(value):
+    """
+    Turns "a,b.c,b.d" into the tree {'a': {}, 'b': {'c': {}, 'd': {}}}.
+    """
+    tree = {}
+    for path in value.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name.strip(), {})
+    return tree
+
+
+class Selection(object):
+    """
+    The requested fields and expanded relations at one level of a
+    representation.  None means "all" for either.
+    """
+
+    def __init__(self, fields=None, expand=None, path=''):
+        self.fields = fields or None
+        self.expand = expand
+        self.path = path
+
+    @classmethod
+    def from_request(cls, request):
+        if request is None:
+            return cls()
+        params = request.query_params
+        fields = _parse_paths(params['fields']) if 'fields' in params else None
+        expand = _parse_paths(params['expand']) if 'expand' in params else None
+        return cls(fields, expand)
+
+    def includes(self, name):
+        return self.fields is None or name in self.fields
+
+    def is_expanded(self, name):
+        if self.fields is not None and self.fields.get(name):
+            # Asking for a relation's fields implies expanding it
+            return True
+        return self.expand is None or name in self.expand
+
+    def child(self, name):
+        return Selection(
+            self.fields.get(name) if self.fields is not None else None,
+            self.expand.get(name, {}) if self.expand is not None else None,
+            '%s%s.' % (self.path, name)
+        )
+
+    def check(self, shape):
+        """
+        Raises a ValidationError for names the shape doesn't have.
+        """
+        for param, tree in (('fields', self.fields), ('expand', self.expand)):
+            for name in tree or ():
+                field = shape.get_field(name)
+                if field is None:
+                    raise ValidationError({param: 'Unknown field "%s%s".' % (self.path, name)})
+                if not isinstance(field, Relation) and (param == 'expand' or tree[name]):
+                    raise ValidationError({param: '"%s%s" is not a relation.' % (self.path, name)})
+
+
+class Field(object):
+
+    def __init__(self, name, convert=None):
+        self.name = name
+        self.convert = convert
+
+    def compile(self, selection):
+        get = attrgetter(self.name)
+        convert = self.convert
+        if convert is None:
+            return get
+        return lambda obj: convert(get(obj))
+
+    def blank(self, selection):
+        return ''
+
+    def plan(self, selection, selects, prefetches):
+        pass
+
+
+class Relation(Field):
+    """
+    A nested object (or list of them with many=True).  Unexpanded, it's
+    rendered as the related primary key(s).
+    """
+
+    def __init__(self, name, shape, many=False, blank_if_null=False):
+        super().__init__(name)
+        self.shape = shape
+        self.many = many
+        # DRF renders a missing nested object as a dict of blank values
+        # (for address localities only, here)
+        self.blank_if_null = blank_if_null
+
+    def compile(self, selection):
+        name = self.name
+        if not selection.is_expanded(name):
+            if self.many:
+                return lambda obj: [item.pk for item in getattr(obj, name).all()]
+            return attrgetter(name + '_id')
+
+        child = selection.child(name)
+        render = self.shape.compile(child)
+        if self.many:
+            return lambda obj: [render(item) for item in getattr(obj, name).all()]
+        attname = name + '_id'
+        if self.blank_if_null:
+            blank = self.shape.blank(child)
+            return lambda obj: render(getattr(obj, name)) if getattr(obj, attname) is not None else dict(blank)
+        return lambda obj: render(getattr(obj, name)) if getattr(obj, attname) is not None else None
+
+    def blank(self, selection):
+        return self.shape.blank(selection.child(self.name))
+
+    def plan(self, selection, selects, prefetches):
+        name = self.name
+        if not selection.is_expanded(name):
+            if self.many:
+                prefetches.append(Prefetch(name, queryset=self.shape.model.objects.only('pk')))
+            return
+        child_selects, child_prefetches = self.shape.plan(selection.child(name))
+        if self.many:
+            prefetches.append(Prefetch(name, queryset=self.shape.apply(
+                self.shape.model.objects.all(), selects=child_selects, prefetches=child_prefetches
+            )))
+        else:
+            selects.append(name)
+            selects.extend('%s__%s' % (name, lookup) for lookup in child_selects)
+            prefetches.extend(
+                Prefetch('%s__%s' % (name, prefetch.prefetch_through), queryset=prefetch.queryset)
+                for prefetch in child_prefetches
+            )
+
+
+class Shape(object):
+    """
+    One representation: its model and its fields in output order.
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+
+    def get_field(self, name):
+        for field in self.fields:
+            if field.name == name:
+                return field
+        return None
+
+    def compile(self, selection):
+        """
+        Returns a function rendering an instance as a dict.
+        """
+        selection.check(self)
+        items = [
+            (field.name, field.compile(selection))
+            for field in self.fields if selection.includes(field.name)
+        ]
+        return lambda obj: {name: get(obj) for name, get in items}
+
+    def blank(self, selection):
+        return {
+            field.name: field.blank(selection)
+            for field in self.fields if field.name != 'id' and selection.includes(field.name)
+        }
+
+    def plan(self, selection):
+        """
+        Returns the (select_related, prefetch_related) lookups rendering
+        the selection needs.
+        """
+        selection.check(self)
+        selects, prefetches = [], []
+        for field in self.fields:
+            if selection.includes(field.name):
+                field.plan(selection, selects, prefetches)
+        return selects, prefetches
+
+    def apply(self, queryset, selection=None, selects=None, prefetches=None):
+        if selection is not None:
+            selects, prefetches = self.plan(selection)
+        if selects:
+            queryset = queryset.select_related(*selects)
+        if prefetches:
+            queryset = queryset.prefetch_related(*prefetches)
+        return queryset
+
+
+COUNTRY = Shape(None, [
+    Field('id'),
+    Field('name'),
+    Field('code'),
+])
+
+STATE = Shape(None, [
+    Field('id'),
+    Field('code'),
+    Field('name'),
+    Relation('country', COUNTRY),
+])
+
+LOCALITY = Shape(None, [
+    Field('id'),
+    Field('name'),
+    Field('postal_code'),
+    Relation('state', STATE),
+])
+
+ADDRESS = Shape(Address, [
+    Field('id'),
+    Field('street_number'),
+    Field('route'),
+    Field('raw'),
+    Field('formatted'),
+    Field('latitude', _float),
+    Field('longitude', _float),
+    Relation('locality', LOCALITY, blank_if_null=True),
+])
+
+COOP_TYPE = Shape(CoopType, [
+    Field('id'),
+    Field('name'),
+])
+
+PHONE = Shape(None, [
+    Field('type', _choice),
+    Field('phone', _str),
+])
+
+EMAIL = Shape(None, [
+    Field('type', _choice),
+    Field('email', _str),
+])
+
+CONTACT_METHOD = Shape(ContactMethod, [
+    Field('type', _choice),
+    Field('phone', _str),
+    Field('email', _str),
+])
+
+COOP_SEARCH = Shape(Coop, [
+    Field('id'),
+    Field('name'),
+    Relation('addresses', ADDRESS, many=True),
+])
+
+COOP = Shape(Coop, [
+    Field('id'),
+    Relation('types', COOP_TYPE, many=True),
+    Relation('addresses', ADDRESS, many=True),
+    Relation('phone', PHONE),
+    Relation('email', EMAIL),
+    Field('name'),
+    Field('enabled'),
+    Field('web_site'),
+])
+
+PERSON = Shape(None, [
+    Field('id'),
+    Field('first_name'),
+    Field('last_name'),
+    Relation('coops', COOP, many=True),
+    Relation('contact_methods', CONTACT_METHOD, many=True),
+])
+
+
+class FlatSerializer(object):
+    """
+    Minimal stand-in for a read-only DRF serializer: takes an instance
+    (or an iterable of them with many=True) and exposes ".data".  The
+    "fields" and "expand" selection comes from context['request'].
+    """
+    shape = None
+
+    def __init__(self, instance, many=False, context=None):
+        self.instance = instance
+        self.many = many
+        self.selection = Selection.from_request((context or {}).get('request'))
+
+    @classmethod
+    def plan(cls, queryset, request=None):
+        """
+        Adds the select_related/prefetch_related lookups the request's
+        selection needs to "queryset".  Raises a ValidationError for an
+        invalid selection.
+        """
+        return cls.shape.apply(queryset, Selection.from_request(request))
+
+    @property
+    def data(self):
+        with timed('serialize'):
+            render = self.shape.compile(self.selection)
+            if self.many:
+                return [render(item) for item in self.instance]
+            return render(self.instance)
+
+
+class FlatCoopSearchSerializer(FlatSerializer):
+    shape = COOP_SEARCH
+
+
+class FlatCoopSerializer(FlatSerializer):
+    shape = COOP
+
+
+class FlatPersonSerializer(FlatSerializer):
+    shape = PERSON
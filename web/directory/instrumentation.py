@@ -0,0 +1,155 @@
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import QuerySet
+
+logger = logging.getLogger('directory.queries')
+
+_local = threading.local()
+
+
+def instrument(queryset, name, criteria):
+    """
+    Returns "queryset" set up to log its evaluation as the "name" lookup
+    with the given search criteria.  With QUERY_LOG_ENABLED off the
+    queryset is returned untouched, so instrumentation costs nothing.
+    """
+    if not settings.QUERY_LOG_ENABLED:
+        return queryset
+    instrumented = InstrumentedQuerySet(
+        model=queryset.model,
+        query=queryset.query.chain(),
+        using=queryset._db,
+        hints=queryset._hints
+    )
+    instrumented._instrument = (name, {key: value for key, value in criteria.items() if value is not None})
+    return instrumented
+
+
+class InstrumentedQuerySet(QuerySet):
+    """
+    QuerySet that times its evaluation (including prefetches) and logs a
+    JSON record of the lookup name, criteria, SQL, row count and duration.
+    A QUERY_LOG_SAMPLE_RATE fraction of evaluations is logged at INFO;
+    evaluations slower than QUERY_LOG_SLOW_MS are always logged, at
+    WARNING.  Querysets chained from this one (filtered, paginated,
+    prefetched) keep logging under the same name.
+    """
+
+    _instrument = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._instrument = self._instrument
+        return clone
+
+    def _fetch_all(self):
+        if self._result_cache is not None or self._instrument is None:
+            return super()._fetch_all()
+        start = time.perf_counter()
+        super()._fetch_all()
+        self._log(time.perf_counter() - start, len(self._result_cache))
+
+    def count(self):
+        if self._result_cache is not None or self._instrument is None:
+            return super().count()
+        start = time.perf_counter()
+        count = super().count()
+        self._log(time.perf_counter() - start, count, operation='count')
+        return count
+
+    def _log(self, seconds, rows, operation='fetch'):
+        duration_ms = seconds * 1000
+        slow = duration_ms >= settings.QUERY_LOG_SLOW_MS
+        if not slow and random.random() >= settings.QUERY_LOG_SAMPLE_RATE:
+            return
+        name, criteria = self._instrument
+        try:
+            sql = str(self.query)
+        except EmptyResultSet:
+            sql = None
+        logger.log(logging.WARNING if slow else logging.INFO, json.dumps({
+            'event': 'query',
+            'lookup': name,
+            'operation': operation,
+            'criteria': criteria,
+            'sql': sql,
+            'rows': rows,
+            'duration_ms': round(duration_ms, 3),
+            'slow': slow,
+        }, default=str))
+
+
+class RequestTimings(object):
+    """
+    Counters for the request being handled on this thread: database
+    queries and time (from an execute wrapper on every connection) and the
+    time spent in named sections (see "timed").  Sections may overlap;
+    e.g. queries run lazily while serializing count towards both.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        # section name -> seconds, in the order first entered
+        self.sections = {}
+
+    @contextmanager
+    def activate(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            _local.timings = self
+            try:
+                yield self
+            finally:
+                _local.timings = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+    def add(self, name, seconds):
+        self.sections[name] = self.sections.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(name):
+    """
+    Adds the time spent in the block to the current request's "name"
+    section.  Does nothing outside a timed request.
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def query_budget(**budgets):
+    """
+    Declares the most queries a function view may run per request method,
+    e.g. @query_budget(GET=2).  Class-based views set a "query_budget"
+    dict attribute instead.  Requests over budget are logged as warnings
+    (see directory.middleware.RequestTimingMiddleware) and fail
+    tests/test_query_budgets.py.
+    """
+    def decorator(view):
+        view.query_budget = budgets
+        return view
+    return decorator
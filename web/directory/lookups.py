@@ -0,0 +1,24 @@
+from django.db.models import CharField, TextField
+from django.db.models.lookups import IContains
+
+
+class ILike(IContains):
+    """
+    Case-insensitive substring match.  On Postgres this compiles to a bare
+    "column ILIKE '%value%'", which the pg_trgm GIN indexes created in
+    migration 0007 can serve (icontains wraps the column in UPPER(), which
+    they can't).  Other backends get plain icontains.
+    """
+    lookup_name = 'ilike'
+
+    def as_sql(self, compiler, connection):
+        return IContains(self.lhs, self.rhs).as_sql(compiler, connection)
+
+    def as_postgresql(self, compiler, connection):
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        return '%s ILIKE %s' % (lhs_sql, rhs_sql), lhs_params + rhs_params
+
+
+CharField.register_lookup(ILike)
+TextField.register_lookup(ILike)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from directory.services.cluster_service import ClusterService
+
+
+class Command(BaseCommand):
+    help = "Recomputes the precomputed map marker clusters for every zoom level."
+
+    def handle(self, *args, **options):
+        svc = ClusterService()
+        count = svc.rebuild()
+        self.stdout.write("Clustered %s addresses." % count)
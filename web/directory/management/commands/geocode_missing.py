@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from directory.services.geocode_backfill_service import GeocodeBackfillService
+
+
+class Command(BaseCommand):
+    help = "Geocodes the addresses without coordinates, resuming from the last checkpoint."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, help="Addresses read and saved at a time (default GEOCODE_BACKFILL_CHUNK_SIZE).")
+        parser.add_argument('--workers', type=int, help="Geocoder calls in flight (default GEOCODE_BACKFILL_WORKERS).")
+        parser.add_argument('--rate', type=float, help="Geocoder calls per second, 0 for no limit (default GEOCODE_RATE_LIMIT).")
+        parser.add_argument('--limit', type=int, help="Stop after this many addresses.")
+        parser.add_argument('--checkpoint', help="Checkpoint file (default GEOCODE_BACKFILL_CHECKPOINT).")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the first address.")
+
+    def handle(self, *args, **options):
+        svc = GeocodeBackfillService(
+            workers=options['workers'],
+            rate=options['rate'],
+            chunk_size=options['chunk_size'],
+            checkpoint_path=options['checkpoint']
+        )
+        checkpoint = {} if options['restart'] else svc.load_checkpoint()
+        if checkpoint:
+            self.stdout.write("Resuming after address %s (%s processed)." % (checkpoint['last_id'], checkpoint['processed']))
+        try:
+            stats = svc.run(restart=options['restart'], limit=options['limit'], progress=self.report)
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted; run again to resume.")
+            return
+        self.report(stats)
+        if stats['complete']:
+            self.stdout.write("Done.")
+        else:
+            self.stdout.write("Stopped at the limit; run again to resume.")
+
+    def report(self, stats):
+        self.stdout.write(
+            "%(processed)s addresses through id %(last_id)s: %(found)s found, %(not_found)s not found, "
+            "%(errors)s errors, %(cached)s from the cache (%(rate).1f addresses/s)" % stats
+        )
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from directory.services.load_test_service import LoadTestService
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays a weighted mix of map, search, detail, reference and write "
+        "requests against a running server and reports throughput, latency "
+        "percentiles and errors.  Run the server against local stand-ins "
+        "(see run_standins) so writes don't call Nominatim or Google Sheets."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000', help="Server to load.")
+        parser.add_argument(
+            '--concurrency', default='10',
+            help="Concurrent clients; a comma-separated list runs each level in turn, e.g. 1,4,16,64."
+        )
+        parser.add_argument('--duration', type=float, default=30, help="Seconds to run each level.")
+        parser.add_argument('--mix', help="Request weights, e.g. data=10,detail=25,post=0.")
+        parser.add_argument('--seed', type=int, help="Seed for a repeatable request sequence.")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+            mix = LoadTestService.parse_mix(options['mix']) if options['mix'] else None
+        except ValueError as err:
+            raise CommandError(err)
+        svc = LoadTestService(options['url'], mix=mix, seed=options['seed'])
+
+        totals = []
+        for concurrency in levels:
+            elapsed, results = svc.run(concurrency, options['duration'])
+            overall, by_kind = svc.summarize(elapsed, results)
+            totals.append((concurrency, overall))
+            self.stdout.write("\nConcurrency %d, %.1fs" % (concurrency, elapsed))
+            self._write_table([(kind, stats) for kind, stats in by_kind.items()] + [('all', overall)])
+
+        if len(levels) > 1:
+            self.stdout.write("\nSummary")
+            self._write_table([('c=%d' % concurrency, stats) for concurrency, stats in totals])
+
+    def _write_table(self, rows):
+        self.stdout.write("%-18s %9s %9s %9s %9s %9s %8s" % ("", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+        for name, stats in rows:
+            self.stdout.write("%-18s %9d %9.1f %9s %9s %9s %7.2f%%" % (
+                name, stats['requests'], stats['rps'],
+                self._ms(stats['p50']), self._ms(stats['p95']), self._ms(stats['p99']),
+                stats['error_rate'] * 100
+            ))
+
+    @staticmethod
+    def _ms(value):
+        return '-' if value is None else '%.1f' % value
@@ -124,6 +124,8 @@ class Command(BaseCommand):
         input_file = csv.DictReader(open(file_path))
         i=1
         address_pks = dict()
+        # Consults the geocode cache before calling Nominatim
+        svc = LocationService()
         for row in input_file:
 
             # code simplified June and July 2022s
@@ -154,7 +156,6 @@ class Command(BaseCommand):
                 # If there are no lat or lon coords provided, attempt to figure
                 # them out
                 if not lat or not lon:
-                    svc = LocationService()
                     ret = svc.get_coords(
                         address=street,
                         city=city,
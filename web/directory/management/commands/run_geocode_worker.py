@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from directory.metrics import reset_multiprocess_dir
+from directory.services.geocode_queue_service import GeocodeQueueService
+
+
+class Command(BaseCommand):
+    help = "Geocodes the addresses queued by coop writes, rate limited, retrying failures with backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once no jobs are due.")
+        parser.add_argument('--batch-size', type=int, help="Jobs claimed at a time (default GEOCODE_BATCH_SIZE), capped to what the rate limit gets through within GEOCODE_JOB_LEASE.")
+        parser.add_argument('--poll-interval', type=float, default=5, help="Seconds to wait when no jobs are due.")
+
+    def handle(self, *args, **options):
+        reset_multiprocess_dir()
+        svc = GeocodeQueueService()
+        total = 0
+        try:
+            while True:
+                count = svc.run_batch(options['batch_size'])
+                total += count
+                if count:
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("Processed %s geocode jobs." % total)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from directory.services.standin_service import StandinService
+
+
+class Command(BaseCommand):
+    help = "Serves local stand-ins for Nominatim and Google Sheets, for load tests."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--latency-ms', type=float, default=200, help="Delay before each response.")
+
+    def handle(self, *args, **options):
+        svc = StandinService(options['host'], options['port'], options['latency_ms'])
+        self.stdout.write("Serving stand-ins at %s; start the server with" % svc.url)
+        self.stdout.write("    NOMINATIM_URL=%s GOOGLE_SHEETS_STANDIN_URL=%s/sheets" % (svc.url, svc.url))
+        try:
+            svc.serve_forever()
+        except KeyboardInterrupt:
+            pass
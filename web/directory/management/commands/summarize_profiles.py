@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from directory.services.profile_service import ProfileService
+
+
+class Command(BaseCommand):
+    help = "Prints the hottest functions across the collected request profiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--view', help="Only profiles of views whose name contains this.")
+        parser.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'calls'])
+        parser.add_argument('--limit', type=int, default=20, help="Number of functions to list.")
+
+    def handle(self, *args, **options):
+        svc = ProfileService()
+        paths = svc.get_paths(options['view'])
+        if not paths:
+            self.stdout.write("No profiles found.")
+            return
+        self.stdout.write("%s profiles:" % len(paths))
+        self.stdout.write(svc.summarize(paths, sort=options['sort'], limit=options['limit']))
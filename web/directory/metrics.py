@@ -0,0 +1,153 @@
+"""
+Prometheus metrics, served at "/metrics".
+
+Under gunicorn every worker keeps its own counters.  Set the
+"prometheus_multiproc_dir" environment variable to an empty, writable
+directory shared by the workers (gunicorn.conf.py clears it when the
+server starts) and prometheus_client stores the values there, so
+"/metrics" reports the totals across all of them whichever worker
+answers.  Other processes ("run_geocode_worker", which makes the
+Nominatim calls) keep their values in their own directories, which
+"/metrics" adds in when they are listed in METRICS_MULTIPROC_DIRS.
+"""
+import glob
+import hmac
+import ipaddress
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+)
+from prometheus_client import multiprocess
+
+from directory.instrumentation import timed
+
+MULTIPROCESS_DIR_VARIABLE = 'prometheus_multiproc_dir'
+
+REQUESTS = Counter(
+    'directory_requests_total',
+    'Requests handled, by view, method and response status.',
+    ['view', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'directory_request_duration_seconds',
+    'Time taken to produce a response, by view.',
+    ['view', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+)
+REQUEST_QUERIES = Histogram(
+    'directory_request_db_queries',
+    'Database queries run per request, by view.',
+    ['view'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 20, 50, 100, 250)
+)
+REQUEST_DB_LATENCY = Histogram(
+    'directory_request_db_duration_seconds',
+    'Time spent in database queries per request, by view.',
+    ['view'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+EXTERNAL_CALLS = Counter(
+    'directory_external_calls_total',
+    'Calls to external services (Nominatim, Google Sheets), by outcome.',
+    ['service', 'operation', 'outcome']
+)
+EXTERNAL_LATENCY = Histogram(
+    'directory_external_call_duration_seconds',
+    'Time taken by calls to external services.',
+    ['service', 'operation'],
+    buckets=(.05, .1, .25, .5, 1, 2, 5, 10, 30, 60)
+)
+
+
+def observe_request(view, method, status, seconds, queries, db_seconds):
+    REQUESTS.labels(view, method, status).inc()
+    REQUEST_LATENCY.labels(view, method).observe(seconds)
+    REQUEST_QUERIES.labels(view).observe(queries)
+    REQUEST_DB_LATENCY.labels(view).observe(db_seconds)
+
+
+@contextmanager
+def external_call(service, operation, section):
+    """
+    Times a call to an external service, both as the request's "section"
+    (see directory.instrumentation.timed) and in the external call
+    metrics.  The call counts as an error if the block raises.
+    """
+    if not settings.METRICS_ENABLED:
+        with timed(section):
+            yield
+        return
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        with timed(section):
+            yield
+        outcome = 'ok'
+    finally:
+        EXTERNAL_CALLS.labels(service, operation, outcome).inc()
+        EXTERNAL_LATENCY.labels(service, operation).observe(time.perf_counter() - start)
+
+
+def render_metrics():
+    """
+    Returns the (content, content type) of the metrics page, aggregated
+    across the worker processes in multiprocess mode.
+    """
+    if MULTIPROCESS_DIR_VARIABLE in os.environ:
+        registry = CollectorRegistry()
+        registry.register(MultiProcessDirsCollector(
+            [os.environ[MULTIPROCESS_DIR_VARIABLE]] + settings.METRICS_MULTIPROC_DIRS
+        ))
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MultiProcessDirsCollector(object):
+    """
+    prometheus_client's MultiProcessCollector over several directories:
+    the values of every process writing to any of them are added up.
+    """
+
+    def __init__(self, paths):
+        self._paths = paths
+
+    def collect(self):
+        files = [name for path in self._paths for name in glob.glob(os.path.join(path, '*.db'))]
+        return multiprocess.MultiProcessCollector.merge(files, accumulate=True)
+
+
+def reset_multiprocess_dir():
+    """
+    Empties this process's multiprocess directory, if it has one, so
+    counts from a previous run don't linger (gunicorn.conf.py does the
+    same for the web workers).  For a process that is the only one
+    writing there, before it records anything.
+    """
+    path = os.environ.get(MULTIPROCESS_DIR_VARIABLE)
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def is_scraper_allowed(request):
+    """
+    Returns whether the request may read the metrics: it comes from an
+    address in METRICS_ALLOWED_IPS (addresses or networks, e.g.
+    "10.0.0.0/8") or sends "Authorization: Bearer <METRICS_BEARER_TOKEN>".
+    """
+    token = settings.METRICS_BEARER_TOKEN
+    if token:
+        scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip(), token):
+            return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(allowed, strict=False) for allowed in settings.METRICS_ALLOWED_IPS)
@@ -0,0 +1,166 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from directory import metrics
+from directory.instrumentation import RequestTimings
+from directory.services.compression_service import CompressionService
+from directory.services.profile_service import ProfileService
+
+logger = logging.getLogger('directory.requests')
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compresses responses with brotli or gzip, whichever the client's
+    Accept-Encoding prefers (brotli on a tie).  Works like Django's
+    GZipMiddleware: short responses and responses that already have a
+    Content-Encoding (the precompressed map snapshots and reference data)
+    are left alone, and strong ETags are made weak.
+    """
+
+    def process_response(self, request, response):
+        if not settings.RESPONSE_COMPRESSION_ENABLED:
+            return response
+        # It's not worth compressing really short responses
+        if not response.streaming and len(response.content) < settings.RESPONSE_COMPRESSION_MIN_LENGTH:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        svc = CompressionService()
+        encoding = svc.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            # The compressed size isn't known until it's all streamed
+            response.streaming_content = svc.compress_sequence(response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            compressed = svc.compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+
+def get_query_budget(view, method):
+    """
+    Returns the most queries the view (a resolved view function) should run
+    for the request method: its declared "query_budget" for the method
+    (see directory.instrumentation.query_budget), or REQUEST_QUERY_BUDGET.
+    """
+    for declared_on in (view, getattr(view, 'view_class', None)):
+        budgets = getattr(declared_on, 'query_budget', None)
+        if budgets is not None and method in budgets:
+            return budgets[method]
+    return settings.REQUEST_QUERY_BUDGET
+
+
+class RequestTimingMiddleware(object):
+    """
+    Counts the queries and database time of each request and times its
+    serialization, rendering and external calls (see
+    directory.instrumentation.timed).  The totals feed the request metrics
+    (see directory/metrics.py) and are logged as JSON on
+    "directory.requests": at WARNING when the request ran more queries
+    than its budget, at INFO when it took REQUEST_LOG_SLOW_MS or more, and
+    otherwise for a REQUEST_LOG_SAMPLE_RATE fraction of requests.  They go
+    out in a Server-Timing header only with DEBUG on or to requests sending
+    "X-Request-Timing: <REQUEST_TIMING_HEADER_TOKEN>".
+
+    Work done while a streaming response is consumed happens after this
+    middleware returns and isn't counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not (settings.REQUEST_TIMING_ENABLED or settings.METRICS_ENABLED):
+            return self.get_response(request)
+        start = time.perf_counter()
+        with RequestTimings().activate() as timings:
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else None
+        if settings.METRICS_ENABLED:
+            metrics.observe_request(
+                view or 'unmatched', request.method, response.status_code,
+                total, timings.queries, timings.db_seconds
+            )
+        if not settings.REQUEST_TIMING_ENABLED:
+            return response
+
+        total_ms = total * 1000
+        if self.should_send_header(request):
+            metrics_header = ['db;dur=%.3f;desc="%d queries"' % (timings.db_seconds * 1000, timings.queries)]
+            metrics_header += ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in timings.sections.items()]
+            metrics_header.append('total;dur=%.3f' % total_ms)
+            response['Server-Timing'] = ', '.join(metrics_header)
+
+        budget = get_query_budget(match.func if match is not None else None, request.method)
+        over_budget = timings.queries > budget
+        slow = total_ms >= settings.REQUEST_LOG_SLOW_MS
+        if not (over_budget or slow) and random.random() >= settings.REQUEST_LOG_SAMPLE_RATE:
+            return response
+        logger.log(logging.WARNING if over_budget else logging.INFO, json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'queries': timings.queries,
+            'db_ms': round(timings.db_seconds * 1000, 3),
+            'sections_ms': {name: round(seconds * 1000, 3) for name, seconds in timings.sections.items()},
+            'total_ms': round(total_ms, 3),
+            'query_budget': budget,
+            'over_budget': over_budget,
+        }))
+        return response
+
+    @staticmethod
+    def should_send_header(request):
+        if settings.DEBUG:
+            return True
+        token = settings.REQUEST_TIMING_HEADER_TOKEN
+        return bool(token) and request.META.get('HTTP_X_REQUEST_TIMING') == token
+
+
+class ProfilingMiddleware(object):
+    """
+    Runs the requests ProfileService.should_profile picks under cProfile
+    and saves the dumps, named in an X-Profile-File response header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not ProfileService.should_profile(request):
+            return self.get_response(request)
+        svc = ProfileService()
+        profiler = svc.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        match = getattr(request, 'resolver_match', None)
+        response['X-Profile-File'] = svc.save(profiler, match.view_name if match is not None else None)
+        return response
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Index the address coordinates so the map's bounding-box queries are
+    range scans rather than full scans of address_address.  The table
+    belongs to django-address, hence the raw SQL.
+    """
+
+    dependencies = [
+        ('address', '0002_auto_20160213_1726'),
+        ('directory', '0004_auto_20200611_1207'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX address_address_lat_lon_idx ON address_address (latitude, longitude);',
+            reverse_sql='DROP INDEX address_address_lat_lon_idx;',
+        ),
+    ]
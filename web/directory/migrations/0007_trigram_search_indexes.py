@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # pg_trgm is Postgres only; other backends keep unindexed LIKE scans
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    schema_editor.execute(
+        'CREATE INDEX directory_coop_name_trgm_idx ON directory_coop USING gin (name gin_trgm_ops);'
+    )
+    schema_editor.execute(
+        'CREATE INDEX address_address_raw_trgm_idx ON address_address USING gin (raw gin_trgm_ops);'
+    )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS directory_coop_name_trgm_idx;')
+    schema_editor.execute('DROP INDEX IF EXISTS address_address_raw_trgm_idx;')
+
+
+class Migration(migrations.Migration):
+    """
+    Trigram GIN indexes for the substring searches in CoopManager.find
+    (coop name and street).
+    """
+
+    dependencies = [
+        ('address', '0002_auto_20160213_1726'),
+        ('directory', '0006_mapcluster'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
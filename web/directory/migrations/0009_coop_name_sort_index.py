@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Index the (lower(name), id) keyset that CoopList pages through.
+    """
+
+    dependencies = [
+        ('directory', '0008_dataversion'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX directory_coop_lower_name_id_idx ON directory_coop (LOWER(name), id);',
+            reverse_sql='DROP INDEX directory_coop_lower_name_id_idx;',
+        ),
+    ]
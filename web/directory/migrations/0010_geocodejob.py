@@ -0,0 +1,33 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address', '0003_auto_20200830_1851'),
+        ('directory', '0009_coop_name_sort_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=7)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('address', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='geocode_job', to='address.address')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='geocodejob',
+            index=models.Index(fields=['status', 'run_after'], name='geocode_job_due_idx'),
+        ),
+    ]
@@ -1,8 +1,13 @@
-from django.db import models
-from django.db.models import Q
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from address.models import Address
+from directory import lookups  # registers the "ilike" lookup used by CoopManager.find
+from directory.instrumentation import instrument
 from phonenumber_field.modelfields import PhoneNumberField
 from address.models import State, Country, Locality
 
@@ -45,7 +50,7 @@ class CoopManager(models.Manager):
     def get_by_type(self, type):
         qset = Coop.objects.filter(types__name=type,
                                    enabled=True)
-        return qset
+        return instrument(qset, 'get_by_type', {'type': type})
 
     def find(
         self, 
@@ -62,7 +67,9 @@ class CoopManager(models.Manager):
         """
         q = Q()
         if partial_name:
-            q &= Q(name__icontains=partial_name)
+            # "ilike" is served by the trigram index on Postgres and
+            # falls back to icontains elsewhere
+            q &= Q(name__ilike=partial_name)
         if enabled != None:
             q &= Q(enabled=enabled)
         if types_arr != None:
@@ -72,7 +79,7 @@ class CoopManager(models.Manager):
             )
             q &= filter
         if street != None:
-            q &= Q(addresses__raw__icontains=street)
+            q &= Q(addresses__raw__ilike=street)
         if city != None:
             q &= Q(addresses__locality__name__iexact=city)
         if zip != None:
@@ -82,8 +89,15 @@ class CoopManager(models.Manager):
             q &= Q(addresses__locality__state__country__code="US")
                
         queryset = Coop.objects.filter(q)
-        print(queryset.query)
-        return queryset
+        return instrument(queryset, 'find', {
+            'partial_name': partial_name or None,
+            'types': types_arr,
+            'enabled': enabled,
+            'city': city,
+            'zip': zip,
+            'street': street,
+            'state': state_abbrev,
+        })
 
     # Meant to look up coops case-insensitively by part of a type
     def contains_type(self, types_arr):
@@ -93,7 +107,7 @@ class CoopManager(models.Manager):
         )
         queryset = Coop.objects.filter(filter,
                                        enabled=True)
-        return queryset
+        return instrument(queryset, 'contains_type', {'types': types_arr})
  
     def find_wo_coords(self):
         """
@@ -104,7 +118,7 @@ class CoopManager(models.Manager):
             Q(addresses__latitude__isnull=True) |
             Q(addresses__longitude__isnull=True)
         )
-        return queryset
+        return instrument(queryset, 'find_wo_coords', {})
 
 
 class Coop(models.Model):
@@ -118,6 +132,182 @@ class Coop(models.Model):
     web_site = models.TextField()
 
 
+class MapCluster(models.Model):
+    """
+    Precomputed map marker cluster: the geocoded addresses of enabled coops
+    that fall in one grid cell at one zoom level.  The centroid is kept as
+    running sums so points can be added and removed incrementally.
+    """
+    zoom = models.PositiveSmallIntegerField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    count = models.IntegerField(default=0)
+    latitude_sum = models.FloatField(default=0)
+    longitude_sum = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['zoom', 'x', 'y'], name='map_cluster_unq')]
+
+
+class DataVersionManager(models.Manager):
+
+    def get_version(self, name):
+        version = self.filter(name=name).values_list('version', flat=True).first()
+        return version or 0
+
+    def bump(self, name):
+        """
+        Atomically increments the named counter and returns its new value.
+        """
+        if not self.filter(name=name).update(version=F('version') + 1):
+            self.get_or_create(name=name)
+            self.filter(name=name).update(version=F('version') + 1)
+        return self.get_version(name)
+
+
+class DataVersion(models.Model):
+    """
+    Named counters bumped on writes, so processes holding in-memory copies
+    of the data can tell when to reload them.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    objects = DataVersionManager()
+
+
+class GeocodeJobManager(models.Manager):
+
+    def enqueue(self, address):
+        """
+        Queues the address for geocoding, or requeues it (with fresh
+        attempts) if it already has a job.
+        """
+        job, _ = self.update_or_create(address=address, defaults={
+            'status': GeocodeJob.Statuses.PENDING,
+            'attempts': 0,
+            'run_after': timezone.now(),
+            'last_error': '',
+        })
+        return job
+
+    def get_due(self, now):
+        """
+        Returns the pending jobs due by "now", oldest first, with their
+        addresses.  Only the job rows are locked (skipping ones another
+        worker holds): the address's locality is nullable, so its joins
+        are outer joins, which Postgres won't lock, and the localities,
+        states and countries are shared with other addresses anyway.
+        """
+        return (
+            self.select_for_update(skip_locked=True, of=('self',))
+            .filter(status=GeocodeJob.Statuses.PENDING, run_after__lte=now)
+            .select_related('address__locality__state__country')
+            .order_by('run_after', 'id')
+        )
+
+    def claim(self, limit, lease_seconds):
+        """
+        Returns up to "limit" due pending jobs, pushing their "run_after"
+        back by the lease so other workers skip them meanwhile.  A job
+        whose worker died is picked up again once the lease runs out.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            jobs = list(self.get_due(now)[:limit])
+            self.filter(id__in=[job.id for job in jobs]).update(run_after=now + timedelta(seconds=lease_seconds))
+        return jobs
+
+
+class GeocodeJob(models.Model):
+    """
+    An address waiting to be geocoded by "run_geocode_worker", so writes
+    don't wait on Nominatim.
+    """
+    class Statuses(models.TextChoices):
+        PENDING = 'PENDING', _('Pending')
+        DONE = 'DONE', _('Done')
+        FAILED = 'FAILED', _('Failed')
+
+    address = models.OneToOneField(Address, on_delete=models.CASCADE, related_name='geocode_job')
+    status = models.CharField(max_length=7, choices=Statuses.choices, default=Statuses.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = GeocodeJobManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'], name='geocode_job_due_idx')]
+
+
+class GeocodeCacheManager(models.Manager):
+
+    def lookup(self, key):
+        """
+        Returns (True, coords) for an unexpired entry, recording the hit,
+        and (False, None) otherwise.  "coords" is None for an address
+        Nominatim didn't find.
+        """
+        found = self.lookup_many([key])
+        return key in found, found.get(key)
+
+    def lookup_many(self, keys):
+        """
+        Returns {key: coords} for the keys with unexpired entries,
+        recording the hits.
+        """
+        now = timezone.now()
+        entries = list(self.filter(key__in=keys, expires__gt=now).only('key', 'latitude', 'longitude'))
+        if entries:
+            self.filter(id__in=[entry.id for entry in entries]).update(hits=F('hits') + 1, last_hit=now)
+        return {entry.key: entry.coords for entry in entries}
+
+    def store(self, key, coords, ttl_seconds):
+        """
+        Caches the geocoder's answer ([lat, lon], or None for "not found")
+        for "ttl_seconds", counting the lookup.
+        """
+        latitude, longitude = coords or (None, None)
+        entry, created = self.update_or_create(key=key, defaults={
+            'latitude': latitude,
+            'longitude': longitude,
+            'expires': timezone.now() + timedelta(seconds=ttl_seconds),
+        })
+        if not created:
+            self.filter(id=entry.id).update(lookups=F('lookups') + 1)
+        return entry
+
+
+class GeocodeCacheEntry(models.Model):
+    """
+    A geocoder answer keyed by the normalized address string (see
+    LocationService.normalize_address), so the same place is only looked
+    up once however its rows are spelled.  A null latitude/longitude is a
+    cached "not found".  "lookups" counts the geocoder calls (misses) made
+    for the key, "hits" the calls saved.
+    """
+    key = models.TextField(unique=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    hits = models.PositiveIntegerField(default=0)
+    lookups = models.PositiveIntegerField(default=1)
+    last_hit = models.DateTimeField(null=True)
+    expires = models.DateTimeField()
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = GeocodeCacheManager()
+
+    @property
+    def coords(self):
+        if self.latitude is None or self.longitude is None:
+            return None
+        return [self.latitude, self.longitude]
+
+
 class Person(models.Model):
     first_name = models.CharField(max_length=250, null=False)
     last_name = models.CharField(max_length=250, null=False)
@@ -0,0 +1,101 @@
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(object):
+    """
+    Keyset ("cursor") pagination.  Rows are ordered by an optional sort key
+    expression and then by id; the cursor is the (sort key, id) of the
+    last row returned, so every page is a range scan from that point and
+    deep pages cost the same as the first.
+
+    Clients pass "limit" and "cursor" and follow the "next" link.  Passing
+    "paginate=false" returns the whole result set as a bare list, as these
+    endpoints did before pagination.
+    """
+
+    default_limit = 100
+    max_limit = 1000
+    limit_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    paginate_query_param = 'paginate'
+
+    def __init__(self, sort_key=None):
+        self._sort_key = sort_key
+        self._next_cursor = None
+        self._request = None
+
+    def is_enabled(self, request):
+        return request.query_params.get(self.paginate_query_param, '').lower() != 'false'
+
+    def paginate_queryset(self, queryset, request):
+        """
+        Returns the list of rows on the requested page.
+        """
+        self._request = request
+        limit = self.get_limit(request)
+        ordering = ['id']
+        if self._sort_key is not None:
+            queryset = queryset.annotate(_sort_key=self._sort_key)
+            ordering = ['_sort_key', 'id']
+        queryset = queryset.order_by(*ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            sort_value, last_id = self.decode_cursor(cursor)
+            if self._sort_key is not None:
+                queryset = queryset.filter(
+                    Q(_sort_key__gt=sort_value) | Q(_sort_key=sort_value, id__gt=last_id)
+                )
+            else:
+                queryset = queryset.filter(id__gt=last_id)
+
+        # Fetch one extra row to learn whether there's a next page
+        rows = list(queryset[:limit + 1])
+        self._next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            self._next_cursor = self.encode_cursor(
+                getattr(last, '_sort_key', None) if self._sort_key is not None else None,
+                last.id
+            )
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if self._next_cursor is None:
+            return None
+        url = self._request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self._next_cursor)
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    @staticmethod
+    def encode_cursor(sort_value, last_id):
+        data = json.dumps([sort_value, last_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            sort_value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return sort_value, int(last_id)
+        except (binascii.Error, TypeError, ValueError, UnicodeError):
+            raise NotFound('Invalid cursor')
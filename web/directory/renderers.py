@@ -0,0 +1,51 @@
+import orjson
+from django.conf import settings
+from phonenumber_field.phonenumber import PhoneNumber
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from directory.instrumentation import timed
+
+# orjson's JSON has no spaces, doesn't escape non-ASCII and, with these
+# options, writes UTC datetimes with a "Z" just like the stock renderer.
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+LINE_SEPARATOR = '\u2028'.encode()
+PARAGRAPH_SEPARATOR = '\u2029'.encode()
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson, which is several times faster
+    than the standard library on the large coop and people lists.  The
+    output is the same as JSONRenderer's (compact, UTF-8).  Types orjson
+    doesn't know (PhoneNumber, Decimal, lazy translations, ...) go through
+    DRF's JSONEncoder.
+
+    Pretty-printed requests (e.g. from the browsable API) and
+    ORJSON_RENDERER_ENABLED = False fall back to the stock renderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('render'):
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type=None, renderer_context=None):
+        if not settings.ORJSON_RENDERER_ENABLED:
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=self.default, option=ORJSON_OPTIONS)
+        # Like JSONRenderer, keep the output a strict JavaScript subset
+        if LINE_SEPARATOR in ret or PARAGRAPH_SEPARATOR in ret:
+            ret = ret.replace(LINE_SEPARATOR, b'\\u2028').replace(PARAGRAPH_SEPARATOR, b'\\u2029')
+        return ret
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, PhoneNumber):
+            return str(obj)
+        return JSONEncoder().default(obj)
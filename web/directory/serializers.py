@@ -1,7 +1,7 @@
 from rest_framework import serializers
 from directory.models import Coop, CoopType, ContactMethod, Person
 from address.models import Address, AddressField, Locality, State, Country
-from .services.location_service import LocationService
+from .services.geocode_queue_service import GeocodeQueueService
 import re
 
 
@@ -140,11 +140,6 @@ class StateSerializer(serializers.ModelSerializer):
         model = State
         fields = ['id', 'code', 'name', 'country']
 
-    def to_representation(self, instance):
-        rep = super().to_representation(instance)
-        rep['country'] = CountrySerializer(instance.country).data
-        return rep
-
 
 class LocalitySerializer(serializers.ModelSerializer):
     state = StateSerializer()
@@ -276,11 +271,11 @@ class CoopSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
-    # Set address coordinate data
+    # Set address coordinate data, in the background (see
+    # GeocodeQueueService)
     @staticmethod
     def update_coords(address):
-        svc = LocationService()
-        svc.save_coords(address)
+        GeocodeQueueService.enqueue(address)
 
 class PersonSerializer(serializers.ModelSerializer):
     #coops = CoopSerializer(many=True)
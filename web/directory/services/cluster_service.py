@@ -0,0 +1,158 @@
+import math
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+
+from address.models import Address
+from directory.models import MapCluster
+
+# Web Mercator can't represent the poles
+MAX_LATITUDE = 85.05112878
+
+
+class ClusterService(object):
+    """
+    Maintains the MapCluster grid: for every zoom level from 0 to
+    MAP_CLUSTER_MAX_ZOOM, the geocoded addresses of enabled coops are
+    grouped into square cells of MAP_CLUSTER_CELL_PIXELS screen pixels.
+    The coop and address signals (directory/signals.py) move the points
+    as they're written; "rebuild" recomputes the whole grid.
+    """
+
+    def __init__(self, max_zoom=None, cell_pixels=None):
+        self._max_zoom = max_zoom if max_zoom is not None else settings.MAP_CLUSTER_MAX_ZOOM
+        self._cell_pixels = cell_pixels or settings.MAP_CLUSTER_CELL_PIXELS
+
+    def get_cell(self, latitude, longitude, zoom):
+        """
+        Returns the (x, y) grid cell holding the point at the given zoom.
+        """
+        cells = self._cells_per_side(zoom)
+        latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+        lat_rad = math.radians(latitude)
+        x = (longitude + 180.0) / 360.0 * cells
+        y = (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * cells
+        return min(int(x), cells - 1), min(int(y), cells - 1)
+
+    def get_clusters(self, zoom, bbox=None):
+        """
+        Returns the clusters at "zoom" (clamped to the precomputed levels)
+        whose cells overlap the (minLon, minLat, maxLon, maxLat) box, as
+        dicts of latitude, longitude (the centroid) and count.
+        """
+        zoom = max(0, min(zoom, self._max_zoom))
+        clusters = MapCluster.objects.filter(zoom=zoom, count__gt=0)
+        if bbox:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            min_x, min_y = self.get_cell(max_lat, min_lon, zoom)
+            max_x, max_y = self.get_cell(min_lat, max_lon, zoom)
+            if min_x <= max_x:
+                x_q = Q(x__range=(min_x, max_x))
+            else:
+                # Crosses the antimeridian
+                x_q = Q(x__gte=min_x) | Q(x__lte=max_x)
+            clusters = clusters.filter(x_q, y__range=(min_y, max_y))
+        return [
+            {
+                'latitude': latitude_sum / count,
+                'longitude': longitude_sum / count,
+                'count': count,
+            }
+            for count, latitude_sum, longitude_sum in clusters.order_by('x', 'y').values_list(
+                'count', 'latitude_sum', 'longitude_sum'
+            )
+        ]
+
+    def rebuild(self):
+        """
+        Recomputes every cluster from the addresses in the database.
+        Returns the number of points clustered.
+        """
+        cells = {}
+        points = Address.objects.filter(
+            coop__enabled=True,
+            latitude__isnull=False,
+            longitude__isnull=False
+        ).order_by().values_list('id', 'latitude', 'longitude').distinct()
+        count = 0
+        for _, latitude, longitude in points.iterator(chunk_size=5000):
+            count += 1
+            for zoom in range(self._max_zoom + 1):
+                key = (zoom,) + self.get_cell(latitude, longitude, zoom)
+                cell = cells.setdefault(key, [0, 0.0, 0.0])
+                cell[0] += 1
+                cell[1] += latitude
+                cell[2] += longitude
+        with transaction.atomic():
+            MapCluster.objects.all().delete()
+            MapCluster.objects.bulk_create([
+                MapCluster(zoom=zoom, x=x, y=y, count=cell[0], latitude_sum=cell[1], longitude_sum=cell[2])
+                for (zoom, x, y), cell in cells.items()
+            ], batch_size=5000)
+        return count
+
+    def get_points(self, address_ids):
+        """
+        Returns {address id: [lat, lon]} for those of the addresses that
+        are clustered: geocoded and belonging to an enabled coop.
+        """
+        points = Address.objects.filter(
+            id__in=address_ids,
+            coop__enabled=True,
+            latitude__isnull=False,
+            longitude__isnull=False
+        ).order_by().values_list('id', 'latitude', 'longitude').distinct()
+        return {id: [latitude, longitude] for id, latitude, longitude in points}
+
+    def update_points(self, old_points, new_points):
+        """
+        Moves the points that changed between two get_points results,
+        adding and removing the ones only in one of them.
+        """
+        for id in set(old_points) | set(new_points):
+            if old_points.get(id) != new_points.get(id):
+                self.move_point(old_points.get(id), new_points.get(id))
+
+    def move_point(self, old_coords, new_coords):
+        """
+        Moves one point from "old_coords" to "new_coords" (either may be
+        None, or a [lat, lon] pair) in every zoom level's clusters.
+        """
+        with transaction.atomic():
+            if self._is_point(old_coords):
+                self._add(old_coords[0], old_coords[1], -1)
+            if self._is_point(new_coords):
+                self._add(new_coords[0], new_coords[1], 1)
+
+    def _add(self, latitude, longitude, sign):
+        for zoom in range(self._max_zoom + 1):
+            x, y = self.get_cell(latitude, longitude, zoom)
+            cell = MapCluster.objects.filter(zoom=zoom, x=x, y=y)
+            updated = cell.update(
+                count=F('count') + sign,
+                latitude_sum=F('latitude_sum') + sign * latitude,
+                longitude_sum=F('longitude_sum') + sign * longitude,
+            )
+            if not updated and sign > 0:
+                try:
+                    with transaction.atomic():
+                        MapCluster.objects.create(
+                            zoom=zoom, x=x, y=y, count=1, latitude_sum=latitude, longitude_sum=longitude
+                        )
+                except IntegrityError:
+                    # Another writer created the cell first
+                    cell.update(
+                        count=F('count') + 1,
+                        latitude_sum=F('latitude_sum') + latitude,
+                        longitude_sum=F('longitude_sum') + longitude,
+                    )
+            elif sign < 0:
+                cell.filter(count__lte=0).delete()
+
+    @staticmethod
+    def _is_point(coords):
+        return coords is not None and coords[0] is not None and coords[1] is not None
+
+    def _cells_per_side(self, zoom):
+        return max(1, (256 * 2 ** zoom) // self._cell_pixels)
@@ -0,0 +1,138 @@
+import gzip
+import os
+import threading
+import zlib
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CompressionService(object):
+    """
+    gzip and brotli ("br") response compression.  Dynamic responses are
+    compressed at a fast setting per request; cacheable content (map
+    snapshots, reference data) is compressed once at the highest setting
+    and the compressed bytes are kept next to the raw ones.
+    """
+
+    EXTENSIONS = {
+        'br': 'br',
+        'gzip': 'gz',
+    }
+
+    def __init__(self):
+        # In order of preference when the client accepts both equally
+        self._encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def negotiate(self, accept_encoding):
+        """
+        Returns the encoding to use for a request with this Accept-Encoding
+        header, or None to send the content uncompressed.
+        """
+        if not settings.RESPONSE_COMPRESSION_ENABLED or not accept_encoding:
+            return None
+        weights = {}
+        for item in accept_encoding.split(','):
+            coding, _, params = item.strip().partition(';')
+            coding = coding.strip().lower()
+            weight = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    weight = float(params[2:])
+                except ValueError:
+                    weight = 0.0
+            weights[coding] = weight
+        best, best_weight = None, 0.0
+        for encoding in self._encodings:
+            weight = weights.get(encoding, weights.get('*', 0.0))
+            if weight > best_weight:
+                best, best_weight = encoding, weight
+        return best
+
+    def compress(self, content, encoding, static=False):
+        """
+        Returns "content" compressed with "encoding".  "static" content is
+        compressed once and served many times, so it gets the slowest,
+        smallest settings.
+        """
+        if encoding == 'br':
+            quality = (
+                settings.RESPONSE_COMPRESSION_STATIC_BROTLI_QUALITY if static
+                else settings.RESPONSE_COMPRESSION_BROTLI_QUALITY
+            )
+            return brotli.compress(content, quality=quality)
+        level = 9 if static else settings.RESPONSE_COMPRESSION_GZIP_LEVEL
+        return gzip.compress(content, compresslevel=level, mtime=0)
+
+    def compress_all(self, content, static=True):
+        """
+        Returns encoding -> compressed "content" for every supported
+        encoding, leaving out any that don't make it smaller.
+        """
+        if not settings.RESPONSE_COMPRESSION_ENABLED:
+            return {}
+        encoded = {}
+        for encoding in self._encodings:
+            compressed = self.compress(content, encoding, static=static)
+            if len(compressed) < len(content):
+                encoded[encoding] = compressed
+        return encoded
+
+    def compress_sequence(self, chunks, encoding):
+        """
+        Compresses a stream of byte chunks (a streaming response's content).
+        """
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=settings.RESPONSE_COMPRESSION_BROTLI_QUALITY)
+            for chunk in chunks:
+                data = compressor.process(chunk)
+                if data:
+                    yield data
+            yield compressor.finish()
+        else:
+            # gzip framing around a raw deflate stream, so each chunk can be
+            # flushed as it's produced
+            compressor = zlib.compressobj(settings.RESPONSE_COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+
+    def compress_file(self, path, source_path=None, static=True):
+        """
+        Writes the precompressed copies of the file at "path" (path.gz,
+        path.br) that get_precompressed serves, reading it from
+        "source_path" if it isn't in place yet.  See "compress" for
+        "static".
+        """
+        if not settings.RESPONSE_COMPRESSION_ENABLED:
+            return
+        with open(source_path or path, 'rb') as f:
+            content = f.read()
+        for encoding, compressed in self.compress_all(content, static=static).items():
+            encoded_path = self.get_encoded_path(path, encoding)
+            tmp_path = '%s.%d.%d.tmp' % (encoded_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp_path, encoded_path)
+
+    def get_precompressed(self, path, accept_encoding):
+        """
+        Returns (path, encoding) of the best precompressed copy of the file
+        at "path" the client accepts, or (path, None) for the raw file.
+        """
+        encoding = self.negotiate(accept_encoding)
+        if encoding is not None:
+            encoded_path = self.get_encoded_path(path, encoding)
+            if os.path.exists(encoded_path):
+                return encoded_path, encoding
+        return path, None
+
+    def get_encoded_path(self, path, encoding):
+        return '%s.%s' % (path, self.EXTENSIONS[encoding])
@@ -0,0 +1,212 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from address.models import Address
+from directory.models import Coop, GeocodeCacheEntry, GeocodeJob
+from directory.signals import coop_type_names, invalidate_map_snapshots, reindex_coops
+from .cluster_service import ClusterService
+from .geocode_queue_service import RateLimiter
+from .location_service import LocationService
+
+
+class GeocodeBackfillService(object):
+    """
+    Geocodes every address missing a latitude or longitude, for
+    "manage.py geocode_missing".  Addresses are read "chunk_size" at a
+    time in id order; for each chunk the geocode cache is checked in one
+    query, the misses are looked up by a pool of "workers" threads (only
+    the geocoder calls run there, at most "rate" per second) and the
+    coordinates found are saved with one bulk_update, closing the
+    addresses' pending GeocodeJobs in the same transaction.  After every
+    chunk the last address id is saved to the checkpoint file, so a run
+    that's interrupted resumes where it stopped; a finished run removes it.
+    """
+
+    STATS = ('processed', 'found', 'not_found', 'errors', 'cached')
+
+    def __init__(self, location_service=None, workers=None, rate=None, chunk_size=None, checkpoint_path=None):
+        self._location = location_service or LocationService()
+        self._workers = workers or settings.GEOCODE_BACKFILL_WORKERS
+        self._rate_limiter = RateLimiter(settings.GEOCODE_RATE_LIMIT if rate is None else rate)
+        self._chunk_size = chunk_size or settings.GEOCODE_BACKFILL_CHUNK_SIZE
+        self._checkpoint_path = checkpoint_path or settings.GEOCODE_BACKFILL_CHECKPOINT
+
+    def run(self, restart=False, limit=None, progress=None):
+        """
+        Geocodes up to "limit" addresses (all of them by default),
+        resuming from the checkpoint unless "restart" is set.  Calls
+        "progress(stats)" after each chunk.  Returns the stats: counts
+        for the whole backfill (including runs it resumed) plus
+        'last_id', 'complete', and 'elapsed' and 'rate' (addresses per
+        second) for this run.
+        """
+        checkpoint = {} if restart else self.load_checkpoint()
+        stats = {name: checkpoint.get(name, 0) for name in self.STATS}
+        stats['last_id'] = checkpoint.get('last_id', 0)
+        processed = 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for chunk in self.get_chunks(stats['last_id'], limit):
+                for name, count in self.process_chunk(chunk, pool).items():
+                    stats[name] += count
+                processed += len(chunk)
+                stats['last_id'] = chunk[-1].id
+                stats['elapsed'] = time.monotonic() - start
+                stats['rate'] = processed / stats['elapsed'] if stats['elapsed'] else 0.0
+                self.save_checkpoint(stats)
+                if progress:
+                    progress(stats)
+        stats['elapsed'] = time.monotonic() - start
+        stats['rate'] = processed / stats['elapsed'] if stats['elapsed'] else 0.0
+        stats['complete'] = limit is None or processed < limit
+        if stats['complete']:
+            self.clear_checkpoint()
+        return stats
+
+    def get_chunks(self, after_id=0, limit=None):
+        """
+        Yields lists of the addresses missing coordinates with ids above
+        "after_id", "chunk_size" at a time, "limit" in all.
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = self._chunk_size if remaining is None else min(self._chunk_size, remaining)
+            chunk = list(
+                Address.objects.filter(Q(latitude__isnull=True) | Q(longitude__isnull=True), id__gt=after_id)
+                .select_related('locality__state__country')
+                .order_by('id')[:size]
+            )
+            if not chunk:
+                return
+            yield chunk
+            after_id = chunk[-1].id
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def process_chunk(self, chunk, pool):
+        """
+        Geocodes and saves one chunk of addresses.  Returns the counts.
+        """
+        counts = dict.fromkeys(self.STATS, 0)
+        counts['processed'] = len(chunk)
+        # Addresses spelled the same way are looked up once
+        by_key = {}
+        address_strs = {}
+        for address in chunk:
+            parts = self.get_parts(address)
+            address_str = LocationService.format_address(*parts)
+            key = LocationService.normalize_address(*parts) if settings.GEOCODE_CACHE_ENABLED else address_str
+            by_key.setdefault(key, []).append(address)
+            address_strs[key] = address_str
+
+        results = {}
+        if settings.GEOCODE_CACHE_ENABLED:
+            results = GeocodeCacheEntry.objects.lookup_many(list(by_key))
+            counts['cached'] = sum(len(by_key[key]) for key in results)
+        misses = [key for key in by_key if key not in results]
+        for key, (coords, err) in zip(misses, pool.map(self._search, [address_strs[key] for key in misses])):
+            if err is not None:
+                counts['errors'] += len(by_key[key])
+                print("%s: Failed to find coordinates for %s " % (err, address_strs[key]), file=sys.stderr)
+                continue
+            if settings.GEOCODE_CACHE_ENABLED:
+                self._location.cache_coords(key, coords)
+            results[key] = coords
+
+        updated = []
+        old_coords = {}
+        answered_ids = []
+        for key, coords in results.items():
+            counts['found' if coords else 'not_found'] += len(by_key[key])
+            answered_ids += [address.id for address in by_key[key]]
+            if not coords:
+                continue
+            for address in by_key[key]:
+                old_coords[address.id] = [address.latitude, address.longitude]
+                address.latitude, address.longitude = coords
+                updated.append(address)
+        if answered_ids:
+            with transaction.atomic():
+                if updated:
+                    Address.objects.bulk_update(updated, ['latitude', 'longitude'])
+                    self.refresh_map_data(updated, old_coords)
+                # The worker would only look these up again
+                GeocodeJob.objects.filter(
+                    address_id__in=answered_ids, status=GeocodeJob.Statuses.PENDING
+                ).update(status=GeocodeJob.Statuses.DONE, last_error='', updated=timezone.now())
+        return counts
+
+    @staticmethod
+    def get_parts(address):
+        """
+        Returns (address, city, state code, zip, country name) the way
+        LocationService.save_coords looks the address up.
+        """
+        locality = address.locality
+        state = locality.state if locality else None
+        country = state.country if state else None
+        return (
+            address.formatted or address.raw,
+            locality.name if locality else "",
+            state.code if state else "",
+            locality.postal_code if locality else "",
+            country.name if country else "",
+        )
+
+    @staticmethod
+    def refresh_map_data(addresses, old_coords):
+        """
+        Does what the Address post_save signal and save_coords do, which
+        bulk_update skips: updates the clusters and marks the map
+        snapshots and coop indexes stale.
+        """
+        ids = [address.id for address in addresses]
+        coops = list(Coop.objects.filter(addresses__in=ids).distinct())
+        if not coops:
+            return
+        clustered = set(Address.objects.filter(id__in=ids, coop__enabled=True).values_list('id', flat=True))
+        cluster_svc = ClusterService()
+        for address in addresses:
+            if address.id in clustered:
+                cluster_svc.move_point(old_coords[address.id], [address.latitude, address.longitude])
+        invalidate_map_snapshots(coop_type_names(coops))
+        reindex_coops([coop.pk for coop in coops])
+
+    def load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_checkpoint(self, stats):
+        checkpoint = {name: stats[name] for name in self.STATS + ('last_id',)}
+        checkpoint['saved'] = timezone.now().isoformat()
+        tmp_path = self._checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def clear_checkpoint(self):
+        try:
+            os.remove(self._checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def _search(self, address_str):
+        """
+        Runs on the pool: returns (coords, None), or (None, the error).
+        """
+        self._rate_limiter.wait()
+        try:
+            return self._location.search(address_str), None
+        except Exception as err:
+            return None, err
@@ -0,0 +1,116 @@
+import random
+import sys
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from directory.models import GeocodeJob
+from .location_service import LocationService
+
+
+class RateLimiter(object):
+    """
+    Spaces calls at least 1 / "rate" seconds apart, across threads.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self._interval = 1.0 / rate if rate else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._next_at)
+            self._next_at = start + self._interval
+        if start > now:
+            self._sleep(start - now)
+
+
+class GeocodeQueueService(object):
+    """
+    Geocodes addresses in the background.  Writes call "enqueue", which
+    records a GeocodeJob (committed with the write) instead of calling
+    Nominatim; "run_geocode_worker" claims due jobs and geocodes them at
+    most GEOCODE_RATE_LIMIT per second.  A job whose geocoder call fails is
+    retried with exponential backoff (GEOCODE_RETRY_BACKOFF seconds,
+    doubling up to GEOCODE_RETRY_BACKOFF_MAX) until GEOCODE_MAX_ATTEMPTS,
+    then marked failed.  An address Nominatim doesn't know is done, not
+    failed.
+    """
+
+    def __init__(self, location_service=None, rate_limiter=None):
+        self._location = location_service or LocationService()
+        self._rate_limiter = rate_limiter or RateLimiter(settings.GEOCODE_RATE_LIMIT)
+
+    @staticmethod
+    def enqueue(address):
+        """
+        Queues the address for geocoding, or geocodes it right away when
+        GEOCODE_QUEUE_ENABLED is off.
+        """
+        if not settings.GEOCODE_QUEUE_ENABLED:
+            LocationService().save_coords(address)
+            return None
+        return GeocodeJob.objects.enqueue(address)
+
+    def run_batch(self, limit=None):
+        """
+        Claims and processes one batch of due jobs.  Returns the number
+        processed.
+        """
+        jobs = GeocodeJob.objects.claim(self.get_batch_size(limit), settings.GEOCODE_JOB_LEASE)
+        for job in jobs:
+            self.process(job)
+        return len(jobs)
+
+    def get_batch_size(self, limit=None):
+        """
+        Returns how many jobs to claim at a time: "limit" (by default
+        GEOCODE_BATCH_SIZE), capped so the batch is done well within
+        GEOCODE_JOB_LEASE at the rate limit.  Otherwise the leases of the
+        last jobs would run out and another worker would claim them too.
+        """
+        size = limit or settings.GEOCODE_BATCH_SIZE
+        rate = self._rate_limiter.rate
+        if rate:
+            # Half the lease's worth, leaving the other half for the
+            # geocoder calls themselves
+            size = min(size, max(1, int(settings.GEOCODE_JOB_LEASE * rate / 2)))
+        return size
+
+    def process(self, job):
+        self._rate_limiter.wait()
+        try:
+            self._location.save_coords(job.address, raise_errors=True)
+        except Exception as err:
+            job.attempts += 1
+            job.last_error = str(err)[:1000]
+            if job.attempts >= settings.GEOCODE_MAX_ATTEMPTS:
+                job.status = GeocodeJob.Statuses.FAILED
+                print("Giving up geocoding address %s: %s" % (job.address_id, err), file=sys.stderr)
+            else:
+                job.run_after = timezone.now() + timedelta(seconds=self.get_backoff(job.attempts))
+        else:
+            job.status = GeocodeJob.Statuses.DONE
+            job.last_error = ''
+        job.save(update_fields=['status', 'attempts', 'run_after', 'last_error', 'updated'])
+        return job
+
+    @staticmethod
+    def get_backoff(attempts):
+        """
+        Seconds to wait before retrying after "attempts" failures, with up
+        to 10% jitter so failed jobs don't retry in lockstep.
+        """
+        backoff = min(
+            settings.GEOCODE_RETRY_BACKOFF * 2 ** (attempts - 1),
+            settings.GEOCODE_RETRY_BACKOFF_MAX
+        )
+        return backoff * random.uniform(0.9, 1.0)
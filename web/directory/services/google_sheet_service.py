@@ -3,12 +3,23 @@ import os
 import csv
 import requests
 import io
+from urllib.parse import quote
 
+from django.conf import settings
 from oauth2client.service_account import ServiceAccountCredentials
 
+from directory.metrics import external_call
+
 class GoogleSheetService(object):
 
     def __init__(self, creds_file=os.environ['SERVICE_CREDS_JSON_FILE']):
+        # A local stand-in for Google Sheets (see
+        # directory/services/standin_service.py) replaces the real API
+        # when configured, e.g. for load tests
+        self._standin_url = settings.GOOGLE_SHEETS_STANDIN_URL
+        if self._standin_url:
+            return
+
         scope = ['https://spreadsheets.google.com/feeds','https://www.googleapis.com/auth/drive']
 
         # add credentials to the account
@@ -23,15 +34,19 @@ class GoogleSheetService(object):
         Downloads a specific google sheet corresponding to the file name and sheet number.
         Returns the data as a CSV file.
         """
-        sheet = self._client.open(file_name)
+        with external_call('google_sheets', 'download', 'sheets'):
+            if self._standin_url:
+                res = requests.get(self._get_standin_url(file_name, sheet_num))
+            else:
+                sheet = self._client.open(file_name)
 
-        # get the third sheet of the Spreadsheet.  This
-        # contains the data we want
-        sheet_instance = sheet.get_worksheet(sheet_num)
+                # get the third sheet of the Spreadsheet.  This
+                # contains the data we want
+                sheet_instance = sheet.get_worksheet(sheet_num)
 
-        url = 'https://docs.google.com/spreadsheets/d/' + sheet.id + '/gviz/tq?tqx=out:csv&gid=' + str(sheet_instance.id)
-        headers = {'Authorization': 'Bearer ' + self._client.auth.token}
-        res = requests.get(url, headers=headers)
+                url = 'https://docs.google.com/spreadsheets/d/' + sheet.id + '/gviz/tq?tqx=out:csv&gid=' + str(sheet_instance.id)
+                headers = {'Authorization': 'Bearer ' + self._client.auth.token}
+                res = requests.get(url, headers=headers)
 
         ar = csv.reader(io.StringIO(res.text, newline=""))
         output = "\n".join([",".join(map(str, ['"' + c.replace('\n', '') + '"' for c in r])) for r in ar])
@@ -41,10 +56,16 @@ class GoogleSheetService(object):
         """
         Adds a row to the end of the given sheet
         """
-        sheet = self._client.open(file_name)
+        with external_call('google_sheets', 'append', 'sheets'):
+            if self._standin_url:
+                requests.post(self._get_standin_url(file_name, sheet_num), json=values).raise_for_status()
+                return
+
+            sheet = self._client.open(file_name)
 
-        # Write to the endo of the sheet
-        sheet_instance = sheet.get_worksheet(sheet_num)
-        sheet_instance.append_row(values)
+            # Write to the endo of the sheet
+            sheet_instance = sheet.get_worksheet(sheet_num)
+            sheet_instance.append_row(values)
 
-  
\ No newline at end of file
+    def _get_standin_url(self, file_name, sheet_num):
+        return '%s/%s/%s' % (self._standin_url.rstrip('/'), quote(file_name), sheet_num)
@@ -0,0 +1,210 @@
+import math
+import random
+import threading
+import time
+
+import requests
+
+from address.models import State
+from directory.models import Coop, CoopType
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, int(math.ceil(fraction * len(sorted_values))) - 1)]
+
+
+class LoadTestService(object):
+    """
+    Replays a weighted mix of the app's real traffic (the requests in
+    scripts/test_*.sh) against a running server from "concurrency" threads,
+    each with its own keep-alive session, and reports throughput, latency
+    percentiles and the error rate.  Ids and search terms are sampled from
+    the database the server uses.
+
+    Writes add coops: "post" creates one and "put" updates one created
+    earlier in the same run, so existing data isn't changed.
+    """
+
+    DEFAULT_MIX = {
+        'data': 10,
+        'search_contains': 20,
+        'search_name': 10,
+        'search_type': 10,
+        'search_criteria': 5,
+        'detail': 25,
+        'people': 5,
+        'reference': 10,
+        'post': 3,
+        'put': 2,
+    }
+
+    def __init__(self, base_url, mix=None, seed=None):
+        self._base_url = base_url.rstrip('/')
+        self._mix = mix or self.DEFAULT_MIX
+        self._seed = seed
+        self._created = []
+        self._created_lock = threading.Lock()
+        self._load_samples()
+
+    @classmethod
+    def parse_mix(cls, value):
+        """
+        Parses "data=10,detail=20" into the weights of a mix.
+        """
+        mix = {}
+        for item in value.split(','):
+            name, _, weight = item.partition('=')
+            name = name.strip()
+            if name not in cls.DEFAULT_MIX:
+                raise ValueError("Unknown request kind %r; expected one of %s." % (name, ", ".join(cls.DEFAULT_MIX)))
+            mix[name] = float(weight)
+        return mix
+
+    def run(self, concurrency, duration):
+        """
+        Runs the mix for "duration" seconds.  Returns (elapsed seconds,
+        {kind: [(seconds, ok), ...]}).
+        """
+        deadline = time.monotonic() + duration
+        samples = [[] for _ in range(concurrency)]
+        threads = [
+            threading.Thread(target=self._work, args=(deadline, samples[i], random.Random(
+                None if self._seed is None else self._seed + i
+            )))
+            for i in range(concurrency)
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        results = {}
+        for thread_samples in samples:
+            for kind, seconds, ok in thread_samples:
+                results.setdefault(kind, []).append((seconds, ok))
+        return elapsed, results
+
+    @staticmethod
+    def summarize(elapsed, results):
+        """
+        Returns {'requests', 'rps', 'p50', 'p95', 'p99' (ms), 'error_rate'}
+        for all the results, and the same per request kind.
+        """
+        def stats(samples):
+            latencies = sorted(seconds * 1000 for seconds, _ in samples)
+            errors = sum(1 for _, ok in samples if not ok)
+            return {
+                'requests': len(samples),
+                'rps': len(samples) / elapsed if elapsed else 0.0,
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'error_rate': errors / len(samples) if samples else 0.0,
+            }
+        everything = [sample for samples in results.values() for sample in samples]
+        return stats(everything), {kind: stats(samples) for kind, samples in sorted(results.items())}
+
+    def _work(self, deadline, samples, rng):
+        session = requests.Session()
+        kinds = list(self._mix)
+        weights = [self._mix[kind] for kind in kinds]
+        while time.monotonic() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            method, path, params, body = getattr(self, '_build_' + kind)(rng)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, self._base_url + path, params=params, json=body, timeout=60)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                response, ok = None, False
+            samples.append((kind, time.perf_counter() - start, ok))
+            if kind == 'post' and ok:
+                with self._created_lock:
+                    self._created.append(response.json()['id'])
+
+    def _load_samples(self):
+        coops = list(Coop.objects.order_by('?').values_list('id', 'name')[:1000])
+        self._coop_ids = [id for id, _ in coops] or [1]
+        self._name_terms = [word for _, name in coops for word in name.split() if len(word) > 3] or ['coop']
+        self._type_names = list(CoopType.objects.values_list('name', flat=True)[:100]) or ['Grocery']
+        self._state = State.objects.select_related('country').filter(code='IL').first() or \
+            State.objects.select_related('country').first()
+
+    def _build_data(self, rng):
+        if rng.random() < 0.5:
+            return 'GET', '/data', {}, None
+        return 'GET', '/data', {'type': rng.choice(self._type_names)}, None
+
+    def _build_search_contains(self, rng):
+        return 'GET', '/coops/', {'contains': rng.choice(self._name_terms)}, None
+
+    def _build_search_name(self, rng):
+        return 'GET', '/coops/', {'name': rng.choice(self._name_terms)}, None
+
+    def _build_search_type(self, rng):
+        types = rng.sample(self._type_names, min(2, len(self._type_names)))
+        return 'GET', '/coops/', {'coop_type': ','.join(types)}, None
+
+    def _build_search_criteria(self, rng):
+        return 'GET', '/coops/', {
+            'name': rng.choice(self._name_terms),
+            'coop_type': rng.choice(self._type_names),
+            'city': 'chicago',
+        }, None
+
+    def _build_detail(self, rng):
+        return 'GET', '/coops/%d/' % rng.choice(self._coop_ids), {}, None
+
+    def _build_people(self, rng):
+        return 'GET', '/people/', {'coop': rng.choice(self._coop_ids)}, None
+
+    def _build_reference(self, rng):
+        path = rng.choice(['/coop_types/', '/countries/', '/states/%s/' % (
+            self._state.country.code if self._state else 'US'
+        )])
+        return 'GET', path, {}, None
+
+    def _build_post(self, rng):
+        return 'POST', '/coops/', {}, self._coop_payload(rng)
+
+    def _build_put(self, rng):
+        with self._created_lock:
+            coop_id = rng.choice(self._created) if self._created else None
+        if coop_id is None:
+            return self._build_post(rng)
+        payload = self._coop_payload(rng)
+        payload['id'] = coop_id
+        return 'PUT', '/coops/%d/' % coop_id, {}, payload
+
+    def _coop_payload(self, rng):
+        state = self._state
+        street = '%d W. Load Test Ave' % rng.randint(1, 9999)
+        return {
+            'name': 'Load Test %d' % rng.randint(1, 10 ** 6),
+            'types': [{'name': rng.choice(self._type_names)}],
+            'addresses': [{
+                'raw': street,
+                'formatted': street,
+                'locality': {
+                    'name': 'Chicago',
+                    'postal_code': '60654',
+                    'state': {
+                        'id': state.id,
+                        'name': state.name,
+                        'code': state.code,
+                        'country': {'id': state.country.id, 'name': state.country.name},
+                    } if state else None,
+                },
+            }],
+            'enabled': True,
+            'phone': {'phone': '+17739441426'},
+            'email': {'email': 'loadtest@example.com'},
+            'web_site': 'http://www.example.com/',
+        }
@@ -1,23 +1,112 @@
 # removed 7/21/222 
 from geopy.geocoders import Nominatim
-import ssl
+import re
 import sys
 import requests
 
 
+from django.conf import settings
+
 from address.models import State, Country, Locality, Address
+from directory.metrics import external_call
+from directory.models import GeocodeCacheEntry
+
+# Spelled-out words replaced by their postal abbreviations when
+# normalizing addresses
+ABBREVIATIONS = {
+    'avenue': 'ave', 'boulevard': 'blvd', 'court': 'ct', 'drive': 'dr',
+    'expressway': 'expy', 'highway': 'hwy', 'lane': 'ln', 'parkway': 'pkwy',
+    'place': 'pl', 'road': 'rd', 'square': 'sq', 'street': 'st',
+    'terrace': 'ter', 'apartment': 'apt', 'building': 'bldg', 'floor': 'fl',
+    'suite': 'ste', 'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+}
+COUNTRY_ALIASES = {'united states': 'us', 'united states of america': 'us', 'usa': 'us'}
 
 class LocationService(object):
 
-    def __init__(self):
+    def __init__(self, geocoder=None):
         self._locator = Nominatim(user_agent="myGeocoder")
+        # Takes an address string and returns Nominatim search results
+        # ([{'lat': ..., 'lon': ...}, ...]); tests pass a fake
+        self._geocoder = geocoder or self.search_nominatim
+
+    @staticmethod
+    def search_nominatim(address_str):
+        # get geo loc from Open Street Maps 7/11/22
+        # fmi see https://www.natasshaselvaraj.com/a-step-by-step-guide-on-geocoding-in-python/
+        #         https://nominatim.org/release-docs/latest/api/Overview/
+        url = settings.NOMINATIM_URL + '/search/' + address_str +'?format=json'
+        with external_call('nominatim', 'search', 'geocode'):
+            response = requests.get(url)
+            response.raise_for_status()
+            return response.json()
+
+    @staticmethod
+    def normalize_address(address, city, state_code, zip, country):
+        """
+        Returns the geocode cache key for an address: lower case, without
+        punctuation or extra whitespace, with street words abbreviated and
+        ZIP+4 codes cut to five digits, so "1 North Main Street, Chicago"
+        and "1 n. main st chicago" match.
+        """
+        def words(value):
+            return [ABBREVIATIONS.get(word, word) for word in re.sub(r"[^\w\s]", " ", str(value or "").lower()).split()]
+        zip = str(zip or "").strip()
+        zip_match = re.match(r"^(\d{5})(?:-?\d{4})?$", zip)
+        country = " ".join(re.sub(r"[^\w\s]", " ", str(country or "").lower()).split())
+        return "|".join([
+            " ".join(words(address)),
+            " ".join(words(city)),
+            " ".join(words(state_code)),
+            zip_match.group(1) if zip_match else " ".join(words(zip)),
+            COUNTRY_ALIASES.get(country, country),
+        ])
+
+    @staticmethod
+    def format_address(address, city, state_code, zip, country_name):
+        """
+        Returns the address as a string for the geocoder.
+        """
+        if not address:
+            return "%s, %s %s %s" % (city, state_code, zip, country_name)
+        return "%s, %s, %s %s %s" % (address, city, state_code, zip, country_name)
+
+    def search(self, address_str):
+        """
+        Geocodes a free-form address string.  Returns [lat, lon], or None
+        if the geocoder doesn't know the address; geocoder errors are
+        raised.  Makes no database queries, so it can run on worker threads.
+        """
+        location = self._geocoder(address_str)
+        if not location:
+            return None
+        return [float(location[0]['lat']), float(location[0]['lon'])]
 
-    def get_coords(self, address, city, state_code, zip, country_code):
+    @staticmethod
+    def cache_coords(cache_key, coords):
+        """
+        Caches a geocoder answer ([lat, lon], or None for "not found").
+        """
+        ttl = settings.GEOCODE_CACHE_TTL if coords else settings.GEOCODE_CACHE_NOT_FOUND_TTL
+        return GeocodeCacheEntry.objects.store(cache_key, coords, ttl)
+
+    def get_coords(self, address, city, state_code, zip, country_code, raise_errors=False):
         """
         Returns an array ([lat, lon]) of coordinates or None if no coords
         are generated.  "country_code" is a 2-letter abbreviation referencing the
-        address_country.code column.
+        address_country.code column.  Geocoder errors are logged and
+        treated as "not found" unless "raise_errors" is set.
+
+        The geocode cache is consulted first; geocoder answers, including
+        "not found", are cached, errors are not.
         """
+        cache_key = None
+        if settings.GEOCODE_CACHE_ENABLED:
+            cache_key = self.normalize_address(address, city, state_code, zip, country_code)
+            hit, coords = GeocodeCacheEntry.objects.lookup(cache_key)
+            if hit:
+                return coords
         latitude = None
         longitude = None
         country = Country.objects.filter(code=country_code).first() 
@@ -40,33 +129,29 @@ class LocationService(object):
                     latitude = address.latitude
                     longitude = address.longitude
         if not latitude and not longitude:
-            address_str = "%s, %s, %s %s %s" % (address, city, state_code, zip, country.name if country else "")
-            if not address:
-                address_str = "%s, %s %s %s" % (city, state_code, zip, country.name if country else "")
+            address_str = self.format_address(address, city, state_code, zip, country.name if country else "")
             try:
-                # get geo loc from Open Street Maps 7/11/22
-                # fmi see https://www.natasshaselvaraj.com/a-step-by-step-guide-on-geocoding-in-python/
-                #         https://nominatim.org/release-docs/latest/api/Overview/
-                url = 'https://nominatim.openstreetmap.org/search/' + address_str +'?format=json'
-                location = requests.get(url).json()
-                if location:
-                    latitude = float(location[0]['lat'])
-                    longitude = float(location[0]['lon'])
+                coords = self.search(address_str)
+                if coords:
+                    latitude, longitude = coords
                 else:
                     print("Failed to find coordinates for %s " % address_str, file=sys.stderr) 
+                if cache_key:
+                    self.cache_coords(cache_key, coords)
             except Exception as err:
+                 if raise_errors:
+                     raise
                  print("%s: Failed to find coordinates for %s " % (str(err), address_str), file=sys.stderr) 
            
         return [latitude, longitude] if latitude and longitude else None            
 
-    def save_coords(self, address):
+    def save_coords(self, address, raise_errors=False):
         """
         Takes a model object of type address.address and sets
         the latitude and lonitude (if possible) of the object and saves
-        this object.
+        this object.  Returns the coordinates, or None if none were found.
         """
-        ssl._create_default_https_context = ssl._create_unverified_context
-        
+        coords = None
         if self._locator:
             state = address.locality.state
             country = state.country
@@ -77,9 +162,12 @@ class LocationService(object):
                 address.locality.name, 
                 state.code, 
                 address.locality.postal_code, 
-                country.name
+                country.name,
+                raise_errors=raise_errors
             )
             if coords:
                 address.latitude = coords[0]
                 address.longitude = coords[1]
-                address.save(update_fields=["latitude", "longitude"])      
+                # The Address signals move its point in the map clusters
+                address.save(update_fields=["latitude", "longitude"])
+        return coords
@@ -0,0 +1,209 @@
+import csv
+import io
+import json
+
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from directory.models import Coop
+
+
+class MapDataService(object):
+    """
+    Produces the flat coop/address rows behind the map's "/data" CSV.
+    """
+
+    HEADER = ['name', 'address', 'city', 'postal code', 'type', 'website', 'lon', 'lat']
+
+    # Keys of the JSON variant, in HEADER order
+    JSON_KEYS = ['name', 'address', 'city', 'postal_code', 'type', 'website', 'lon', 'lat']
+
+    # Columns pulled in the single coop/address join
+    ROW_FIELDS = (
+        'id',
+        'name',
+        'web_site',
+        'addresses__formatted',
+        'addresses__locality__name',
+        'addresses__locality__state__code',
+        'addresses__locality__postal_code',
+        'addresses__longitude',
+        'addresses__latitude',
+    )
+
+    # Columns behind each GeoJSON feature
+    FEATURE_FIELDS = (
+        'id',
+        'name',
+        'web_site',
+        'addresses__formatted',
+        'addresses__longitude',
+        'addresses__latitude',
+    )
+
+    def __init__(self, chunk_size=2000):
+        self._chunk_size = chunk_size
+
+    def get_coops(self, type=None, contains=None):
+        """
+        Returns the coop queryset for the "type" or "contains" filter used
+        by the map.  With neither filter, all enabled coops are returned.
+        """
+        if type:
+            return Coop.objects.get_by_type(type)
+        elif contains:
+            return Coop.objects.contains_type(contains.split(","))
+        return Coop.objects.filter(enabled=True)
+
+    @staticmethod
+    def parse_bbox(bbox):
+        """
+        Parses a "minLon,minLat,maxLon,maxLat" string.  Raises ValueError if
+        it isn't four numbers within longitude/latitude bounds.
+        """
+        parts = [float(part) for part in bbox.split(",")]
+        if len(parts) != 4:
+            raise ValueError("bbox must be minLon,minLat,maxLon,maxLat")
+        min_lon, min_lat, max_lon, max_lat = parts
+        if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180
+                and -90 <= min_lat <= max_lat <= 90):
+            raise ValueError("bbox is out of range")
+        return min_lon, min_lat, max_lon, max_lat
+
+    @staticmethod
+    def filter_bbox(coops, bbox):
+        """
+        Narrows the coop queryset to addresses inside the (minLon, minLat,
+        maxLon, maxLat) box.  The predicates are plain latitude/longitude
+        ranges so they can use the address coordinates index.  A box whose
+        minLon is greater than its maxLon crosses the antimeridian.
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        if min_lon <= max_lon:
+            lon_q = Q(addresses__longitude__range=(min_lon, max_lon))
+        else:
+            lon_q = Q(addresses__longitude__gte=min_lon) | Q(addresses__longitude__lte=max_lon)
+        # One filter() call so both predicates apply to the same address join
+        return coops.filter(lon_q, addresses__latitude__range=(min_lat, max_lat))
+
+    def get_type_names(self, coops):
+        """
+        Returns a dict of coop id -> joined type names (e.g. "Grocery, Housing")
+        for the given coop queryset, built from one query.
+        """
+        through = Coop.types.through
+        type_rows = through.objects.filter(
+            coop__in=coops.values('id')
+        ).order_by('coop_id', 'id').values_list('coop_id', 'cooptype__name')
+        names = {}
+        for coop_id, name in type_rows.iterator(chunk_size=self._chunk_size):
+            names.setdefault(coop_id, []).append(name)
+        return {coop_id: ', '.join(type_names) for coop_id, type_names in names.items()}
+
+    def get_rows(self, coops):
+        """
+        Generator of CSV rows (matching HEADER) for every geocoded address of
+        the given coops, ordered by coop name.  Addresses are read through a
+        server-side cursor so memory stays flat regardless of result size.
+        """
+        type_names = self.get_type_names(coops)
+        rows = coops.order_by(
+            Lower('name'),
+            'id',
+            'addresses__locality',
+            'addresses__route',
+            'addresses__street_number'
+        ).values_list(*self.ROW_FIELDS)
+        for (coop_id, name, web_site, formatted, city_name, state_code,
+                postal_code, longitude, latitude) in rows.iterator(chunk_size=self._chunk_size):
+            if not (longitude and latitude) or city_name is None:
+                continue
+            city = city_name + ", " + state_code + " " + postal_code
+            yield [name, formatted, city, postal_code, type_names.get(coop_id, ''), web_site, longitude, latitude]
+
+    def get_features(self, coops):
+        """
+        Generator of GeoJSON Point features, one per geocoded address of the
+        given coops.
+        """
+        type_names = self.get_type_names(coops)
+        rows = coops.order_by('id').values_list(*self.FEATURE_FIELDS)
+        for coop_id, name, web_site, formatted, longitude, latitude in rows.iterator(chunk_size=self._chunk_size):
+            if not (longitude and latitude):
+                continue
+            yield {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                'properties': {
+                    'id': coop_id,
+                    'name': name,
+                    'address': formatted,
+                    'type': type_names.get(coop_id, ''),
+                    'website': web_site,
+                },
+            }
+
+    def get_geojson_chunks(self, coops):
+        """
+        Generator of a GeoJSON FeatureCollection for the given coops, in
+        text chunks.
+        """
+        yield '{"type":"FeatureCollection","features":['
+        separator = ''
+        chunk = []
+        for feature in self.get_features(coops):
+            chunk.append(json.dumps(feature, separators=(',', ':')))
+            if len(chunk) == self._chunk_size:
+                yield separator + ','.join(chunk)
+                separator = ','
+                chunk = []
+        if chunk:
+            yield separator + ','.join(chunk)
+        yield ']}'
+
+    def get_csv_chunks(self, coops):
+        """
+        Generator of CSV text chunks, header first, each holding up to
+        "chunk_size" rows.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        writer.writerow(self.HEADER)
+        # Send the header right away so the first byte isn't held up by the query
+        yield self._drain(buffer)
+        count = 0
+        for row in self.get_rows(coops):
+            writer.writerow(row)
+            count += 1
+            if count % self._chunk_size == 0:
+                yield self._drain(buffer)
+        if buffer.tell():
+            yield self._drain(buffer)
+
+    def get_json_chunks(self, coops):
+        """
+        Generator of the same rows as a JSON list of objects, in text chunks.
+        """
+        yield '['
+        separator = ''
+        chunk = []
+        for row in self.get_rows(coops):
+            chunk.append(self.to_json(row))
+            if len(chunk) == self._chunk_size:
+                yield separator + ',\n'.join(chunk)
+                separator = ',\n'
+                chunk = []
+        if chunk:
+            yield separator + ',\n'.join(chunk)
+        yield ']'
+
+    @classmethod
+    def to_json(cls, row):
+        return json.dumps(dict(zip(cls.JSON_KEYS, row)))
+
+    @staticmethod
+    def _drain(buffer):
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return chunk
@@ -0,0 +1,249 @@
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from directory.models import CoopType
+from .compression_service import CompressionService
+from .map_data_service import MapDataService
+
+
+class MapSnapshotService(object):
+    """
+    Keeps the "/data" map output materialized on disk, one directory per
+    filter: "all" and each existing coop type.  Other requests (a
+    "contains" search, an unknown type) are streamed from the database, so
+    the number of snapshots is bounded.  Each directory holds:
+
+        filter.json   the filter the snapshot was built for
+        version       the last version built
+        v<N>.csv      the CSV exactly as "/data" returns it
+        v<N>.json     the same rows as a JSON list of objects
+        v<N>.*.gz/br  precompressed copies of the above
+        stale         present when the data changed since the last build
+
+    A stale snapshot is still served while the background rebuild runs;
+    readers only build a snapshot that doesn't exist yet.
+    """
+
+    CONTENT_TYPES = {
+        'csv': 'text/csv',
+        'json': 'application/json',
+    }
+
+    # Filters waiting on a background rebuild, shared by all instances in
+    # this process so a burst of saves results in one rebuild.
+    _pending = set()
+    _lock = threading.Lock()
+    _timer = None
+
+    def __init__(self, snapshot_dir=None):
+        self._dir = snapshot_dir or settings.MAP_SNAPSHOT_DIR
+
+    @staticmethod
+    def get_filter(type=None, contains=None):
+        """
+        Returns the (kind, value) filter the map request asks for, or None
+        if it isn't one that's snapshotted.
+        """
+        if type:
+            return ('type', type)
+        elif contains:
+            return None
+        return ('all', '')
+
+    def get_snapshot(self, map_filter, format='csv'):
+        """
+        Returns (path, etag) of the current snapshot for the filter, or None
+        if there is none and the filter is for a type that doesn't exist.
+
+        A missing snapshot is built on the spot (with the fast compression
+        settings); a stale one is served as is, and only rebuilt here, in the
+        background, if the rebuild scheduled by the change hasn't happened
+        within MAP_SNAPSHOT_STALE_GRACE seconds (e.g. its worker exited).
+        """
+        filter_dir = self._filter_dir(map_filter)
+        version = self.get_version(map_filter)
+        if version is None:
+            kind, value = map_filter
+            if kind == 'type' and not CoopType.objects.filter(name=value).exists():
+                return None
+            version = self.build(map_filter, static=False)
+        else:
+            try:
+                stale_for = time.time() - os.path.getmtime(os.path.join(filter_dir, 'stale'))
+            except OSError:
+                stale_for = None
+            if stale_for is not None and stale_for > settings.MAP_SNAPSHOT_STALE_GRACE:
+                self.schedule_rebuild([map_filter])
+        path = os.path.join(filter_dir, 'v%d.%s' % (version, format))
+        etag = '"%s-%d"' % (os.path.basename(filter_dir)[:16], version)
+        return path, etag
+
+    def get_version(self, map_filter):
+        try:
+            with open(os.path.join(self._filter_dir(map_filter), 'version')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def get_filters(self):
+        """
+        Returns the filters that have a snapshot on disk.  Snapshots of
+        filters that are no longer snapshotted ("contains" searches, from
+        before they were streamed) are deleted.
+        """
+        filters = []
+        if not os.path.isdir(self._dir):
+            return filters
+        for name in os.listdir(self._dir):
+            try:
+                with open(os.path.join(self._dir, name, 'filter.json')) as f:
+                    map_filter = tuple(json.load(f))
+            except (IOError, ValueError):
+                continue
+            if map_filter[0] in ('all', 'type'):
+                filters.append(map_filter)
+            else:
+                shutil.rmtree(os.path.join(self._dir, name), ignore_errors=True)
+        return filters
+
+    def build(self, map_filter, static=True):
+        """
+        Writes a new version of the CSV and JSON snapshots for the filter
+        and returns its version number.  The precompressed copies use the
+        slow "static" compression settings unless "static" is False (for
+        builds a request is waiting on).
+        """
+        filter_dir = self._filter_dir(map_filter)
+        os.makedirs(filter_dir, exist_ok=True)
+        # Clear the marker before reading so a change made mid-build marks
+        # the new version stale again.
+        self._remove(os.path.join(filter_dir, 'stale'))
+        version = (self.get_version(map_filter) or 0) + 1
+
+        data_svc = MapDataService()
+        kind, value = map_filter
+        coops = data_svc.get_coops(**({kind: value} if kind != 'all' else {}))
+        csv_path = os.path.join(filter_dir, 'v%d.csv' % version)
+        json_path = os.path.join(filter_dir, 'v%d.json' % version)
+        csv_tmp = self._tmp_path(csv_path)
+        json_tmp = self._tmp_path(json_path)
+        with open(csv_tmp, 'w', encoding='utf-8', newline='') as csv_file, \
+                open(json_tmp, 'w', encoding='utf-8') as json_file:
+            writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
+            writer.writerow(MapDataService.HEADER)
+            json_file.write('[')
+            separator = ''
+            for row in data_svc.get_rows(coops):
+                writer.writerow(row)
+                json_file.write(separator + MapDataService.to_json(row))
+                separator = ',\n'
+            json_file.write(']')
+        # The compressed copies go into place first, so whoever sees the
+        # new version finds them
+        compression_svc = CompressionService()
+        compression_svc.compress_file(csv_path, source_path=csv_tmp, static=static)
+        compression_svc.compress_file(json_path, source_path=json_tmp, static=static)
+        os.replace(csv_tmp, csv_path)
+        os.replace(json_tmp, json_path)
+        self._write(os.path.join(filter_dir, 'filter.json'), json.dumps(list(map_filter)))
+        self._write(os.path.join(filter_dir, 'version'), str(version))
+        self._prune(filter_dir, version)
+        return version
+
+    def invalidate(self, type_names=None):
+        """
+        Marks the snapshots affected by a change to coops with the given type
+        names as stale (all of them if "type_names" is None) and schedules
+        their rebuild.
+        """
+        affected = [
+            map_filter for map_filter in self.get_filters()
+            if type_names is None or self.is_affected(map_filter, type_names)
+        ]
+        for map_filter in affected:
+            self._write(os.path.join(self._filter_dir(map_filter), 'stale'), '')
+        if affected:
+            self.schedule_rebuild(affected)
+
+    @staticmethod
+    def is_affected(map_filter, type_names):
+        kind, value = map_filter
+        if kind == 'type':
+            return value in type_names
+        return True
+
+    def schedule_rebuild(self, map_filters):
+        """
+        Rebuilds the given snapshots, in a background thread unless
+        MAP_SNAPSHOT_BACKGROUND is off.  Rebuilds requested within
+        MAP_SNAPSHOT_REBUILD_DELAY seconds of each other are coalesced.
+        """
+        if not settings.MAP_SNAPSHOT_BACKGROUND:
+            for map_filter in map_filters:
+                self.build(map_filter)
+            return
+        cls = MapSnapshotService
+        with cls._lock:
+            cls._pending.update(map_filters)
+            if cls._timer is None:
+                cls._timer = threading.Timer(settings.MAP_SNAPSHOT_REBUILD_DELAY, self._rebuild_pending)
+                cls._timer.daemon = True
+                cls._timer.start()
+
+    def _rebuild_pending(self):
+        cls = MapSnapshotService
+        with cls._lock:
+            map_filters = cls._pending
+            cls._pending = set()
+            cls._timer = None
+        try:
+            for map_filter in map_filters:
+                try:
+                    self.build(map_filter)
+                except Exception as err:
+                    print("%s: Failed to rebuild map snapshot %s" % (str(err), map_filter), file=sys.stderr)
+        finally:
+            connection.close()
+
+    def _filter_dir(self, map_filter):
+        digest = hashlib.sha1(json.dumps(list(map_filter)).encode('utf-8')).hexdigest()
+        return os.path.join(self._dir, digest)
+
+    @staticmethod
+    def _prune(filter_dir, version):
+        # Keep the previous version for readers that already looked up
+        # the version number but haven't opened the file yet.
+        for name in os.listdir(filter_dir):
+            parts = name.split('.')
+            base = parts[0]
+            if parts[1:2] in (['csv'], ['json']) and parts[-1] != 'tmp' and base.startswith('v') and base[1:].isdigit():
+                if int(base[1:]) < version - 1:
+                    MapSnapshotService._remove(os.path.join(filter_dir, name))
+
+    @staticmethod
+    def _tmp_path(path):
+        # Unique per process and thread so concurrent builds don't collide
+        return '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+    @staticmethod
+    def _write(path, content):
+        tmp_path = MapSnapshotService._tmp_path(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,303 @@
+import math
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from directory.models import Coop, CoopType, DataVersion
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+
+class NearbyPoints(object):
+    """
+    One immutable generation of the index.  "main" points are sorted by
+    grid cell, so every cell is a contiguous slice found by binary search;
+    points changed since the last merge sit unsorted in "delta" and are
+    scanned in full.
+    """
+    COLUMNS = ('coop_ids', 'address_ids', 'lat', 'lon', 'cos_lat', 'masks')
+
+    def __init__(self, main, keys, alive, delta):
+        self.main = main
+        self.keys = keys
+        self.alive = alive
+        self.delta = delta
+
+
+def empty_columns():
+    return {
+        'coop_ids': np.empty(0, dtype=np.int64),
+        'address_ids': np.empty(0, dtype=np.int64),
+        'lat': np.empty(0, dtype=np.float64),
+        'lon': np.empty(0, dtype=np.float64),
+        'cos_lat': np.empty(0, dtype=np.float64),
+        'masks': np.empty(0, dtype=np.uint64),
+    }
+
+
+class NearbyIndex(object):
+    """
+    In-memory proximity index over the geocoded addresses of enabled
+    coops, answering "/coops/nearby".  Points live in contiguous NumPy
+    arrays (coop id, address id, latitude, longitude, coop type bitmask)
+    bucketed into a NEARBY_GRID_DEGREES grid; a search computes haversine
+    distances in one vectorized pass over the cells the radius touches.
+
+    Like CoopSearchIndex, every write bumps the "coop_nearby" DataVersion
+    counter.  The writing process replaces the changed coops' points in
+    place (into the delta, merged back into the grid once it passes
+    NEARBY_MERGE_THRESHOLD points); other processes rebuild.
+    """
+
+    VERSION_NAME = 'coop_nearby'
+    TYPE_BITS = 64
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns this process's shared index.
+        """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, grid_degrees=None, check_interval=None, merge_threshold=None):
+        self._grid = grid_degrees or settings.NEARBY_GRID_DEGREES
+        self._check_interval = (
+            check_interval if check_interval is not None else settings.NEARBY_INDEX_CHECK_INTERVAL
+        )
+        self._merge_threshold = merge_threshold or settings.NEARBY_MERGE_THRESHOLD
+        self._cols = int(math.ceil(360.0 / self._grid))
+        self._rows = int(math.ceil(180.0 / self._grid))
+        self._lock = threading.RLock()
+        self._points = None
+        # coop type name -> bit in the masks
+        self._type_bits = {}
+        self._version = None
+        self._checked_at = 0
+
+    def search(self, latitude, longitude, radius_km, limit, type_name=None):
+        """
+        Returns up to "limit" (coop id, distance in km) pairs, nearest
+        first, for the enabled coops with an address within "radius_km" of
+        the point, optionally only those of the named type.  A coop's
+        distance is that of its nearest address.
+        """
+        self.ensure_current()
+        with self._lock:
+            points = self._points
+            type_bit = self._type_bits.get(type_name) if type_name else None
+        if type_name and type_bit is None:
+            if not CoopType.objects.filter(name=type_name).exists():
+                return []
+
+        coop_ids, distances = [], []
+        main_rows = self._candidate_rows(points, latitude, longitude, radius_km)
+        for columns, rows in ((points.main, main_rows), (points.delta, None)):
+            ids, dist = self._within(columns, rows, latitude, longitude, radius_km, type_bit)
+            coop_ids.append(ids)
+            distances.append(dist)
+        coop_ids = np.concatenate(coop_ids)
+        distances = np.concatenate(distances)
+
+        if type_name and type_bit is None:
+            # Types past the first TYPE_BITS have no bit; ask the database
+            of_type = Coop.objects.filter(types__name=type_name).values_list('id', flat=True)
+            keep = np.isin(coop_ids, np.fromiter(of_type, dtype=np.int64))
+            coop_ids, distances = coop_ids[keep], distances[keep]
+        return self._nearest(coop_ids, distances, limit)
+
+    def ensure_current(self):
+        """
+        Rebuilds the index if it hasn't been built or another process has
+        written since.
+        """
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self._check_interval:
+            return
+        version = DataVersion.objects.get_version(self.VERSION_NAME)
+        if version != self._version:
+            self.build(version)
+        self._checked_at = now
+
+    def build(self, version=None):
+        """
+        Loads every geocoded address of the enabled coops into a fresh
+        index (two queries).
+        """
+        if version is None:
+            version = DataVersion.objects.get_version(self.VERSION_NAME)
+        with self._lock:
+            self._type_bits = {}
+            columns = self._load(Coop.objects.filter(enabled=True))
+            self.set_points(columns)
+            self._version = version
+
+    def set_points(self, columns):
+        """
+        Replaces the index contents with the given columns (a dict of
+        arrays named as in NearbyPoints.COLUMNS).
+        """
+        keys = self._cell_keys(columns['lat'], columns['lon'])
+        order = np.argsort(keys, kind='stable')
+        main = {name: values[order] for name, values in columns.items()}
+        with self._lock:
+            self._points = NearbyPoints(main, keys[order], np.ones(len(order), dtype=bool), empty_columns())
+
+    def record_change(self, coop_ids=None):
+        """
+        Called after a write that touched "coop_ids" (None if the affected
+        coops aren't known).  Bumps the shared version and replaces those
+        coops' points here; if this process missed someone else's write,
+        or the ids aren't known, the index is rebuilt on the next search
+        instead.
+        """
+        version = DataVersion.objects.bump(self.VERSION_NAME)
+        with self._lock:
+            if self._version is None:
+                return
+            if coop_ids is None or version != self._version + 1:
+                self._version = None
+                return
+            self._replace(coop_ids)
+            self._version = version
+
+    def _replace(self, coop_ids):
+        coop_ids = np.fromiter(set(coop_ids), dtype=np.int64)
+        points = self._points
+        alive = points.alive & ~np.isin(points.main['coop_ids'], coop_ids)
+        keep = ~np.isin(points.delta['coop_ids'], coop_ids)
+        added = self._load(Coop.objects.filter(enabled=True, id__in=coop_ids.tolist()))
+        delta = {
+            name: np.concatenate([values[keep], added[name]])
+            for name, values in points.delta.items()
+        }
+        dead = len(alive) - int(np.count_nonzero(alive))
+        if len(delta['coop_ids']) + dead > self._merge_threshold:
+            self.set_points({
+                name: np.concatenate([values[alive], delta[name]])
+                for name, values in points.main.items()
+            })
+        else:
+            self._points = NearbyPoints(points.main, points.keys, alive, delta)
+
+    def _load(self, coops):
+        """
+        Returns the columns for the geocoded addresses of "coops".
+        """
+        masks = {}
+        for coop_id, type_name in Coop.types.through.objects.filter(
+            coop__in=coops
+        ).values_list('coop_id', 'cooptype__name').order_by('cooptype_id').iterator():
+            bit = self._type_bits.get(type_name)
+            if bit is None and len(self._type_bits) < self.TYPE_BITS:
+                bit = self._type_bits[type_name] = len(self._type_bits)
+            if bit is not None:
+                masks[coop_id] = masks.get(coop_id, 0) | (1 << bit)
+
+        rows = list(coops.filter(
+            addresses__latitude__isnull=False,
+            addresses__longitude__isnull=False
+        ).order_by().values_list(
+            'id', 'addresses__id', 'addresses__latitude', 'addresses__longitude'
+        ).iterator(chunk_size=10000))
+        columns = empty_columns()
+        if rows:
+            coop_ids, address_ids, lat, lon = zip(*rows)
+            columns['coop_ids'] = np.array(coop_ids, dtype=np.int64)
+            columns['address_ids'] = np.array(address_ids, dtype=np.int64)
+            columns['lat'] = np.array(lat, dtype=np.float64)
+            columns['lon'] = np.array(lon, dtype=np.float64)
+            columns['cos_lat'] = np.cos(np.radians(columns['lat']))
+            columns['masks'] = np.array([masks.get(coop_id, 0) for coop_id in coop_ids], dtype=np.uint64)
+        return columns
+
+    def _cell_keys(self, lat, lon):
+        rows = np.clip(((lat + 90.0) // self._grid).astype(np.int64), 0, self._rows - 1)
+        cols = ((lon + 180.0) // self._grid).astype(np.int64) % self._cols
+        return rows * self._cols + cols
+
+    def _candidate_rows(self, points, latitude, longitude, radius_km):
+        """
+        Returns the indexes into the main arrays of the points in the grid
+        cells the search circle overlaps.
+        """
+        grid = self._grid
+        lat_delta = radius_km / KM_PER_DEGREE
+        row_lo = max(0, int((latitude - lat_delta + 90.0) // grid))
+        row_hi = min(self._rows - 1, int((latitude + lat_delta + 90.0) // grid))
+        widest = max(abs(latitude - lat_delta), abs(latitude + lat_delta))
+        lon_delta = 360.0 if widest >= 90.0 else lat_delta / math.cos(math.radians(widest))
+        if lon_delta >= 180.0:
+            # Every column: the rows are one contiguous run of keys
+            col_ranges = [(0, self._cols - 1)]
+        else:
+            col_lo = int((longitude - lon_delta + 180.0) // grid)
+            col_hi = int((longitude + lon_delta + 180.0) // grid)
+            if col_lo < 0:
+                col_ranges = [(col_lo % self._cols, self._cols - 1), (0, col_hi)]
+            elif col_hi >= self._cols:
+                col_ranges = [(col_lo, self._cols - 1), (0, col_hi % self._cols)]
+            else:
+                col_ranges = [(col_lo, col_hi)]
+
+        if col_ranges == [(0, self._cols - 1)]:
+            key_ranges = [(row_lo * self._cols, row_hi * self._cols + self._cols - 1)]
+        else:
+            key_ranges = [
+                (row * self._cols + lo, row * self._cols + hi)
+                for row in range(row_lo, row_hi + 1) for lo, hi in col_ranges
+            ]
+        lows = np.searchsorted(points.keys, [lo for lo, _ in key_ranges], side='left')
+        highs = np.searchsorted(points.keys, [hi for _, hi in key_ranges], side='right')
+        slices = [np.arange(lo, hi) for lo, hi in zip(lows, highs) if hi > lo]
+        rows = np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+        return rows[points.alive[rows]]
+
+    @staticmethod
+    def _within(columns, rows, latitude, longitude, radius_km, type_bit):
+        """
+        Returns (coop ids, distances) of the points (all of them, or just
+        "rows") within the radius.
+        """
+        if rows is not None:
+            columns = {name: values[rows] for name, values in columns.items()}
+        if type_bit is not None:
+            match = (columns['masks'] & np.uint64(1 << type_bit)) != 0
+            columns = {name: values[match] for name, values in columns.items()}
+        lat = np.radians(columns['lat'])
+        half_dlat = (lat - math.radians(latitude)) / 2.0
+        half_dlon = np.radians(columns['lon'] - longitude) / 2.0
+        a = np.sin(half_dlat) ** 2 + math.cos(math.radians(latitude)) * columns['cos_lat'] * np.sin(half_dlon) ** 2
+        distances = 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        inside = distances <= radius_km
+        return columns['coop_ids'][inside], distances[inside]
+
+    @staticmethod
+    def _nearest(coop_ids, distances, limit):
+        """
+        Returns the "limit" nearest coops, each at its nearest address.
+        """
+        count = len(distances)
+        k = limit
+        while True:
+            if k < count:
+                order = np.argpartition(distances, k)[:k]
+                order = order[np.argsort(distances[order], kind='stable')]
+            else:
+                order = np.argsort(distances, kind='stable')
+            _, first = np.unique(coop_ids[order], return_index=True)
+            first.sort()
+            # Enough distinct coops, or nothing left to look at
+            if len(first) >= limit or k >= count:
+                order = order[first[:limit]]
+                return [(int(coop_id), float(distance)) for coop_id, distance in zip(coop_ids[order], distances[order])]
+            k *= 2
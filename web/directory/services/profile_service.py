@@ -0,0 +1,115 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sys
+from datetime import datetime
+
+from django.conf import settings
+
+
+class ProfileService(object):
+    """
+    Keeps the cProfile dumps of profiled requests (see
+    directory.middleware.ProfilingMiddleware) in PROFILE_DIR, one
+    "<view>-<UTC time>-<pid>.prof" file per request.  The oldest dumps are
+    deleted once the directory holds more than PROFILE_DIR_MAX_BYTES.
+
+    The dumps are standard pstats files: besides "summarize_profiles" they
+    open in snakeviz, or flameprof for a flame graph.
+    """
+
+    SUFFIX = '.prof'
+
+    def __init__(self, profile_dir=None, max_bytes=None):
+        self._dir = profile_dir or settings.PROFILE_DIR
+        self._max_bytes = max_bytes or settings.PROFILE_DIR_MAX_BYTES
+
+    @staticmethod
+    def should_profile(request):
+        """
+        Returns whether to profile the request: PROFILE_ENABLED must be on
+        and the request either carries the PROFILE_HEADER_TOKEN in an
+        "X-Profile" header or is picked at PROFILE_SAMPLE_RATE.
+        """
+        if not settings.PROFILE_ENABLED:
+            return False
+        token = settings.PROFILE_HEADER_TOKEN
+        if token and request.META.get('HTTP_X_PROFILE') == token:
+            return True
+        return random.random() < settings.PROFILE_SAMPLE_RATE
+
+    @staticmethod
+    def start():
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def save(self, profiler, view_name):
+        """
+        Writes the profiler's stats for the named view and prunes the
+        directory.  Returns the file name.
+        """
+        profiler.disable()
+        os.makedirs(self._dir, exist_ok=True)
+        name = '%s-%s-%d%s' % (
+            re.sub(r'[^A-Za-z0-9_.]+', '_', view_name or 'unmatched'),
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+            os.getpid(),
+            self.SUFFIX
+        )
+        path = os.path.join(self._dir, name)
+        tmp_path = path + '.tmp'
+        profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, path)
+        self._prune()
+        return name
+
+    def get_paths(self, view_name=None):
+        """
+        Returns the dump paths, oldest first, optionally only those of views
+        whose name contains "view_name".
+        """
+        if not os.path.isdir(self._dir):
+            return []
+        paths = [
+            os.path.join(self._dir, name) for name in os.listdir(self._dir)
+            if name.endswith(self.SUFFIX) and (not view_name or view_name in name.rsplit('-', 2)[0])
+        ]
+        return sorted(paths, key=os.path.getmtime)
+
+    def summarize(self, paths, sort='cumulative', limit=20):
+        """
+        Returns the pstats report of the "limit" hottest functions across
+        the given dumps.
+        """
+        stream = io.StringIO()
+        stats = None
+        for path in paths:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path, stream=stream)
+                else:
+                    stats.add(path)
+            except (IOError, EOFError, ValueError) as err:
+                print("Skipping unreadable profile %s: %s" % (path, err), file=sys.stderr)
+        if stats is None:
+            return ''
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def _prune(self):
+        paths = self.get_paths()
+        sizes = [os.path.getsize(path) for path in paths]
+        total = sum(sizes)
+        for path, size in zip(paths, sizes):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another worker got to it first
+                pass
+            total -= size
@@ -0,0 +1,59 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from directory.renderers import ORJSONRenderer
+from directory.services.compression_service import CompressionService
+
+
+class ReferenceDataService(object):
+    """
+    Caches the rendered JSON of the reference-data endpoints (countries,
+    states per country, coop types) so a warm request costs no queries.
+
+    Entries are keyed by a generation number that any write to the
+    underlying tables bumps, which drops every entry at once.
+    """
+
+    GENERATION_KEY = 'reference_data:generation'
+
+    def __init__(self):
+        self._cache = caches[settings.REFERENCE_DATA_CACHE]
+        self._timeout = settings.REFERENCE_DATA_CACHE_TIMEOUT
+
+    def get(self, name, get_data):
+        """
+        Returns the cached entry for "name" as a dict of content (JSON
+        bytes), encoded (encoding -> compressed content), etag and
+        last_modified (a timestamp).  On a miss the entry
+        is rendered from "get_data()" and cached.
+        """
+        key = 'reference_data:%s:%s' % (self._get_generation(), name)
+        entry = self._cache.get(key)
+        if entry is None:
+            content = ORJSONRenderer().render(get_data())
+            entry = {
+                'content': content,
+                'encoded': CompressionService().compress_all(content),
+                'etag': '"%s"' % hashlib.md5(content).hexdigest(),
+                'last_modified': int(time.time()),
+            }
+            self._cache.set(key, entry, self._timeout)
+        return entry
+
+    def invalidate(self):
+        try:
+            self._cache.incr(self.GENERATION_KEY)
+        except ValueError:
+            # Generation not cached yet (or evicted); start a new one
+            self._cache.set(self.GENERATION_KEY, int(time.time() * 1000), None)
+
+    def _get_generation(self):
+        generation = self._cache.get(self.GENERATION_KEY)
+        if generation is None:
+            generation = int(time.time() * 1000)
+            self._cache.add(self.GENERATION_KEY, generation, None)
+            generation = self._cache.get(self.GENERATION_KEY, generation)
+        return generation
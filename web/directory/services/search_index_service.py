@@ -0,0 +1,164 @@
+import threading
+import time
+
+from django.conf import settings
+
+from directory.models import Coop, DataVersion
+
+
+class CoopSearchIndex(object):
+    """
+    In-memory trigram index over the enabled coops, answering the
+    "/coops/?contains=" substring search without touching the database.
+
+    Every write bumps the "coop_search" DataVersion counter.  The process
+    that made the write re-indexes the changed coops in place; any other
+    process notices the new version (checked at most every
+    COOP_SEARCH_INDEX_CHECK_INTERVAL seconds) and rebuilds.
+    """
+
+    VERSION_NAME = 'coop_search'
+
+    # Indexable fields: name -> query returning (coop id, text) rows
+    FIELDS = {
+        'name': lambda coops: coops.values_list('id', 'name'),
+        'address': lambda coops: coops.values_list('id', 'addresses__raw'),
+        'type': lambda coops: coops.values_list('id', 'types__name'),
+    }
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns this process's shared index.
+        """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, fields=None, check_interval=None):
+        self._fields = fields or settings.COOP_SEARCH_INDEX_FIELDS
+        self._check_interval = (
+            check_interval if check_interval is not None else settings.COOP_SEARCH_INDEX_CHECK_INTERVAL
+        )
+        self._lock = threading.RLock()
+        # coop id -> tuple of normalized field texts
+        self._docs = {}
+        # trigram -> set of coop ids
+        self._postings = {}
+        self._version = None
+        self._checked_at = 0
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split()).casefold() if text else ""
+
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def search(self, query):
+        """
+        Returns the sorted ids of enabled coops with "query" in any indexed
+        field (case-insensitive).
+        """
+        self.ensure_current()
+        query = self.normalize(query)
+        with self._lock:
+            if len(query) >= 3:
+                postings = sorted(
+                    (self._postings.get(gram, ()) for gram in self.trigrams(query)),
+                    key=len
+                )
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                candidates = self._docs.keys()
+            return sorted(
+                coop_id for coop_id in candidates
+                if any(query in text for text in self._docs[coop_id])
+            )
+
+    def ensure_current(self):
+        """
+        Rebuilds the index if it hasn't been built or another process has
+        written since.
+        """
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self._check_interval:
+            return
+        version = DataVersion.objects.get_version(self.VERSION_NAME)
+        if version != self._version:
+            self.build(version)
+        self._checked_at = now
+
+    def build(self, version=None):
+        """
+        Loads every enabled coop into a fresh index (one query per field).
+        """
+        if version is None:
+            version = DataVersion.objects.get_version(self.VERSION_NAME)
+        docs = self._load(Coop.objects.filter(enabled=True))
+        postings = {}
+        for coop_id, texts in docs.items():
+            for gram in self._doc_trigrams(texts):
+                postings.setdefault(gram, set()).add(coop_id)
+        with self._lock:
+            self._docs = docs
+            self._postings = postings
+            self._version = version
+
+    def record_change(self, coop_ids=None):
+        """
+        Called after a write that touched "coop_ids" (None if the affected
+        coops aren't known).  Bumps the shared version and re-indexes the
+        coops here; if this process missed someone else's write, or the ids
+        aren't known, the index is rebuilt on the next search instead.
+        """
+        version = DataVersion.objects.bump(self.VERSION_NAME)
+        with self._lock:
+            if self._version is None:
+                return
+            if coop_ids is None or version != self._version + 1:
+                self._version = None
+                return
+            self._reindex(coop_ids)
+            self._version = version
+
+    def _reindex(self, coop_ids):
+        coop_ids = set(coop_ids)
+        for coop_id in coop_ids:
+            texts = self._docs.pop(coop_id, None)
+            if texts:
+                for gram in self._doc_trigrams(texts):
+                    self._postings.get(gram, set()).discard(coop_id)
+        docs = self._load(Coop.objects.filter(enabled=True, id__in=coop_ids))
+        for coop_id, texts in docs.items():
+            self._docs[coop_id] = texts
+            for gram in self._doc_trigrams(texts):
+                self._postings.setdefault(gram, set()).add(coop_id)
+
+    def _load(self, coops):
+        """
+        Returns coop id -> tuple of normalized texts, one per indexed field.
+        Multi-valued fields (addresses, types) are joined with newlines.
+        """
+        texts = {}
+        for position, field in enumerate(self._fields):
+            for coop_id, text in self.FIELDS[field](coops).iterator():
+                field_texts = texts.setdefault(coop_id, [[] for _ in self._fields])
+                if text:
+                    field_texts[position].append(self.normalize(text))
+        return {
+            coop_id: tuple("\n".join(values) for values in field_texts)
+            for coop_id, field_texts in texts.items()
+        }
+
+    def _doc_trigrams(self, texts):
+        grams = set()
+        for text in texts:
+            grams |= self.trigrams(text)
+        return grams
@@ -0,0 +1,126 @@
+import csv
+import hashlib
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Stand-in geocodes land in this box (Chicago, roughly)
+AREA = (-88.0, 41.6, -87.5, 42.1)
+
+
+class StandinService(object):
+    """
+    Local HTTP stand-ins for the external services, for load tests:
+
+        GET  /search/<address>?format=json   Nominatim: a made-up but stable
+                                             location for the address, none
+                                             if it contains "nowhere"
+        GET  /sheets/<file>/<sheet>          Google Sheets: the rows appended
+                                             so far, as CSV
+        POST /sheets/<file>/<sheet>          Google Sheets: appends the JSON
+                                             list of values as a row
+
+    Every response waits "latency_ms" first, to mimic the real services.
+    Point the app at it with NOMINATIM_URL=<url> and
+    GOOGLE_SHEETS_STANDIN_URL=<url>/sheets.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0):
+        self.latency = latency_ms / 1000.0
+        # (file, sheet) -> rows
+        self.sheets = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        """
+        Serves in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def geocode(address):
+        """
+        Returns the stand-in Nominatim results for the address.
+        """
+        if 'nowhere' in address.lower():
+            return []
+        digest = hashlib.md5(address.encode('utf-8')).digest()
+        min_lon, min_lat, max_lon, max_lat = AREA
+        lat = min_lat + (max_lat - min_lat) * int.from_bytes(digest[:4], 'big') / 2 ** 32
+        lon = min_lon + (max_lon - min_lon) * int.from_bytes(digest[4:8], 'big') / 2 ** 32
+        return [{'lat': '%.7f' % lat, 'lon': '%.7f' % lon, 'display_name': address}]
+
+    def _make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith('/search'):
+                    address = unquote(url.path[len('/search/'):]) or parse_qs(url.query).get('q', [''])[0]
+                    self._respond(200, 'application/json', json.dumps(service.geocode(address)))
+                elif url.path.startswith('/sheets/'):
+                    with service._lock:
+                        rows = list(service.sheets.get(self._sheet_key(url.path), []))
+                    out = io.StringIO()
+                    csv.writer(out).writerows(rows)
+                    self._respond(200, 'text/csv', out.getvalue())
+                else:
+                    self._respond(404, 'text/plain', 'Not found')
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not url.path.startswith('/sheets/'):
+                    self._respond(404, 'text/plain', 'Not found')
+                    return
+                try:
+                    values = json.loads(body)
+                except ValueError:
+                    self._respond(400, 'text/plain', 'Expected a JSON list')
+                    return
+                with service._lock:
+                    service.sheets.setdefault(self._sheet_key(url.path), []).append(values)
+                self._respond(200, 'application/json', json.dumps({'updatedRows': 1}))
+
+            @staticmethod
+            def _sheet_key(path):
+                parts = [unquote(part) for part in path.split('/')[2:4]]
+                return tuple(parts + [''] * (2 - len(parts)))
+
+            def _respond(self, status, content_type, content):
+                if service.latency:
+                    time.sleep(service.latency)
+                content = content.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -46,7 +46,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'directory.middleware.RequestTimingMiddleware',
+    'directory.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'directory.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -141,4 +144,171 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 # Configuration for phone numbers.
 PHONENUMBER_DB_FORMAT = 'NATIONAL'
 PHONENUMBER_DEFAULT_REGION = 'US'
- 
+
+# Materialized "/data" map snapshots.  Snapshots are rebuilt in a
+# background thread a few seconds after the coop data changes; until then
+# the stale one is served.  A snapshot still stale MAP_SNAPSHOT_STALE_GRACE
+# seconds after the change is rebuilt by the next worker that reads it.
+MAP_SNAPSHOT_ENABLED = True
+MAP_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'snapshots')
+MAP_SNAPSHOT_BACKGROUND = True
+MAP_SNAPSHOT_REBUILD_DELAY = 2
+MAP_SNAPSHOT_STALE_GRACE = 60
+
+# Precomputed map marker clusters (see directory/services/cluster_service.py)
+MAP_CLUSTER_MAX_ZOOM = 16
+MAP_CLUSTER_CELL_PIXELS = 64
+
+# In-memory index for the "/coops/?contains=" search (see
+# directory/services/search_index_service.py).  Fields may be any of
+# 'name', 'address' and 'type'; the database search matches names only.
+COOP_SEARCH_INDEX_ENABLED = False
+COOP_SEARCH_INDEX_FIELDS = ('name',)
+COOP_SEARCH_INDEX_CHECK_INTERVAL = 2
+
+# Rendered reference data (countries, states, coop types).  A file cache
+# is shared by all the gunicorn workers on a box, so an invalidation in
+# one worker is seen by the rest.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reference_data': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'reference_data'),
+    },
+}
+REFERENCE_DATA_CACHE = 'reference_data'
+REFERENCE_DATA_CACHE_TIMEOUT = 24 * 60 * 60
+
+# REST API responses are encoded with orjson (see directory/renderers.py);
+# set to False to fall back to DRF's stock JSON encoder.
+ORJSON_RENDERER_ENABLED = True
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'directory.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# brotli/gzip response compression (see directory/middleware.py).  Map
+# snapshots and reference data are precompressed once, at
+# RESPONSE_COMPRESSION_STATIC_BROTLI_QUALITY (slow: ~2s per MB at 11, in
+# the background rebuild); everything else is compressed per request at
+# the faster settings.
+RESPONSE_COMPRESSION_ENABLED = True
+RESPONSE_COMPRESSION_MIN_LENGTH = 200
+RESPONSE_COMPRESSION_BROTLI_QUALITY = 4
+RESPONSE_COMPRESSION_GZIP_LEVEL = 6
+RESPONSE_COMPRESSION_STATIC_BROTLI_QUALITY = 11
+
+# Most coops "/coops/?ids=" returns in one request
+COOP_BATCH_MAX_IDS = 100
+
+# In-memory index for "/coops/nearby" (see
+# directory/services/nearby_service.py).  While enabled, every coop write
+# bumps its version and the other workers reload it, so "/coops/nearby"
+# is off (404) unless this is on.
+NEARBY_INDEX_ENABLED = False
+NEARBY_GRID_DEGREES = 0.1
+NEARBY_INDEX_CHECK_INTERVAL = 2
+NEARBY_MERGE_THRESHOLD = 10000
+NEARBY_MAX_RADIUS_KM = 500
+NEARBY_MAX_LIMIT = 100
+
+# Per-request query count, database time and section timings (see
+# directory/middleware.py).  Requests running more queries than their
+# view's "query_budget" (or this default) are logged as warnings, slow ones
+# at INFO, and a REQUEST_LOG_SAMPLE_RATE fraction of the rest.  The timings
+# go out in Server-Timing headers with DEBUG on, or to requests sending
+# "X-Request-Timing: <REQUEST_TIMING_HEADER_TOKEN>".
+REQUEST_TIMING_ENABLED = True
+REQUEST_QUERY_BUDGET = 20
+REQUEST_LOG_SLOW_MS = 1000
+REQUEST_LOG_SAMPLE_RATE = 0.0
+REQUEST_TIMING_HEADER_TOKEN = os.environ.get('REQUEST_TIMING_HEADER_TOKEN', '')
+
+# Prometheus metrics at "/metrics" (see directory/metrics.py).  With
+# several gunicorn workers, set the "prometheus_multiproc_dir" environment
+# variable to a directory they share so the counts add up across them.
+# METRICS_MULTIPROC_DIRS lists other processes' directories to add in
+# (the geocode worker's, which records the Nominatim calls).
+# Only clients in METRICS_ALLOWED_IPS (addresses or networks) or sending
+# "Authorization: Bearer <METRICS_BEARER_TOKEN>" can read them.
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = [
+    ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()
+]
+METRICS_BEARER_TOKEN = os.environ.get('METRICS_BEARER_TOKEN', '')
+METRICS_MULTIPROC_DIRS = [
+    path.strip() for path in os.environ.get('METRICS_MULTIPROC_DIRS', '').split(',') if path.strip()
+]
+
+# Opt-in cProfile runs of single requests (see
+# directory/services/profile_service.py).  With PROFILE_ENABLED on, a
+# request is profiled when it sends "X-Profile: <PROFILE_HEADER_TOKEN>" or
+# is sampled at PROFILE_SAMPLE_RATE.  Summarize the dumps with
+# "manage.py summarize_profiles".
+PROFILE_ENABLED = False
+PROFILE_HEADER_TOKEN = os.environ.get('PROFILE_HEADER_TOKEN', '')
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_DIR_MAX_BYTES = 200 * 1024 * 1024
+
+# External services.  Point these at local stand-ins ("manage.py
+# run_standins") to load test without calling the real APIs.
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+GOOGLE_SHEETS_STANDIN_URL = os.environ.get('GOOGLE_SHEETS_STANDIN_URL', '')
+
+# Geocoding runs in "manage.py run_geocode_worker", off the request path
+# (see directory/services/geocode_queue_service.py).  Nominatim's usage
+# policy allows one request per second.  With the queue off, writes
+# geocode synchronously.
+GEOCODE_QUEUE_ENABLED = True
+GEOCODE_RATE_LIMIT = 1.0
+GEOCODE_BATCH_SIZE = 50
+GEOCODE_JOB_LEASE = 300
+GEOCODE_MAX_ATTEMPTS = 5
+GEOCODE_RETRY_BACKOFF = 30
+GEOCODE_RETRY_BACKOFF_MAX = 3600
+
+# Geocoder answers are cached by normalized address (see
+# GeocodeCacheEntry), found ones for GEOCODE_CACHE_TTL seconds and "not
+# found" ones for GEOCODE_CACHE_NOT_FOUND_TTL, since those may just be
+# missing from OpenStreetMap for now.
+GEOCODE_CACHE_ENABLED = True
+GEOCODE_CACHE_TTL = 180 * 24 * 60 * 60
+GEOCODE_CACHE_NOT_FOUND_TTL = 7 * 24 * 60 * 60
+
+# "manage.py geocode_missing" backfills addresses without coordinates,
+# GEOCODE_BACKFILL_CHUNK_SIZE at a time, with up to GEOCODE_BACKFILL_WORKERS
+# geocoder calls in flight (still at most GEOCODE_RATE_LIMIT per second).
+# Its progress is saved to GEOCODE_BACKFILL_CHECKPOINT so an interrupted
+# run resumes.
+GEOCODE_BACKFILL_CHUNK_SIZE = 100
+GEOCODE_BACKFILL_WORKERS = 4
+GEOCODE_BACKFILL_CHECKPOINT = os.path.join(BASE_DIR, 'geocode_missing.checkpoint')
+
+# Structured logging of the CoopManager lookups (see
+# directory/instrumentation.py).  When enabled, a QUERY_LOG_SAMPLE_RATE
+# fraction of lookups is logged, plus every one slower than
+# QUERY_LOG_SLOW_MS.
+QUERY_LOG_ENABLED = False
+QUERY_LOG_SAMPLE_RATE = 0.01
+QUERY_LOG_SLOW_MS = 500
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'directory': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
@@ -0,0 +1,164 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from address.models import Address, Country, State
+from directory.models import Coop, CoopType
+from directory.services.cluster_service import ClusterService
+from directory.services.map_snapshot_service import MapSnapshotService
+from directory.services.nearby_service import NearbyIndex
+from directory.services.reference_data_service import ReferenceDataService
+from directory.services.search_index_service import CoopSearchIndex
+
+
+def invalidate_map_snapshots(type_names=None):
+    """
+    Marks the affected map snapshots stale once the current transaction
+    commits, so the rebuild reads the committed data.
+    """
+    if not settings.MAP_SNAPSHOT_ENABLED:
+        return
+    transaction.on_commit(lambda: MapSnapshotService().invalidate(type_names))
+
+
+def reindex_coops(coop_ids=None):
+    """
+    Updates the in-memory coop indexes (search and nearby, whichever are
+    enabled) once the current transaction commits.
+    """
+    if settings.COOP_SEARCH_INDEX_ENABLED:
+        transaction.on_commit(lambda: CoopSearchIndex.get_instance().record_change(coop_ids))
+    if settings.NEARBY_INDEX_ENABLED:
+        transaction.on_commit(lambda: NearbyIndex.get_instance().record_change(coop_ids))
+
+
+def invalidate_reference_data():
+    transaction.on_commit(lambda: ReferenceDataService().invalidate())
+
+
+def remember_map_points(instance, address_ids):
+    """
+    Notes which of the addresses are in the map clusters, and where,
+    before a write that may change that; update_map_points moves them
+    once the write is done.
+    """
+    instance._map_points = (address_ids, ClusterService().get_points(address_ids))
+
+
+def update_map_points(instance):
+    address_ids, old_points = instance.__dict__.pop('_map_points', ((), {}))
+    if address_ids:
+        svc = ClusterService()
+        svc.update_points(old_points, svc.get_points(address_ids))
+
+
+def coop_type_names(coops):
+    return set(CoopType.objects.filter(coop__in=coops).values_list('name', flat=True))
+
+
+@receiver(pre_save, sender=Coop)
+def coop_saving(sender, instance, raw=False, **kwargs):
+    # Enabling or disabling a coop adds or removes its points
+    if raw or instance.pk is None:
+        return
+    enabled = Coop.objects.filter(pk=instance.pk).values_list('enabled', flat=True).first()
+    if enabled is not None and enabled != instance.enabled:
+        remember_map_points(instance, list(instance.addresses.values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Coop)
+def coop_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    update_map_points(instance)
+    invalidate_map_snapshots(coop_type_names([instance]))
+    reindex_coops([instance.pk])
+
+
+@receiver(pre_save, sender=Address)
+@receiver(pre_delete, sender=Address)
+def address_changing(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    remember_map_points(instance, [instance.pk])
+
+
+@receiver(post_save, sender=Address)
+def address_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    update_map_points(instance)
+    coops = list(instance.coop_set.all())
+    invalidate_map_snapshots(coop_type_names(coops))
+    reindex_coops([coop.pk for coop in coops])
+
+
+@receiver(pre_delete, sender=Coop)
+def coop_deleting(sender, instance, **kwargs):
+    remember_map_points(instance, list(instance.addresses.values_list('id', flat=True)))
+
+
+@receiver(post_delete, sender=Coop)
+def coop_deleted(sender, instance, **kwargs):
+    update_map_points(instance)
+    # The coop's types are gone by now, so there's no telling which
+    # snapshots were affected.
+    invalidate_map_snapshots()
+    reindex_coops([instance.pk])
+
+
+@receiver(post_delete, sender=Address)
+@receiver(post_save, sender=CoopType)
+@receiver(post_delete, sender=CoopType)
+def map_data_deleted(sender, instance, raw=False, **kwargs):
+    # The old relations (or the old type name) are gone by now, so there's
+    # no telling which snapshots or coops were affected.
+    if raw:
+        return
+    if sender is Address:
+        update_map_points(instance)
+    invalidate_map_snapshots()
+    reindex_coops()
+
+
+@receiver(m2m_changed, sender=Coop.addresses.through)
+def coop_addresses_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Linking or unlinking an address from an enabled coop adds or
+    # removes its point
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if reverse:
+            address_ids = [instance.pk]
+        elif pk_set is None:
+            address_ids = list(instance.addresses.values_list('id', flat=True))
+        else:
+            address_ids = list(pk_set)
+        remember_map_points(instance, address_ids)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        update_map_points(instance)
+
+
+@receiver(m2m_changed, sender=Coop.types.through)
+@receiver(m2m_changed, sender=Coop.addresses.through)
+def coop_relations_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse or not pk_set:
+        invalidate_map_snapshots()
+        reindex_coops(None if reverse else [instance.pk])
+        return
+    type_names = coop_type_names([instance])
+    if model is CoopType:
+        type_names |= set(CoopType.objects.filter(pk__in=pk_set).values_list('name', flat=True))
+    invalidate_map_snapshots(type_names)
+    reindex_coops([instance.pk])
+
+
+@receiver(post_save, sender=Country)
+@receiver(post_delete, sender=Country)
+@receiver(post_save, sender=State)
+@receiver(post_delete, sender=State)
+@receiver(post_save, sender=CoopType)
+@receiver(post_delete, sender=CoopType)
+def reference_data_changed(sender, **kwargs):
+    invalidate_reference_data()
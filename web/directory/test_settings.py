@@ -1,4 +1,5 @@
 from .settings import *
+import tempfile
 
 
 class DisableMigrations(object):
@@ -12,3 +13,16 @@ class DisableMigrations(object):
 
 
 MIGRATION_MODULES = DisableMigrations()
+
+MAP_SNAPSHOT_DIR = tempfile.mkdtemp(prefix='map_snapshots')
+MAP_SNAPSHOT_BACKGROUND = False
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reference_data': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'reference_data',
+    },
+}
@@ -4,6 +4,10 @@ from directory import views
 
 urlpatterns = [
     path('data', views.data, name='data'),
+    path('metrics', views.metrics_page, name='metrics'),
+    path('coops.geojson', views.coops_geojson, name='coops_geojson'),
+    path('coops/clusters', views.coops_clusters, name='coops_clusters'),
+    path('coops/nearby', views.coops_nearby, name='coops_nearby'),
     path('coops/no_coords', views.coops_wo_coordinates, name='coops_wo_coordinates'),
     path('coops/', views.CoopList.as_view()),
     path('coops/<int:pk>/', views.CoopDetail.as_view()),
@@ -1,52 +1,187 @@
+import logging
+
 from directory.models import Coop, CoopType
 from address.models import State, Country, Locality
+from directory import metrics
+from directory.instrumentation import query_budget
+from directory.flat_serializers import FlatCoopSearchSerializer, FlatCoopSerializer, FlatPersonSerializer
+from directory.pagination import KeysetPagination
 from directory.serializers import *
+from directory.services.cluster_service import ClusterService
+from directory.services.compression_service import CompressionService
 from directory.services.google_sheet_service import GoogleSheetService
+from directory.services.map_data_service import MapDataService
+from directory.services.map_snapshot_service import MapSnapshotService
+from directory.services.nearby_service import NearbyIndex
+from directory.services.reference_data_service import ReferenceDataService
+from directory.services.search_index_service import CoopSearchIndex
+from django.conf import settings
 from django.http import Http404
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.renderers import JSONRenderer, TemplateHTMLRenderer
-import csv
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 from django.db.models.functions import Lower
 
+logger = logging.getLogger(__name__)
 
-def data(request):
-    # Create the HttpResponse object with the appropriate CSV header.
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="data.csv"'
 
-    writer = csv.writer(response, quoting=csv.QUOTE_ALL)
-    writer.writerow(['name','address','city','postal code','type','website','lon','lat'])
+def list_response(request, queryset, serializer_class, sort_key=None):
+    """
+    Serializes one keyset-paginated page of the queryset, or all of it if
+    the client opted out with "paginate=false".
+    """
+    context = {'request': request}
+    paginator = KeysetPagination(sort_key=sort_key)
+    if not paginator.is_enabled(request):
+        serializer = serializer_class(queryset, many=True, context=context)
+        return Response(serializer.data)
+    page = paginator.paginate_queryset(queryset, request)
+    serializer = serializer_class(page, many=True, context=context)
+    return paginator.get_paginated_response(serializer.data)
+
+
+@query_budget(GET=2)
+def data(request, format=None):
+    """
+    Returns the map data ("csv", the default, or "json") for the "type" or
+    "contains" filter.  All coops and each coop type are served from the
+    on-disk snapshot, with ETag support; "contains" searches (and everything,
+    if MAP_SNAPSHOT_ENABLED is off) are streamed straight from the database.
+    """
+    format = format or 'csv'
+    if format not in MapSnapshotService.CONTENT_TYPES:
+        raise Http404
     type = request.GET.get("type", "")
     contains = request.GET.get("contains", "")
-    if type:
-        coops = Coop.objects.get_by_type(type)
-    elif contains:
-        print("containns:",contains)
-        coops = Coop.objects.contains_type(contains.split(","))
-
-    for coop in coops.order_by(Lower('name')):
-        for address in coop.addresses.all():
-            postal_code = address.locality.postal_code
-            city = address.locality.name + ", " + address.locality.state.code + " " + postal_code
-            coop_types = ', '.join([type.name for type in coop.types.all()])
-            if address.longitude and address.latitude:
-                writer.writerow([coop.name, address.formatted, city, postal_code, coop_types, coop.web_site, address.longitude, address.latitude])
-
+    content_type = MapSnapshotService.CONTENT_TYPES[format]
+    snapshot = None
+    if settings.MAP_SNAPSHOT_ENABLED:
+        svc = MapSnapshotService()
+        map_filter = svc.get_filter(type=type, contains=contains)
+        snapshot = svc.get_snapshot(map_filter, format) if map_filter else None
+    if snapshot is not None:
+        path, etag = snapshot
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            path, encoding = CompressionService().get_precompressed(
+                path, request.META.get('HTTP_ACCEPT_ENCODING', '')
+            )
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+                etag = 'W/' + etag
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept-Encoding',))
+    else:
+        svc = MapDataService()
+        coops = svc.get_coops(type=type, contains=contains)
+        chunks = svc.get_csv_chunks(coops) if format == 'csv' else svc.get_json_chunks(coops)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+    if format == 'csv':
+        response['Content-Disposition'] = 'attachment; filename="data.csv"'
     return response
 
+def metrics_page(request, format=None):
+    """
+    Returns the Prometheus metrics (see directory/metrics.py) to scrapers
+    allowed by metrics.is_scraper_allowed; it's a 404 for everyone else.
+    """
+    if not settings.METRICS_ENABLED or not metrics.is_scraper_allowed(request):
+        raise Http404
+    content, content_type = metrics.render_metrics()
+    return HttpResponse(content, content_type=content_type)
+
+def coops_geojson(request, format=None):
+    """
+    Returns a GeoJSON FeatureCollection of the geocoded coop addresses,
+    optionally limited to a "bbox" (minLon,minLat,maxLon,maxLat) viewport
+    and the same "type" or "contains" filter as "/data".
+    """
+    svc = MapDataService()
+    coops = svc.get_coops(
+        type=request.GET.get("type", ""),
+        contains=request.GET.get("contains", "")
+    )
+    bbox = request.GET.get("bbox", "")
+    if bbox:
+        try:
+            coops = svc.filter_bbox(coops, svc.parse_bbox(bbox))
+        except ValueError as err:
+            return JsonResponse({'bbox': str(err)}, status=status.HTTP_400_BAD_REQUEST)
+    return StreamingHttpResponse(svc.get_geojson_chunks(coops), content_type='application/geo+json')
+
+@api_view(('GET',))
+def coops_clusters(request, format=None):
+    """
+    Returns the precomputed marker clusters (centroid and count) for the
+    "zoom" level, limited to the optional "bbox" (minLon,minLat,maxLon,maxLat)
+    viewport.
+    """
+    try:
+        zoom = int(request.GET.get("zoom", ""))
+    except ValueError:
+        return Response({'zoom': 'This field is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    bbox = request.GET.get("bbox", "")
+    try:
+        bbox = MapDataService.parse_bbox(bbox) if bbox else None
+    except ValueError as err:
+        return Response({'bbox': str(err)}, status=status.HTTP_400_BAD_REQUEST)
+    svc = ClusterService()
+    return Response(svc.get_clusters(zoom, bbox))
+
+@api_view(('GET',))
+def coops_nearby(request, format=None):
+    """
+    Returns the enabled coops with an address within "radius_km" (default
+    10) of "lat"/"lon", nearest first, each with its "distance_km".  At
+    most "limit" (default 20) are returned; "type" limits the coops to
+    one coop type.  Needs NEARBY_INDEX_ENABLED.
+    """
+    if not settings.NEARBY_INDEX_ENABLED:
+        raise Http404
+    try:
+        latitude = float(request.GET["lat"])
+        longitude = float(request.GET["lon"])
+    except (KeyError, ValueError):
+        return Response({'lat': 'lat and lon are required.'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        radius_km = float(request.GET.get("radius_km", 10))
+        limit = int(request.GET.get("limit", 20))
+    except ValueError:
+        return Response({'radius_km': 'Expected numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return Response({'lat': 'Coordinates out of range.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 0 < radius_km <= settings.NEARBY_MAX_RADIUS_KM:
+        return Response(
+            {'radius_km': 'Must be between 0 and %s.' % settings.NEARBY_MAX_RADIUS_KM},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    limit = max(1, min(limit, settings.NEARBY_MAX_LIMIT))
+
+    nearest = NearbyIndex.get_instance().search(
+        latitude, longitude, radius_km, limit, type_name=request.GET.get("type", None)
+    )
+    coops = FlatCoopSearchSerializer.plan(Coop.objects.filter(id__in=[id for id, _ in nearest]), request).in_bulk()
+    found = [(coops[id], distance) for id, distance in nearest if id in coops]
+    data = FlatCoopSearchSerializer([coop for coop, _ in found], many=True, context={'request': request}).data
+    for rep, (_, distance) in zip(data, found):
+        rep['distance_km'] = round(distance, 3)
+    return Response(data)
+
+@query_budget(GET=2)
 @api_view(('GET',))
 def coops_wo_coordinates(request):
     """
     Returns all the coops that currently have no coordiantes (or at least
     are missing either latitude or longitude)
     """
-    coops = Coop.objects.find_wo_coords()
-    serializer = CoopSearchSerializer(coops, many=True)
-    return Response(serializer.data)
+    coops = FlatCoopSearchSerializer.plan(Coop.objects.find_wo_coords(), request)
+    return list_response(request, coops, FlatCoopSearchSerializer)
 
 @api_view(('POST',))
 def save_to_sheet_from_form(request):
@@ -94,9 +229,16 @@ class CoopList(APIView):
     """
     List all coops, or create a new coop.
     """
+    query_budget = {'GET': 3}
+
     def get(self, request, format=None):
+        if "ids" in request.GET:
+            return self.get_batch(request)
         contains = request.GET.get("contains", "")
-        if contains:
+        if contains and settings.COOP_SEARCH_INDEX_ENABLED:
+            ids = CoopSearchIndex.get_instance().search(contains)
+            coops = Coop.objects.filter(id__in=ids).order_by('id')
+        elif contains:
             coops = Coop.objects.find(
                 partial_name=contains,
                 enabled=True
@@ -121,14 +263,33 @@ class CoopList(APIView):
                 state_abbrev=state,
                 types_arr=types_arr
             )
-        serializer = CoopSearchSerializer(coops, many=True)
+        coops = FlatCoopSearchSerializer.plan(coops, request)
+        return list_response(request, coops, FlatCoopSearchSerializer, sort_key=Lower('name'))
+
+    def get_batch(self, request):
+        """
+        Returns the full (detail) representation of each coop in "ids" (a
+        comma-separated list of at most COOP_BATCH_MAX_IDS ids) in one
+        response, in the order asked for.  Unknown ids are left out.
+        """
+        try:
+            ids = [int(id) for id in request.GET["ids"].split(",") if id.strip()]
+        except ValueError:
+            return Response({'ids': 'Expected a comma-separated list of ids.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > settings.COOP_BATCH_MAX_IDS:
+            return Response(
+                {'ids': 'At most %d ids per request.' % settings.COOP_BATCH_MAX_IDS},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        coops = FlatCoopSerializer.plan(Coop.objects.filter(id__in=ids), request).in_bulk()
+        found = [coops[id] for id in dict.fromkeys(ids) if id in coops]
+        serializer = FlatCoopSerializer(found, many=True, context={'request': request})
         return Response(serializer.data)
 
     def post(self, request, format=None):
         serializer = CoopSerializer(data=request.data)
         if serializer.is_valid():
-            print("request data ...")
-            print(request.data)
+            logger.debug("Creating coop from %s", request.data)
             values = [
                 request.data['name'],
                 request.data['addresses'][0]['raw'],
@@ -157,6 +318,8 @@ class CoopDetail(APIView):
     """
     Retrieve, update or delete a coop instance.
     """
+    query_budget = {'GET': 3}
+
     def get_object(self, pk):
         try:
             return Coop.objects.get(pk=pk)
@@ -164,8 +327,11 @@ class CoopDetail(APIView):
             raise Http404
 
     def get(self, request, pk, format=None):
-        coop = self.get_object(pk)
-        serializer = CoopSerializer(coop)
+        try:
+            coop = FlatCoopSerializer.plan(Coop.objects.all(), request).get(pk=pk)
+        except Coop.DoesNotExist:
+            raise Http404
+        serializer = FlatCoopSerializer(coop, context={'request': request})
         return Response(serializer.data)
 
     def put(self, request, pk, format=None):
@@ -186,14 +352,16 @@ class PersonList(APIView):
     """
     List all people, or create a new person.
     """
+    query_budget = {'GET': 5}
+
     def get(self, request, format=None):
         coop = request.GET.get("coop", "")
         if coop:
             people = Person.objects.filter(coops__in=[coop])
         else:
-            people = People.objects.all()
-        serializer = PersonSerializer(people, many=True)
-        return Response(serializer.data)
+            people = Person.objects.all()
+        people = FlatPersonSerializer.plan(people, request)
+        return list_response(request, people, FlatPersonSerializer)
 
     def post(self, request, format=None):
         serializer = PersonSerializer(data=request.data)
@@ -207,6 +375,8 @@ class PersonDetail(APIView):
     """
     Retrieve, update or delete a person instance.
     """
+    query_budget = {'GET': 5}
+
     def get_object(self, pk):
         try:
             return Person.objects.get(pk=pk)
@@ -214,8 +384,11 @@ class PersonDetail(APIView):
             raise Http404
 
     def get(self, request, pk, format=None):
-        person = self.get_object(pk)
-        serializer = PersonSerializer(person)
+        try:
+            person = FlatPersonSerializer.plan(Person.objects.all(), request).get(pk=pk)
+        except Person.DoesNotExist:
+            raise Http404
+        serializer = FlatPersonSerializer(person, context={'request': request})
         return Response(serializer.data)
 
     def put(self, request, pk, format=None):
@@ -231,38 +404,68 @@ class PersonDetail(APIView):
         person.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+def reference_response(request, name, get_data):
+    """
+    Returns the cached JSON (precompressed if the client accepts it) for a
+    reference-data endpoint, or a 304 if the client's copy (If-None-Match /
+    If-Modified-Since) is current.
+    """
+    entry = ReferenceDataService().get(name, get_data)
+    response = get_conditional_response(
+        request,
+        etag=entry['etag'],
+        last_modified=entry['last_modified']
+    )
+    etag = entry['etag']
+    if response is None:
+        encoding = CompressionService().negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        encoded = entry.get('encoded', {})
+        if encoding in encoded:
+            response = HttpResponse(encoded[encoding], content_type='application/json')
+            response['Content-Encoding'] = encoding
+            etag = 'W/' + etag
+        else:
+            response = HttpResponse(entry['content'], content_type='application/json')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
 class CoopTypeList(APIView):
     """
     List all coop types
     """
+    query_budget = {'GET': 1}
+
     def get(self, request, format=None):
-        coop_types = CoopType.objects.all().order_by(Lower('name'))
-        serializer = CoopTypeSerializer(coop_types, many=True)
-        return Response(serializer.data)
+        def get_data():
+            coop_types = CoopType.objects.all().order_by(Lower('name'))
+            return CoopTypeSerializer(coop_types, many=True).data
+        return reference_response(request, 'coop_types', get_data)
 
 
 class CountryList(APIView):
     """
     List all countries
     """
+    query_budget = {'GET': 1}
+
     def get(self, request, format=None):
-        countries = Country.objects.all()
-        serializer = CountrySerializer(countries, many=True)
-        return Response(serializer.data)
+        def get_data():
+            countries = Country.objects.all()
+            return CountrySerializer(countries, many=True).data
+        return reference_response(request, 'countries', get_data)
 
 
 class StateList(APIView):
     """
     List all states based on country
     """
-    def get_object(self, country_code):
-        try:
-            return State.objects.first(country__code=country_code)
-            #return State.objects.filter(country=pk)
-        except Coop.DoesNotExist:
-            raise Http404
+    query_budget = {'GET': 1}
 
     def get(self, request, country_code, format=None):
-        states = State.objects.filter(country__code=country_code)
-        serializer = StateSerializer(states, many=True)
-        return Response(serializer.data)
+        def get_data():
+            states = State.objects.filter(country__code=country_code).select_related('country')
+            return StateSerializer(states, many=True).data
+        return reference_response(request, 'states:%s' % country_code, get_data)
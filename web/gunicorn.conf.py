@@ -0,0 +1,24 @@
+"""
+gunicorn settings, loaded automatically from the working directory.
+
+Sets up prometheus_client's multiprocess mode when the
+"prometheus_multiproc_dir" environment variable is set (see
+directory/metrics.py): the directory is emptied when the server starts, so
+counts from a previous run don't linger, and a worker's files are marked
+dead when it exits.
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    path = os.environ.get('prometheus_multiproc_dir')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,45 @@
+"""
+Bytes saved and CPU cost of response compression on the big payloads:
+"/coops/?paginate=false" (compressed per request) and the "/data" CSV
+snapshot (compressed once, at build time).  "per request" rows use the
+RESPONSE_COMPRESSION_* settings the middleware uses; "static" rows use
+the highest settings, as precompression does.
+
+    BENCHMARK_SIZES=1000,10000 pytest -s tests/benchmarks/bench_compression.py
+"""
+import pytest
+from rest_framework.test import APIClient
+
+from directory.services.compression_service import CompressionService
+from .utils import build_coops, get_sizes, measure, print_table
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes("1000,10000"))
+def test_compression(size, settings, tmp_path):
+    settings.MAP_SNAPSHOT_DIR = str(tmp_path)
+    build_coops(size)
+    client = APIClient()
+    payloads = [
+        ("/coops/", client.get("/coops/", {"paginate": "false"}).content),
+        ("/data", b"".join(client.get("/data").streaming_content)),
+    ]
+    svc = CompressionService()
+    rows = []
+    for name, content in payloads:
+        rows.append([name, "raw", len(content), "100.0%", "-"])
+        for encoding in ("gzip", "br"):
+            for static in (False, True):
+                seconds, compressed = measure(lambda: svc.compress(content, encoding, static=static), runs=3)
+                rows.append([
+                    name,
+                    "%s %s" % (encoding, "static" if static else "per request"),
+                    len(compressed),
+                    "%.1f%%" % (100.0 * len(compressed) / len(content)),
+                    "%.2f" % (seconds * 1000),
+                ])
+    print_table(
+        "Compression at %d coops" % size,
+        ["payload", "encoding", "bytes", "of raw", "cpu ms"],
+        rows
+    )
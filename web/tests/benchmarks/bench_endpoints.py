@@ -0,0 +1,143 @@
+"""
+Latency, query count and peak memory of every API endpoint, reads and
+writes, against generated datasets (1k/10k/100k coops by default).
+
+Nominatim and Google Sheets are replaced by stand-ins, so the write paths
+measure this app's own work only.
+
+    BENCHMARK_SIZES=1000,10000,100000 pytest -s tests/benchmarks/bench_endpoints.py
+
+Save a baseline, then compare later runs against it (the run fails if an
+endpoint regressed, see utils.compare_baseline):
+
+    BENCHMARK_BASELINE=baseline.json BENCHMARK_SAVE_BASELINE=1 pytest -s tests/benchmarks/bench_endpoints.py
+    BENCHMARK_BASELINE=baseline.json pytest -s tests/benchmarks/bench_endpoints.py
+"""
+import tempfile
+from unittest import mock
+
+import pytest
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from address.models import Address
+from directory.models import Coop, Person
+from directory.services.google_sheet_service import GoogleSheetService
+from directory.services.location_service import LocationService
+from .utils import build_coops, build_people, compare_baseline, get_sizes, print_table, profile_call
+
+
+def get_reads(coop_types, coop_ids):
+    type_name = coop_types[0].name
+    coop_id = coop_ids[len(coop_ids) // 2]
+    member_of = Person.coops.through.objects.order_by('id').values_list('coop_id', flat=True).first()
+    state = Address.objects.select_related('locality__state').first().locality.state
+    return [
+        # Each CoopManager.find criterion on its own, then combined
+        ("/coops/", {"contains": "Coop 000421"}),
+        ("/coops/", {"name": "Coop 000421"}),
+        ("/coops/", {"enabled": "true"}),
+        ("/coops/", {"coop_type": type_name}),
+        ("/coops/", {"city": "Narnia"}),
+        ("/coops/", {"zip": "60605"}),
+        ("/coops/", {"street": "777 Fake"}),
+        ("/coops/", {"state": state.code}),
+        ("/coops/", {"name": "Coop 0004", "enabled": "true", "coop_type": type_name, "city": "Narnia", "zip": "60605"}),
+        ("/coops/%d/" % coop_id, {}),
+        ("/coops/", {"ids": ",".join(str(id) for id in coop_ids[:50])}),
+        ("/coops/no_coords", {}),
+        ("/coops/nearby", {"lat": 41.88, "lon": -87.63, "radius_km": 2}),
+        ("/data", {}),
+        ("/data", {"type": type_name}),
+        ("/coops.geojson", {"bbox": "-87.66,41.86,-87.61,41.91"}),
+        ("/coops/clusters", {"zoom": 10}),
+        ("/people/", {"coop": member_of}),
+        ("/people/", {}),
+        ("/people/%d/" % Person.objects.order_by('id').values_list('id', flat=True).first(), {}),
+        ("/coop_types/", {}),
+        ("/countries/", {}),
+        ("/states/%s/" % state.country.code, {}),
+    ]
+
+
+def get_coop_payload(state, name):
+    return {
+        "name": name,
+        "types": [{"name": "Grocery"}],
+        "addresses": [{
+            "raw": "222 W. Merchandise Mart Plaza",
+            "formatted": "222 W. Merchandise Mart Plaza",
+            "locality": {
+                "name": "Chicago",
+                "postal_code": "60654",
+                "state": {
+                    "id": state.id,
+                    "name": state.name,
+                    "code": state.code,
+                    "country": {"id": state.country.id, "name": state.country.name}
+                }
+            }
+        }],
+        "enabled": True,
+        "phone": {"phone": "7732441468"},
+        "email": {"email": "test@example.com"},
+        "web_site": "http://www.example.com"
+    }
+
+
+def get_content(client, method, url, params, status):
+    if method == "get":
+        response = client.get(url, params)
+    else:
+        response = getattr(client, method)(url, params, format="json")
+    assert response.status_code == status, (url, response.status_code)
+    if response.streaming:
+        return b"".join(response.streaming_content)
+    return response.content
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes("1000,10000,100000"))
+def test_endpoints(size):
+    coop_types = build_coops(size)
+    coop_ids = list(Coop.objects.order_by('id').values_list('id', flat=True))
+    build_people(coop_ids, max(10, size // 10))
+    state = Address.objects.select_related('locality__state__country').first().locality.state
+
+    client = APIClient()
+    cases = [("get", url, params, 200) for url, params in get_reads(coop_types, coop_ids)]
+    victims = coop_ids[-20:]
+    person_id = Person.objects.order_by('id').values_list('id', flat=True).first()
+    cases += [
+        ("post", "/coops/", get_coop_payload(state, "New Coop"), 201),
+        ("put", "/coops/%d/" % coop_ids[0], dict(get_coop_payload(state, "Updated Coop"), id=coop_ids[0]), 200),
+        ("delete", lambda: "/coops/%d/" % victims.pop(), {}, 204),
+        ("post", "/people/", {
+            "first_name": "New", "last_name": "Person", "coops": [coop_ids[0]],
+            "contact_methods": [{"email": "new@example.com", "type": "EMAIL"}]
+        }, 201),
+        ("put", "/people/%d/" % person_id, {
+            "id": person_id, "first_name": "Updated", "last_name": "Person", "coops": [coop_ids[1]],
+            "contact_methods": [{"email": "updated@example.com", "type": "EMAIL"}]
+        }, 200),
+    ]
+
+    results = {}
+    rows = []
+    with override_settings(MAP_SNAPSHOT_DIR=tempfile.mkdtemp(prefix='map_snapshots'), MAP_SNAPSHOT_BACKGROUND=False,
+                           NEARBY_INDEX_ENABLED=True), \
+            mock.patch.object(GoogleSheetService, '__init__', return_value=None), \
+            mock.patch.object(GoogleSheetService, 'append_to_sheet'), \
+            mock.patch.object(LocationService, 'get_coords', return_value=[41.89, -87.63]):
+        for method, url, params, status in cases:
+            get_url = url if callable(url) else (lambda url=url: url)
+            case = "%s %s" % (method.upper(), "/coops/<pk>/" if callable(url) else url)
+            if method == "get" and params:
+                case += "?" + "&".join("%s=%s" % item for item in params.items())
+            result, content = profile_call(lambda: get_content(client, method, get_url(), params, status))
+            results[case] = result
+            rows.append([case[:80], len(content), result['queries'], result['peak_kb'], "%.2f" % result['ms']])
+    print_table("Endpoints at %d coops" % size, ["request", "bytes", "queries", "peak KB", "ms"], rows)
+
+    regressions = compare_baseline("endpoints-%d" % size, results)
+    assert not regressions, "\n".join(regressions)
@@ -0,0 +1,45 @@
+"""
+Payload size and latency of the map endpoints: the full "/data" CSV
+against "/coops.geojson" for the whole area and for a downtown viewport.
+
+Run explicitly (these aren't collected by a plain "pytest tests"):
+
+    BENCHMARK_SIZES=10000,100000 pytest -s tests/benchmarks/bench_map_payloads.py
+"""
+import pytest
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from .utils import build_coops, get_sizes, measure, print_table
+
+# About 1% of the benchmark area
+VIEWPORT = "-87.66,41.86,-87.61,41.91"
+
+
+def get_content(client, url, params):
+    response = client.get(url, params)
+    assert response.status_code == 200
+    return b"".join(response.streaming_content)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes())
+@override_settings(MAP_SNAPSHOT_ENABLED=False)
+def test_map_payloads(size):
+    coop_types = build_coops(size)
+    client = APIClient()
+    type_name = coop_types[0].name
+    cases = [
+        ("/data", {}),
+        ("/data", {"type": type_name}),
+        ("/coops.geojson", {}),
+        ("/coops.geojson", {"type": type_name}),
+        ("/coops.geojson", {"bbox": VIEWPORT}),
+        ("/coops.geojson", {"bbox": VIEWPORT, "type": type_name}),
+    ]
+    rows = []
+    for url, params in cases:
+        seconds, content = measure(lambda: get_content(client, url, params), runs=3)
+        query = "&".join("%s=%s" % item for item in params.items())
+        rows.append([url + ("?" + query if query else ""), len(content), "%.1f" % (seconds * 1000)])
+    print_table("Map payloads at %d coops" % size, ["request", "bytes", "ms"], rows)
@@ -0,0 +1,85 @@
+"""
+"/coops/nearby" search latency on the in-memory NearbyIndex against a
+brute-force vectorized haversine over every point.  The points are
+generated straight into the index's arrays (no database), spread over
+the continental US with a dense cluster around Chicago.
+
+    BENCHMARK_SIZES=100000,1000000 pytest -s tests/benchmarks/bench_nearby.py
+"""
+import math
+import time
+
+import numpy as np
+import pytest
+
+from directory.services.nearby_service import EARTH_RADIUS_KM, NearbyIndex
+from .utils import get_sizes, measure, print_table
+
+CHICAGO = (41.88, -87.63)
+SEARCHES = [
+    (CHICAGO, 1, 20),
+    (CHICAGO, 10, 20),
+    (CHICAGO, 50, 100),
+    ((39.74, -104.99), 25, 20),
+]
+
+
+def make_columns(size, seed=1):
+    rng = np.random.default_rng(seed)
+    dense = size // 5
+    lat = np.concatenate([
+        rng.uniform(25.0, 49.0, size - dense),
+        rng.normal(CHICAGO[0], 0.2, dense),
+    ])
+    lon = np.concatenate([
+        rng.uniform(-124.0, -67.0, size - dense),
+        rng.normal(CHICAGO[1], 0.2, dense),
+    ])
+    return {
+        'coop_ids': np.arange(size, dtype=np.int64),
+        'address_ids': np.arange(size, dtype=np.int64),
+        'lat': lat,
+        'lon': lon,
+        'cos_lat': np.cos(np.radians(lat)),
+        'masks': rng.integers(1, 16, size).astype(np.uint64),
+    }
+
+
+def brute_force(columns, latitude, longitude, radius_km, limit):
+    lat = np.radians(columns['lat'])
+    a = (np.sin((lat - math.radians(latitude)) / 2) ** 2 +
+         math.cos(math.radians(latitude)) * columns['cos_lat'] *
+         np.sin(np.radians(columns['lon'] - longitude) / 2) ** 2)
+    distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    inside = np.flatnonzero(distances <= radius_km)
+    return inside[np.argsort(distances[inside])][:limit].tolist()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes("100000,1000000"))
+def test_nearby(size):
+    columns = make_columns(size)
+    index = NearbyIndex(check_interval=3600)
+    start = time.perf_counter()
+    index.set_points(columns)
+    build_seconds = time.perf_counter() - start
+    index._version, index._checked_at = 0, time.monotonic()
+
+    rows = [["(grid sort)", "", "", "%.2f" % (build_seconds * 1000), "", ""]]
+    for (latitude, longitude), radius_km, limit in SEARCHES:
+        index_seconds, found = measure(lambda: index.search(latitude, longitude, radius_km, limit), runs=20)
+        brute_seconds, expected = measure(lambda: brute_force(columns, latitude, longitude, radius_km, limit), runs=5)
+        assert [coop_id for coop_id, _ in found] == expected
+        rows.append([
+            "%.2f,%.2f" % (latitude, longitude),
+            radius_km,
+            len(found),
+            "%.3f" % (index_seconds * 1000),
+            "%.3f" % (brute_seconds * 1000),
+            "%.0fx" % (brute_seconds / index_seconds),
+        ])
+    print_table(
+        "Nearby search over %d points" % size,
+        ["center", "radius km", "found", "index ms", "brute ms", "speedup"],
+        rows
+    )
@@ -0,0 +1,43 @@
+"""
+JSON render time for realistic "/coops/" and coop detail payloads, DRF's
+stock JSONRenderer vs. directory.renderers.ORJSONRenderer.  The payloads
+are serialized up front so only encoding is measured.
+
+    BENCHMARK_SIZES=1000,10000 pytest -s tests/benchmarks/bench_renderers.py
+"""
+import pytest
+from rest_framework.renderers import JSONRenderer
+
+from directory.flat_serializers import FlatCoopSearchSerializer, FlatCoopSerializer
+from directory.models import Coop
+from directory.renderers import ORJSONRenderer
+from .utils import build_coops, get_sizes, measure, print_table
+
+CASES = [
+    ("search", FlatCoopSearchSerializer),
+    ("detail", FlatCoopSerializer),
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes("1000,10000"))
+def test_renderers(size):
+    build_coops(size)
+    rows = []
+    for name, serializer_class in CASES:
+        data = serializer_class(serializer_class.plan(Coop.objects.order_by('id')), many=True).data
+        stock_seconds, stock = measure(lambda: JSONRenderer().render(data))
+        fast_seconds, fast = measure(lambda: ORJSONRenderer().render(data))
+        assert fast == stock
+        rows.append([
+            name,
+            len(stock),
+            "%.2f" % (stock_seconds * 1000),
+            "%.2f" % (fast_seconds * 1000),
+            "%.1fx" % (stock_seconds / fast_seconds),
+        ])
+    print_table(
+        "Render %d coops" % size,
+        ["shape", "bytes", "stock ms", "orjson ms", "speedup"],
+        rows
+    )
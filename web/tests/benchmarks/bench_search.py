@@ -0,0 +1,32 @@
+"""
+Latency of the substring searches behind "/coops/?contains=" and
+"/coops/?street=" (CoopManager.find).
+
+On Postgres the trigram indexes from migration 0007 are created for the
+run; on other backends this measures the plain icontains fallback.
+
+    BENCHMARK_SIZES=10000,100000,1000000 pytest -s tests/benchmarks/bench_search.py
+"""
+import pytest
+
+from directory.models import Coop
+from .utils import build_coops, create_trigram_indexes, get_sizes, measure, print_table
+
+SEARCHES = [
+    {"partial_name": "0421"},
+    {"partial_name": "coop 0099"},
+    {"partial_name": "no such coop"},
+    {"partial_name": "", "street": "777 fake"},
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes("10000,100000,1000000"))
+def test_substring_search(size):
+    build_coops(size)
+    create_trigram_indexes()
+    rows = []
+    for criteria in SEARCHES:
+        seconds, count = measure(lambda: len(list(Coop.objects.find(**criteria))))
+        rows.append([", ".join("%s=%r" % item for item in criteria.items()), count, "%.2f" % (seconds * 1000)])
+    print_table("Substring search at %d coops" % size, ["criteria", "rows", "ms"], rows)
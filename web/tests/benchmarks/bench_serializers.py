@@ -0,0 +1,45 @@
+"""
+Serialization cost per 1,000 coops, DRF serializers vs. the flat ones in
+directory/flat_serializers.py, for the "/coops/" search rows and the
+coop detail shape.  The rows are loaded (with the views' query plans)
+before timing, so only serialization and JSON rendering are measured.
+
+    BENCHMARK_SIZES=1000,10000 pytest -s tests/benchmarks/bench_serializers.py
+"""
+import pytest
+from rest_framework.renderers import JSONRenderer
+
+from directory.flat_serializers import FlatCoopSearchSerializer, FlatCoopSerializer
+from directory.models import Coop
+from directory.serializers import CoopSearchSerializer, CoopSerializer
+from .utils import build_coops, get_sizes, measure, print_table
+
+CASES = [
+    ("search", CoopSearchSerializer, FlatCoopSearchSerializer),
+    ("detail", CoopSerializer, FlatCoopSerializer),
+]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("size", get_sizes("1000,10000"))
+def test_serializers(size):
+    build_coops(size)
+    renderer = JSONRenderer()
+    rows = []
+    for name, drf_class, flat_class in CASES:
+        coops = list(flat_class.plan(Coop.objects.order_by('id')))
+        timings = {}
+        for label, serializer_class in [("drf", drf_class), ("flat", flat_class)]:
+            seconds, _ = measure(lambda: renderer.render(serializer_class(coops, many=True).data))
+            timings[label] = seconds * 1000 * 1000 / size
+        rows.append([
+            name,
+            "%.2f" % timings["drf"],
+            "%.2f" % timings["flat"],
+            "%.1fx" % (timings["drf"] / timings["flat"]),
+        ])
+    print_table(
+        "Serialize + render %d coops (ms per 1k)" % size,
+        ["shape", "drf", "flat", "speedup"],
+        rows
+    )
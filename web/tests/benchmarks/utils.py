@@ -0,0 +1,192 @@
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.db import connection
+
+from address.models import Address
+from directory.instrumentation import RequestTimings
+from directory.models import Coop, CoopType, Person
+from ..factories import AddressFactory, CoopFactory, CoopTypeFactory, LocalityFactory, PersonFactory
+
+# Chicago, roughly.  Benchmark coops are scattered across this box.
+AREA = (-88.0, 41.6, -87.5, 42.1)
+
+
+def get_sizes(default="10000,100000"):
+    """
+    Dataset sizes to benchmark, from the BENCHMARK_SIZES environment
+    variable (comma separated).
+    """
+    return [int(size) for size in os.environ.get("BENCHMARK_SIZES", default).split(",")]
+
+
+def create_coordinates_index():
+    """
+    The test database is built without migrations, so add the address
+    coordinates index from directory/migrations/0005 by hand.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS address_address_lat_lon_idx "
+            "ON address_address (latitude, longitude)"
+        )
+
+
+def create_trigram_indexes():
+    """
+    Adds the pg_trgm indexes from directory/migrations/0007 (Postgres only).
+    """
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS directory_coop_name_trgm_idx "
+            "ON directory_coop USING gin (name gin_trgm_ops)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS address_address_raw_trgm_idx "
+            "ON address_address USING gin (raw gin_trgm_ops)"
+        )
+        cursor.execute("ANALYZE directory_coop")
+        cursor.execute("ANALYZE address_address")
+
+
+def build_coops(count, type_names=("Grocery", "Housing", "Worker", "Credit Union"), seed=1):
+    """
+    Bulk creates "count" geocoded coops, each with one address and one type,
+    using the factories for field defaults.  Returns the list of coop types.
+    """
+    create_coordinates_index()
+    rng = random.Random(seed)
+    locality = LocalityFactory()
+    coop_types = [CoopTypeFactory(name=name) for name in type_names]
+    min_lon, min_lat, max_lon, max_lat = AREA
+
+    addresses = Address.objects.bulk_create([
+        AddressFactory.build(
+            locality=locality,
+            raw="%d Fake Rd" % i,
+            formatted="%d Fake Rd." % i,
+            latitude=rng.uniform(min_lat, max_lat),
+            longitude=rng.uniform(min_lon, max_lon),
+        )
+        for i in range(count)
+    ], batch_size=5000)
+    coops = Coop.objects.bulk_create([
+        CoopFactory.build(name="Coop %06d" % i, phone=None, email=None)
+        for i in range(count)
+    ], batch_size=5000)
+    # bulk_create only sets primary keys on Postgres, so look them up
+    address_ids = list(Address.objects.filter(locality=locality).order_by('id').values_list('id', flat=True))
+    coop_ids = list(Coop.objects.order_by('id').values_list('id', flat=True))[-count:]
+    Coop.addresses.through.objects.bulk_create([
+        Coop.addresses.through(coop_id=coop_id, address_id=address_id)
+        for coop_id, address_id in zip(coop_ids, address_ids)
+    ], batch_size=5000)
+    Coop.types.through.objects.bulk_create([
+        Coop.types.through(coop_id=coop_id, cooptype_id=coop_types[i % len(coop_types)].id)
+        for i, coop_id in enumerate(coop_ids)
+    ], batch_size=5000)
+    return coop_types
+
+
+def build_people(coop_ids, count, seed=1):
+    """
+    Bulk creates "count" people, each a member of one to three of the
+    given coops.
+    """
+    rng = random.Random(seed)
+    Person.objects.bulk_create([
+        PersonFactory.build(first_name="Person", last_name="%06d" % i)
+        for i in range(count)
+    ], batch_size=5000)
+    person_ids = list(Person.objects.order_by('id').values_list('id', flat=True))[-count:]
+    Person.coops.through.objects.bulk_create([
+        Person.coops.through(person_id=person_id, coop_id=coop_id)
+        for person_id in person_ids
+        for coop_id in set(rng.sample(coop_ids, min(len(coop_ids), rng.randint(1, 3))))
+    ], batch_size=5000)
+
+
+def measure(func, runs=5):
+    """
+    Calls "func" "runs" times and returns (median seconds, last result).
+    """
+    timings = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def print_table(title, header, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    print("\n" + title)
+    for row in [header] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+
+def profile_call(func, runs=5):
+    """
+    Calls "func" once to warm up, once each to count its queries and its
+    peak traced memory, then "runs" times for the median latency.  Returns
+    (result dict, last return value).
+    """
+    func()
+    # Not CaptureQueriesContext: the test client's request_started signal
+    # resets connection.queries
+    with RequestTimings().activate() as timings:
+        func()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    seconds, result = measure(func, runs)
+    return {'ms': round(seconds * 1000, 2), 'queries': timings.queries, 'peak_kb': peak // 1024}, result
+
+
+def compare_baseline(name, results):
+    """
+    Checks "results" ({case: profile_call result}) against the saved
+    baseline "name" in the BENCHMARK_BASELINE file and returns the
+    regressions as messages.  With BENCHMARK_SAVE_BASELINE set the results
+    are saved as the new baseline instead.
+
+    A case regresses when it runs more queries than before, or its latency
+    or peak memory grew by more than BENCHMARK_TOLERANCE (a fraction,
+    default 0.25) and by more than 2 ms / 64 KB, which is within noise.
+    """
+    path = os.environ.get("BENCHMARK_BASELINE", "")
+    if not path:
+        return []
+    baselines = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baselines = json.load(f)
+    if os.environ.get("BENCHMARK_SAVE_BASELINE"):
+        baselines[name] = results
+        with open(path, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        return []
+
+    tolerance = float(os.environ.get("BENCHMARK_TOLERANCE", "0.25"))
+    regressions = []
+    for case, result in results.items():
+        baseline = baselines.get(name, {}).get(case)
+        if baseline is None:
+            continue
+        if result['queries'] > baseline['queries']:
+            regressions.append("%s: %d queries, was %d" % (case, result['queries'], baseline['queries']))
+        for key, floor in (('ms', 2), ('peak_kb', 64)):
+            if result[key] > baseline[key] * (1 + tolerance) and result[key] - baseline[key] > floor:
+                regressions.append("%s: %s %s, was %s" % (case, key, result[key], baseline[key]))
+    return regressions
@@ -0,0 +1,124 @@
+import json
+import pytest
+from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from .factories import AddressFactory, CoopFactory, CoopTypeFactory, LocalityFactory, PersonFactory
+from directory.flat_serializers import FlatCoopSearchSerializer, FlatCoopSerializer, FlatPersonSerializer
+from directory.models import Coop, Person
+from directory.serializers import CoopSearchSerializer, CoopSerializer, PersonSerializer
+
+
+class FlatSerializerTests(TestCase):
+
+    def setUp(self):
+        self.locality = LocalityFactory()
+        grocery = CoopTypeFactory(name="Grocery")
+        housing = CoopTypeFactory(name="Housing")
+
+        self.full = CoopFactory(
+            name="Full Coop",
+            addresses=[AddressFactory(locality=self.locality), AddressFactory(locality=self.locality)]
+        )
+        self.full.types.add(grocery, housing)
+        self.bare = CoopFactory(
+            name="Bare Coop",
+            phone=None,
+            email=None,
+            web_site="",
+            addresses=[AddressFactory(locality=self.locality, latitude=None, longitude=None)]
+        )
+        self.no_locality = CoopFactory(
+            name="No Locality Coop",
+            addresses=[AddressFactory(locality=None)]
+        )
+        self.no_locality.types.add(grocery)
+
+    def assert_same_output(self, flat, drf):
+        # Compare the rendered JSON so key order counts too
+        assert json.dumps(flat.data) == json.dumps(drf.data)
+
+    @pytest.mark.django_db
+    def test_coop_search_serializer_matches_drf(self):
+        """ Test the flat search serializer renders the same JSON as CoopSearchSerializer """
+        coops = list(FlatCoopSearchSerializer.plan(Coop.objects.order_by('id')))
+        self.assert_same_output(
+            FlatCoopSearchSerializer(coops, many=True),
+            CoopSearchSerializer(coops, many=True)
+        )
+
+    @pytest.mark.django_db
+    def test_coop_serializer_matches_drf(self):
+        """ Test the flat coop serializer renders the same JSON as CoopSerializer """
+        for coop in [self.full, self.bare, self.no_locality]:
+            coop = FlatCoopSerializer.plan(Coop.objects.all()).get(pk=coop.pk)
+            self.assert_same_output(FlatCoopSerializer(coop), CoopSerializer(coop))
+
+    @pytest.mark.django_db
+    def test_coop_serializer_matches_drf_for_unsaved_choice(self):
+        """ Test an in-memory contact type enum renders as its value, like DRF """
+        coop = FlatCoopSerializer.plan(Coop.objects.all()).get(pk=self.full.pk)
+        coop.phone.type = coop.phone.ContactTypes.PHONE
+        self.assert_same_output(FlatCoopSerializer(coop), CoopSerializer(coop))
+
+    @pytest.mark.django_db
+    def test_person_serializer_matches_drf(self):
+        """ Test the flat person serializer renders the same JSON as PersonSerializer """
+        person = PersonFactory(coops=0)
+        person.coops.add(self.full, self.bare)
+        people = list(FlatPersonSerializer.plan(Person.objects.order_by('id')))
+        self.assert_same_output(
+            FlatPersonSerializer(people, many=True),
+            PersonSerializer(people, many=True)
+        )
+
+    def get_request(self, **params):
+        return Request(APIRequestFactory().get('/coops/', params))
+
+    @pytest.mark.django_db
+    def test_sparse_fields(self):
+        """ Test "fields" picks nested fields and only loads what they need """
+        request = self.get_request(fields="id,name,addresses.latitude,addresses.longitude")
+        with self.assertNumQueries(2):
+            coop = FlatCoopSerializer.plan(Coop.objects.all(), request).get(pk=self.full.pk)
+            data = FlatCoopSerializer(coop, context={'request': request}).data
+        assert data == {
+            'id': self.full.id,
+            'name': "Full Coop",
+            'addresses': [
+                {'latitude': address.latitude, 'longitude': address.longitude}
+                for address in self.full.addresses.all()
+            ],
+        }
+
+        request = self.get_request(fields="id,name")
+        with self.assertNumQueries(1):
+            coop = FlatCoopSerializer.plan(Coop.objects.all(), request).get(pk=self.full.pk)
+            data = FlatCoopSerializer(coop, context={'request': request}).data
+        assert data == {'id': self.full.id, 'name': "Full Coop"}
+
+    @pytest.mark.django_db
+    def test_expand(self):
+        """ Test relations left out of "expand" render as primary keys """
+        request = self.get_request(expand="addresses")
+        with self.assertNumQueries(3):
+            coop = FlatCoopSerializer.plan(Coop.objects.all(), request).get(pk=self.full.pk)
+            data = FlatCoopSerializer(coop, context={'request': request}).data
+        assert data['types'] == sorted(coop_type.id for coop_type in self.full.types.all())
+        assert data['phone'] == self.full.phone_id
+        assert data['addresses'][0]['locality'] == self.locality.id
+
+        request = self.get_request(fields="types,addresses", expand="")
+        with self.assertNumQueries(3):
+            coop = FlatCoopSerializer.plan(Coop.objects.all(), request).get(pk=self.full.pk)
+            data = FlatCoopSerializer(coop, context={'request': request}).data
+        assert set(data) == {'types', 'addresses'}
+        assert sorted(data['addresses']) == sorted(address.id for address in self.full.addresses.all())
+
+    @pytest.mark.django_db
+    def test_invalid_selection(self):
+        """ Test unknown fields and expanding plain fields are rejected """
+        for params in [{'fields': 'id,nope'}, {'fields': 'name.first'}, {'expand': 'addresses.raw'}]:
+            with pytest.raises(ValidationError):
+                FlatCoopSerializer.plan(Coop.objects.all(), self.get_request(**params))
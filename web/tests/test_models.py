@@ -1,5 +1,7 @@
+import json
 import pytest
-from django.test import TestCase
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
 from .factories import CoopTypeFactory, CoopFactory, AddressFactory, PhoneContactMethodFactory 
 from directory.models import Coop, CoopType
 
@@ -82,5 +84,45 @@ class ModelTests(TestCase):
         results = list(coops)
         assert len(results) > 0, "Failed to find any matching results."
         assert coop_from_factory in list(coops), "Failed to find coop."
- 
 
+    def test_find_by_partial_name_and_street(self):
+        """
+        Substring search on name and street is case-insensitive and treats
+        LIKE wildcards literally
+        """
+        address = AddressFactory(raw="1871 Merchandise Mart")
+        coop = CoopFactory(name="Sunrise 100% Grocery", addresses=[address])
+        assert list(Coop.objects.find(partial_name="100% gro")) == [coop]
+        assert list(Coop.objects.find(partial_name="rise", street="merchandise")) == [coop]
+        assert list(Coop.objects.find(partial_name="1000")) == []
+        assert list(Coop.objects.find(partial_name="100_")) == []
+
+    @pytest.mark.django_db
+    @override_settings(QUERY_LOG_ENABLED=True, QUERY_LOG_SAMPLE_RATE=1.0, QUERY_LOG_SLOW_MS=60000)
+    def test_find_logs_sampled_query(self):
+        """ Test a sampled lookup logs its criteria, SQL, row count and duration """
+        CoopFactory(name="Logged Coop")
+        with self.assertLogs('directory.queries', level='INFO') as logs:
+            coops = list(Coop.objects.find(partial_name="logged", enabled=True).order_by('id'))
+        assert len(coops) == 1
+        record = json.loads(logs.records[0].getMessage())
+        assert record['lookup'] == 'find'
+        assert record['criteria'] == {'partial_name': 'logged', 'enabled': True}
+        assert record['rows'] == 1
+        assert 'SELECT' in record['sql']
+        assert record['slow'] is False
+
+    @pytest.mark.django_db
+    @override_settings(QUERY_LOG_ENABLED=True, QUERY_LOG_SAMPLE_RATE=0.0, QUERY_LOG_SLOW_MS=0)
+    def test_slow_query_always_logged(self):
+        """ Test lookups over the slow threshold are logged even when not sampled """
+        with self.assertLogs('directory.queries', level='WARNING') as logs:
+            assert Coop.objects.find_wo_coords().count() == 0
+        record = json.loads(logs.records[0].getMessage())
+        assert (record['lookup'], record['operation'], record['slow']) == ('find_wo_coords', 'count', True)
+
+    @override_settings(QUERY_LOG_ENABLED=False)
+    def test_instrumentation_disabled(self):
+        """ Test lookups return plain querysets when query logging is off """
+        assert type(Coop.objects.find(partial_name="x")) is QuerySet
+        assert type(Coop.objects.get_by_type("Grocery")) is QuerySet
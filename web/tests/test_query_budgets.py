@@ -0,0 +1,109 @@
+import pytest
+import tempfile
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase
+from django.urls import resolve
+from rest_framework.test import APIClient
+from .factories import AddressFactory, CoopFactory, CoopTypeFactory, LocalityFactory, PersonFactory
+from directory.instrumentation import RequestTimings
+from directory.middleware import get_query_budget
+
+SEED_SIZE = 3
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every view's query count must stay within the budget declared next to
+    it and must not grow with the amount of data: each read is measured
+    with N and then 10 x N coops, people and addresses.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.locality = LocalityFactory()
+        self.coop_types = [CoopTypeFactory(name="Grocery"), CoopTypeFactory(name="Housing")]
+        self.coops = []
+        self.people = []
+
+    def seed(self, count):
+        """
+        Adds coops (every third one without coordinates) and people up to
+        "count" of each.
+        """
+        for i in range(len(self.coops), count):
+            geocoded = i % 3 != 0
+            address = AddressFactory(
+                locality=self.locality,
+                raw="%d Fake Rd" % i,
+                latitude=41.88 if geocoded else None,
+                longitude=-87.63 if geocoded else None
+            )
+            coop = CoopFactory(name="Budget Coop %d" % i, addresses=[address])
+            coop.types.add(*self.coop_types)
+            self.coops.append(coop)
+        for i in range(len(self.people), count):
+            person = PersonFactory(coops=0, first_name="Person %d" % i)
+            person.coops.set(self.coops[:3] + self.coops[-2:])
+            self.people.append(person)
+
+    def count_queries(self, url, params):
+        # Reference data is cached; measure the uncached path
+        caches[settings.REFERENCE_DATA_CACHE].clear()
+        with RequestTimings().activate() as timings:
+            response = self.client.get(url, params)
+            assert response.status_code == 200, (url, response.status_code)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        return timings.queries
+
+    def get_reads(self):
+        """
+        Returns (url, params, settings) for every read, with ids that stay
+        the same as the data grows.
+        """
+        coop = self.coops[1]
+        return [
+            ("/coops/", {"contains": "Budget Coop"}, {}),
+            ("/coops/", {"contains": "Budget Coop"}, {'COOP_SEARCH_INDEX_ENABLED': False}),
+            ("/coops/", {"name": "Budget", "coop_type": "Grocery", "city": self.locality.name}, {}),
+            ("/coops/", {"paginate": "false"}, {}),
+            ("/coops/", {"ids": ",".join(str(c.id) for c in self.coops[:SEED_SIZE])}, {}),
+            ("/coops/%d/" % coop.id, {}, {}),
+            ("/people/", {}, {}),
+            ("/people/", {"paginate": "false"}, {}),
+            ("/people/", {"coop": coop.id}, {}),
+            ("/people/%d/" % self.people[0].id, {}, {}),
+            # A cold snapshot build, and the unsnapshotted stream
+            ("/data", {}, {'MAP_SNAPSHOT_DIR': tempfile.mkdtemp(prefix='map_snapshots')}),
+            ("/data.json", {"type": "Grocery"}, {'MAP_SNAPSHOT_ENABLED': False}),
+            ("/coops/no_coords", {}, {}),
+            ("/states/%s/" % self.locality.state.country.code, {}, {}),
+            ("/coop_types/", {}, {}),
+            ("/countries/", {}, {}),
+        ]
+
+    def measure(self):
+        counts = []
+        for url, params, overrides in self.get_reads():
+            with self.settings(**overrides):
+                counts.append(self.count_queries(url, params))
+        return counts
+
+    @pytest.mark.django_db
+    def test_query_budgets(self):
+        """ Test reads stay within their view's budget as the data grows tenfold """
+        self.seed(SEED_SIZE)
+        small = self.measure()
+        self.seed(SEED_SIZE * 10)
+        large = self.measure()
+        for (url, params, overrides), before, after in zip(self.get_reads(), small, large):
+            request = "%s %s %s" % (url, params, overrides)
+            view = resolve(url).func
+            assert 'GET' in (getattr(view, 'query_budget', None) or getattr(view.view_class, 'query_budget', {})), \
+                "%s: no query budget declared" % request
+            budget = get_query_budget(view, 'GET')
+            assert after <= budget, "%s: %d queries, budget %d" % (request, after, budget)
+            assert after == before, "%s: %d queries with %d coops, %d with %d" % (
+                request, before, SEED_SIZE, after, SEED_SIZE * 10
+            )
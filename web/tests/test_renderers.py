@@ -0,0 +1,55 @@
+import datetime
+import decimal
+import pytest
+from django.test import TestCase, override_settings
+from django.utils.translation import gettext_lazy
+from phonenumber_field.phonenumber import PhoneNumber
+from rest_framework.renderers import JSONRenderer
+from .factories import AddressFactory, CoopFactory, CoopTypeFactory, LocalityFactory
+from directory.flat_serializers import FlatCoopSerializer
+from directory.models import Coop
+from directory.renderers import ORJSONRenderer
+
+
+class ORJSONRendererTests(TestCase):
+
+    def assert_same_output(self, data):
+        assert ORJSONRenderer().render(data) == JSONRenderer().render(data)
+
+    def test_special_types(self):
+        """ Test the types orjson doesn't know render like the stock renderer """
+        self.assert_same_output({
+            'price': decimal.Decimal('1.50'),
+            'label': gettext_lazy('Coop'),
+            'created': datetime.datetime(2020, 1, 2, 3, 4, 5, 678000, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2020, 1, 2),
+            'took': datetime.timedelta(seconds=90),
+            'text': 'café \u2028 \u2029',
+            1: None,
+        })
+
+    def test_phone_number(self):
+        """ Test phone numbers render as their string form """
+        phone = PhoneNumber.from_string('8005551234', region='US')
+        assert ORJSONRenderer().render({'phone': phone}) == JSONRenderer().render({'phone': str(phone)})
+
+    @pytest.mark.django_db
+    def test_coop_payload(self):
+        """ Test a coop detail payload renders byte for byte like the stock renderer """
+        coop = CoopFactory(addresses=[AddressFactory(locality=LocalityFactory())])
+        coop.types.add(CoopTypeFactory(name="Grocery"))
+        coop = FlatCoopSerializer.plan(Coop.objects.all()).get(pk=coop.pk)
+        self.assert_same_output(FlatCoopSerializer(coop).data)
+
+    def test_indent_falls_back(self):
+        """ Test pretty-printed output comes from the stock renderer """
+        data = {'a': [1, 2]}
+        media_type = 'application/json; indent=4'
+        assert ORJSONRenderer().render(data, media_type) == JSONRenderer().render(data, media_type)
+
+    @override_settings(ORJSON_RENDERER_ENABLED=False)
+    def test_disabled(self):
+        """ Test the setting switches back to the stock encoder """
+        with pytest.raises(TypeError):
+            # The stock encoder doesn't know PhoneNumber
+            ORJSONRenderer().render({'phone': PhoneNumber.from_string('8005551234', region='US')})
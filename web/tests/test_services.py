@@ -1,7 +1,34 @@
+import io
+import json
+import os
 import pytest
-from django.test import TestCase
-from .factories import CoopTypeFactory, CoopFactory, AddressFactory, PhoneContactMethodFactory
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from django.test import TestCase, TransactionTestCase
+from prometheus_client import REGISTRY
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
+from .factories import CoopTypeFactory, CoopFactory, AddressFactory, LocalityFactory, PhoneContactMethodFactory
+from directory.instrumentation import RequestTimings
+from directory.services.cluster_service import ClusterService
+from directory.services.compression_service import CompressionService
+from directory.services.geocode_backfill_service import GeocodeBackfillService
+from directory.services.geocode_queue_service import GeocodeQueueService, RateLimiter
+from directory.services.google_sheet_service import GoogleSheetService
+from directory.services.load_test_service import LoadTestService, percentile
 from directory.services.location_service import LocationService 
+from directory.services.map_snapshot_service import MapSnapshotService
+from directory.services.nearby_service import NearbyIndex
+from directory.services.profile_service import ProfileService
+from directory.services.reference_data_service import ReferenceDataService
+from directory.services.search_index_service import CoopSearchIndex
+from directory.services.standin_service import StandinService
+from address.models import Address
+from directory.models import Coop, CoopType, GeocodeCacheEntry, GeocodeJob
+from directory.serializers import CoopSerializer
+from directory.signals import reindex_coops
 
 
 class ServiceTests(TestCase):
@@ -24,5 +51,760 @@ class ServiceTests(TestCase):
         assert coords[0] == test_lat, "Failed to return proper latitude."
         assert coords[1] == test_lon, "Failed to return proper longitude."
 
+    def test_geocoder_metrics(self):
+        """
+        Nominatim calls are counted by outcome and timed
+        """
+        def calls(outcome):
+            labels = {'service': 'nominatim', 'operation': 'search', 'outcome': outcome}
+            return REGISTRY.get_sample_value('directory_external_calls_total', labels) or 0
+
+        ok, errors = calls('ok'), calls('error')
+        svc = LocationService()
+        response = mock.Mock(**{'json.return_value': [{'lat': '41.88', 'lon': '-87.63'}]})
+        with mock.patch('directory.services.location_service.requests.get', return_value=response):
+            assert svc.get_coords("1 Nowhere St", "Chicago", "IL", "60601", "US") == [41.88, -87.63]
+        with mock.patch('directory.services.location_service.requests.get', side_effect=IOError("down")):
+            assert svc.get_coords("2 Nowhere St", "Chicago", "IL", "60601", "US") is None
+        assert calls('ok') == ok + 1
+        assert calls('error') == errors + 1
+
+    def test_writes_move_cluster_points(self):
+        """
+        Coop and address writes keep the clusters the same as a rebuild would make them
+        """
+        cluster_svc = ClusterService(max_zoom=3)
+        cluster_settings = self.settings(MAP_CLUSTER_MAX_ZOOM=3)
+        cluster_settings.enable()
+        self.addCleanup(cluster_settings.disable)
+
+        def assert_rebuilt(count):
+            clusters = cluster_svc.get_clusters(3)
+            assert sum(cluster['count'] for cluster in clusters) == count
+            cluster_svc.rebuild()
+            assert cluster_svc.get_clusters(3) == clusters
+
+        address = AddressFactory(latitude=41.88, longitude=-87.63)
+        other = AddressFactory(locality=address.locality, latitude=-33.87, longitude=151.21)
+        coop = CoopFactory(addresses=[address, other])
+        shared = CoopFactory(addresses=[other])
+        assert_rebuilt(2)
+        coop.enabled = False
+        coop.save()
+        # Still on the map through the other coop
+        assert_rebuilt(1)
+        coop.enabled = True
+        coop.save()
+        assert_rebuilt(2)
+        address.latitude = 40.71
+        address.save()
+        assert_rebuilt(2)
+        coop.addresses.remove(address)
+        assert_rebuilt(1)
+        address.coop_set.add(coop)
+        assert_rebuilt(2)
+        shared.delete()
+        assert_rebuilt(2)
+        coop.addresses.clear()
+        assert_rebuilt(0)
+        coop.addresses.add(address, other)
+        other.delete()
+        assert_rebuilt(1)
+        coop.delete()
+        assert_rebuilt(0)
+
+    def test_metrics_add_in_worker_dirs(self):
+        """
+        In multiprocess mode the metrics include the geocode worker's directory
+        """
+        from prometheus_client.mmap_dict import MmapedDict, mmap_key
+        from directory.metrics import render_metrics
+        web_dir, worker_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        for path, pid, value in ((web_dir, 10, 1), (worker_dir, 1, 2)):
+            values = MmapedDict(os.path.join(path, 'counter_%s.db' % pid))
+            labels = {'service': 'nominatim', 'operation': 'search', 'outcome': 'ok'}
+            values.write_value(mmap_key('directory_external_calls', 'directory_external_calls_total', labels, labels.values()), value)
+            values.close()
+        with mock.patch.dict(os.environ, {'prometheus_multiproc_dir': web_dir}), \
+                self.settings(METRICS_MULTIPROC_DIRS=[worker_dir]):
+            content, _ = render_metrics()
+        assert b'directory_external_calls_total{operation="search",outcome="ok",service="nominatim"} 3.0' in content
+
+    def test_save_coords_moves_cluster_point(self):
+        """
+        Geocoding an address moves its point in the precomputed clusters
+        """
+        address = AddressFactory(latitude=41.88, longitude=-87.63)
+        CoopFactory(addresses=[address])
+        cluster_svc = ClusterService(max_zoom=3)
+        assert cluster_svc.rebuild() == 1
+
+        svc = LocationService()
+        with self.settings(MAP_CLUSTER_MAX_ZOOM=3), \
+                mock.patch.object(LocationService, 'get_coords', return_value=[-33.87, 151.21]):
+            svc.save_coords(address)
+        clusters = cluster_svc.get_clusters(3)
+        assert len(clusters) == 1
+        assert clusters[0]['count'] == 1
+        assert clusters[0]['latitude'] == pytest.approx(-33.87)
+        # Only the new location is inside a viewport around Sydney
+        assert cluster_svc.get_clusters(3, (150, -35, 152, -33)) == clusters
+        assert cluster_svc.get_clusters(3, (-88, 41, -87, 42)) == []
+
+
+class MapSnapshotServiceTests(TransactionTestCase):
+
+    def setUp(self):
+        snapshot_settings = self.settings(MAP_SNAPSHOT_DIR=tempfile.mkdtemp(prefix='map_snapshots'))
+        snapshot_settings.enable()
+        self.addCleanup(snapshot_settings.disable)
+
+    def test_snapshot_rebuilt_on_change(self):
+        """
+        Saving a coop or one of its addresses rebuilds the snapshots for its types
+        """
+        coop_type = CoopTypeFactory(name="Bakery")
+        coop = CoopFactory(name="Bread Coop")
+        coop.types.add(coop_type)
+        svc = MapSnapshotService()
+        bakery = svc.get_filter(type="Bakery")
+        other = svc.get_filter(type="Housing")
+        svc.build(bakery)
+        svc.build(other)
+
+        coop.name = "Bread Coop Renamed"
+        coop.save()
+        assert svc.get_version(bakery) == 2
+        assert svc.get_version(other) == 1, "Rebuilt a snapshot the change can't affect."
+        path, etag = svc.get_snapshot(bakery)
+        with open(path) as f:
+            assert "Bread Coop Renamed" in f.read()
+
+        address = coop.addresses.first()
+        address.latitude = 41.88
+        address.save()
+        assert svc.get_version(bakery) == 3
+
+    def test_stale_snapshot_served(self):
+        """
+        A stale snapshot is served without touching the database until the
+        background rebuild replaces it
+        """
+        CoopFactory(name="Bread Coop")
+        svc = MapSnapshotService()
+        everything = svc.get_filter()
+        svc.build(everything)
+        with mock.patch.object(MapSnapshotService, 'schedule_rebuild') as schedule_rebuild:
+            svc.invalidate()
+            schedule_rebuild.assert_called_once_with([everything])
+            schedule_rebuild.reset_mock()
+            with RequestTimings().activate() as timings:
+                path, etag = svc.get_snapshot(everything)
+            assert timings.queries == 0
+            assert path.endswith('v1.csv')
+            schedule_rebuild.assert_not_called()
+
+            # The change's rebuild never happened; a reader schedules one
+            stale_path = os.path.join(os.path.dirname(path), 'stale')
+            then = os.path.getmtime(stale_path) - settings.MAP_SNAPSHOT_STALE_GRACE - 1
+            os.utime(stale_path, (then, then))
+            with RequestTimings().activate() as timings:
+                assert svc.get_snapshot(everything) == (path, etag)
+            assert timings.queries == 0
+            schedule_rebuild.assert_called_once_with([everything])
+
+    def test_snapshot_compression(self):
+        """
+        Builds a request waits on compress at the fast settings; the
+        background rebuilds use the slow, smaller ones
+        """
+        CoopFactory(name="Bread Coop")
+        svc = MapSnapshotService()
+        everything = svc.get_filter()
+        compress = CompressionService.compress
+        with mock.patch.object(CompressionService, 'compress', autospec=True, side_effect=compress) as mock_compress:
+            svc.get_snapshot(everything)
+            assert {call[1].get('static') for call in mock_compress.call_args_list} == {False}
+            mock_compress.reset_mock()
+            svc.invalidate()
+            assert svc.get_version(everything) == 2
+            assert {call[1].get('static') for call in mock_compress.call_args_list} == {True}
+
+    def test_snapshot_filters(self):
+        """
+        Only all coops and existing coop types get snapshots
+        """
+        CoopTypeFactory(name="Bakery")
+        svc = MapSnapshotService()
+        assert svc.get_filter(contains="bak") is None
+        assert svc.get_snapshot(svc.get_filter(type="No Such Type")) is None
+        assert svc.get_snapshot(svc.get_filter(type="Bakery")) is not None
+        assert svc.get_filters() == [('type', 'Bakery')]
+
+        # Leftover "contains" snapshots are cleaned up
+        legacy_dir = os.path.join(settings.MAP_SNAPSHOT_DIR, 'legacy')
+        os.makedirs(legacy_dir)
+        with open(os.path.join(legacy_dir, 'filter.json'), 'w') as f:
+            f.write('["contains", "bak"]')
+        assert svc.get_filters() == [('type', 'Bakery')]
+        assert not os.path.exists(legacy_dir)
+
+class CoopSearchIndexTests(TestCase):
+
+    def test_search_matches_database_contains(self):
+        """
+        The index finds the same coops as the database name search
+        """
+        address = AddressFactory()
+        grocery = CoopFactory(name="Sunrise Grocery", addresses=[address])
+        CoopFactory(name="Sunset Housing", addresses=[address])
+        CoopFactory(name="Hidden Grocery", enabled=False, addresses=[address])
+        index = CoopSearchIndex(fields=('name',), check_interval=60)
+        for query in ["grocery", "SUN", "rise gro", "s", "bakery"]:
+            expected = sorted(Coop.objects.find(partial_name=query, enabled=True).values_list('id', flat=True))
+            assert index.search(query) == expected, query
+        assert index.search("sunrise") == [grocery.id]
+
+    def test_index_follows_writes(self):
+        """
+        The writing process re-indexes in place; another process rebuilds
+        once it sees the new version
+        """
+        address = AddressFactory(raw="1 Main St")
+        coop = CoopFactory(name="Old Name", addresses=[address])
+        index = CoopSearchIndex(fields=('name', 'address'), check_interval=60)
+        other_process = CoopSearchIndex(fields=('name', 'address'), check_interval=0)
+        assert index.search("main st") == [coop.id]
+        assert other_process.search("old name") == [coop.id]
+
+        coop.name = "New Name"
+        coop.save()
+        index.record_change([coop.id])
+        assert index.search("old name") == []
+        assert index.search("new name") == [coop.id]
+        assert other_process.search("new name") == [coop.id]
+
+    def test_writes_skip_disabled_index(self):
+        """ Writes only bump the nearby index's version while it's enabled """
+        with mock.patch('directory.signals.transaction.on_commit') as on_commit:
+            with self.settings(NEARBY_INDEX_ENABLED=False, COOP_SEARCH_INDEX_ENABLED=False):
+                reindex_coops([1])
+            on_commit.assert_not_called()
+            with self.settings(NEARBY_INDEX_ENABLED=True, COOP_SEARCH_INDEX_ENABLED=False):
+                reindex_coops([1])
+            on_commit.assert_called_once()
+
+
+class NearbyIndexTests(TestCase):
+
+    def create_coop(self, name, *coords, types=(), enabled=True):
+        addresses = [
+            AddressFactory(locality=self.address.locality, latitude=lat, longitude=lon)
+            for lat, lon in coords
+        ]
+        coop = CoopFactory(name=name, enabled=enabled, addresses=addresses)
+        coop.types.add(*types)
+        return coop
+
+    def setUp(self):
+        self.address = AddressFactory()
+        self.grocery = CoopTypeFactory(name="Grocery")
+
+    def test_search(self):
+        """
+        Finds the coops within the radius, nearest first, each at its
+        nearest address
+        """
+        # 0.01 degrees of latitude is about 1.1 km
+        near = self.create_coop("Near", (41.90, -87.65), (41.81, -87.65), types=[self.grocery])
+        nearer = self.create_coop("Nearer", (41.805, -87.65))
+        far = self.create_coop("Far", (42.5, -87.65), types=[self.grocery])
+        self.create_coop("Hidden", (41.80, -87.65), enabled=False)
+        index = NearbyIndex(grid_degrees=0.1, check_interval=60)
+
+        results = index.search(41.80, -87.65, 20, 10)
+        assert [coop_id for coop_id, _ in results] == [nearer.id, near.id]
+        assert abs(results[1][1] - 1.112) < 0.01
+        assert [coop_id for coop_id, _ in index.search(41.80, -87.65, 100, 10)] == [nearer.id, near.id, far.id]
+        assert [coop_id for coop_id, _ in index.search(41.80, -87.65, 100, 1)] == [nearer.id]
+        assert [coop_id for coop_id, _ in index.search(41.80, -87.65, 100, 10, "Grocery")] == [near.id, far.id]
+        assert index.search(41.80, -87.65, 100, 10, "No Such Type") == []
+
+    def test_search_across_antimeridian(self):
+        """
+        The search circle wraps around longitude 180
+        """
+        fiji = self.create_coop("Fiji", (-17.8, 179.9))
+        samoa = self.create_coop("Samoa", (-17.8, -179.9))
+        index = NearbyIndex(grid_degrees=0.5, check_interval=60)
+        assert sorted(coop_id for coop_id, _ in index.search(-17.8, 179.99, 50, 10)) == sorted([fiji.id, samoa.id])
+
+    def test_index_follows_writes(self):
+        """
+        The writing process replaces the changed coop's points; another
+        process rebuilds once it sees the new version
+        """
+        coop = self.create_coop("Moving", (41.80, -87.65))
+        index = NearbyIndex(grid_degrees=0.1, check_interval=60)
+        other_process = NearbyIndex(grid_degrees=0.1, check_interval=0)
+        assert index.search(41.80, -87.65, 5, 10)[0][0] == coop.id
+        assert other_process.search(41.80, -87.65, 5, 10)[0][0] == coop.id
+
+        address = coop.addresses.first()
+        address.latitude = 45.0
+        address.save()
+        index.record_change([coop.id])
+        assert len(index._points.delta['coop_ids']) == 1
+        assert index.search(41.80, -87.65, 5, 10) == []
+        assert index.search(45.0, -87.65, 5, 10)[0][0] == coop.id
+        assert other_process.search(45.0, -87.65, 5, 10)[0][0] == coop.id
+
+        # Past the merge threshold the delta is folded back into the grid
+        index._merge_threshold = 0
+        index.record_change([coop.id])
+        assert len(index._points.delta['coop_ids']) == 0
+        assert index.search(45.0, -87.65, 5, 10)[0][0] == coop.id
+
+
+class ReferenceDataServiceTests(TransactionTestCase):
+
+    def test_invalidated_on_write(self):
+        """
+        Adding a coop type drops the cached reference data
+        """
+        svc = ReferenceDataService()
+        get_names = lambda: sorted(CoopType.objects.values_list('name', flat=True))
+        CoopTypeFactory(name="Grocery")
+        assert svc.get('coop_types', get_names)['content'] == b'["Grocery"]'
+        CoopTypeFactory(name="Bakery")
+        assert svc.get('coop_types', get_names)['content'] == b'["Bakery","Grocery"]'
+
+
+class CompressionServiceTests(TestCase):
+
+    def test_negotiate(self):
+        """
+        Picks the client's highest weighted encoding, brotli on a tie
+        """
+        svc = CompressionService()
+        assert svc.negotiate("") is None
+        assert svc.negotiate("identity") is None
+        assert svc.negotiate("gzip, deflate, br") == 'br'
+        assert svc.negotiate("br;q=0.5, gzip") == 'gzip'
+        assert svc.negotiate("gzip;q=0, *") == 'br'
+        assert svc.negotiate("br;q=0, *;q=0.1") == 'gzip'
+        with self.settings(RESPONSE_COMPRESSION_ENABLED=False):
+            assert svc.negotiate("gzip, br") is None
+
+
+class ProfileServiceTests(TestCase):
+
+    def profile(self, svc, view_name):
+        profiler = svc.start()
+        sorted(range(1000), key=lambda i: -i)
+        return svc.save(profiler, view_name)
+
+    def test_dump_directory_is_bounded(self):
+        """ Test the oldest dumps are deleted once the directory is over its size limit """
+        profile_dir = tempfile.mkdtemp(prefix='profiles')
+        svc = ProfileService(profile_dir, max_bytes=10 ** 9)
+        first = self.profile(svc, 'coops_nearby')
+        assert first.startswith('coops_nearby-') and first.endswith('.prof')
+        size = os.path.getsize(svc.get_paths()[0])
+
+        svc = ProfileService(profile_dir, max_bytes=size * 2.5)
+        for _ in range(3):
+            self.profile(svc, 'directory.views.CoopList')
+        names = [os.path.basename(path) for path in svc.get_paths()]
+        assert first not in names
+        assert len(names) == 2
+
+    def test_summarize(self):
+        """ Test the summary lists the hot functions across dumps """
+        svc = ProfileService(tempfile.mkdtemp(prefix='profiles'))
+        self.profile(svc, 'data')
+        self.profile(svc, 'coops_nearby')
+        assert len(svc.get_paths('coops_nearby')) == 1
+        report = svc.summarize(svc.get_paths(), sort='tottime', limit=5)
+        assert 'sorted' in report
+
+
+class StandinServiceTests(TestCase):
+
+    def setUp(self):
+        self.standins = StandinService().start()
+        self.addCleanup(self.standins.stop)
+
+    def test_geocoder_standin(self):
+        """ Test LocationService geocodes through the Nominatim stand-in """
+        svc = LocationService()
+        with self.settings(NOMINATIM_URL=self.standins.url):
+            coords = svc.get_coords("1 Main St", "Chicago", "IL", "60601", "US")
+            assert svc.get_coords("1 Main St", "Chicago", "IL", "60601", "US") == coords
+            assert svc.get_coords("Nowhere Rd", "Chicago", "IL", "60601", "US") is None
+        assert 41.6 <= coords[0] <= 42.1 and -88.0 <= coords[1] <= -87.5
+
+    def test_google_sheets_standin(self):
+        """ Test GoogleSheetService appends to and downloads from the stand-in """
+        with self.settings(GOOGLE_SHEETS_STANDIN_URL=self.standins.url + "/sheets"):
+            svc = GoogleSheetService()
+            svc.append_to_sheet('ChiCommons Directory', 4, ["Test Coop", "123 Fake Rd"])
+            assert svc.download_sheet_as_csv('ChiCommons Directory', 4) == '"Test Coop","123 Fake Rd"'
+        assert self.standins.sheets == {('ChiCommons Directory', '4'): [["Test Coop", "123 Fake Rd"]]}
+
+
+class LoadTestServiceTests(TestCase):
+
+    def test_summarize(self):
+        """ Test the load test report's throughput, percentiles and error rate """
+        results = {
+            'detail': [(i / 1000.0, True) for i in range(1, 101)],
+            'post': [(0.5, False), (0.5, True)],
+        }
+        overall, by_kind = LoadTestService.summarize(2.0, results)
+        assert overall['requests'] == 102
+        assert overall['rps'] == 51
+        assert by_kind['detail']['p50'] == pytest.approx(50)
+        assert by_kind['detail']['p99'] == pytest.approx(99)
+        assert by_kind['post']['error_rate'] == 0.5
+        assert percentile([], 0.5) is None
+
+    def test_parse_mix(self):
+        """ Test request weights are parsed and unknown kinds rejected """
+        assert LoadTestService.parse_mix("data=1,detail=2.5") == {'data': 1.0, 'detail': 2.5}
+        with pytest.raises(ValueError):
+            LoadTestService.parse_mix("nope=1")
+
+
+class FakeGeocoder(object):
+    """
+    Stands in for Nominatim: finds every address but those containing
+    "nowhere", after failing the first "errors" calls.
+    """
+
+    def __init__(self, errors=0):
+        self.errors = errors
+        self.calls = []
+
+    def __call__(self, address_str):
+        self.calls.append(address_str)
+        if self.errors:
+            self.errors -= 1
+            raise IOError("Nominatim unavailable")
+        if 'nowhere' in address_str.lower():
+            return []
+        return [{'lat': '41.88', 'lon': '-87.63'}]
+
+
+class GeocodeQueueServiceTests(TestCase):
+
+    def setUp(self):
+        self.locality = LocalityFactory()
+
+    def create_address(self, raw="1 Main St"):
+        return AddressFactory(locality=self.locality, raw=raw, formatted=raw, latitude=None, longitude=None)
+
+    def get_service(self, geocoder):
+        return GeocodeQueueService(LocationService(geocoder=geocoder), RateLimiter(0))
+
+    def test_writes_enqueue_geocoding(self):
+        """ Test saving a coop queues its addresses instead of calling Nominatim """
+        state = self.locality.state
+        serializer = CoopSerializer(data={
+            "name": "Queued Coop",
+            "types": [{"name": "Grocery"}],
+            "addresses": [{
+                "raw": "222 W. Merchandise Mart Plaza",
+                "formatted": "222 W. Merchandise Mart Plaza",
+                "locality": {
+                    "name": "Chicago",
+                    "postal_code": "60654",
+                    "state": {
+                        "id": state.id, "name": state.name, "code": state.code,
+                        "country": {"id": state.country.id, "name": state.country.name}
+                    }
+                }
+            }],
+            "enabled": True,
+            "phone": {"phone": "7732441468"},
+            "email": {"email": "test@example.com"},
+            "web_site": "http://www.example.com"
+        })
+        assert serializer.is_valid(), serializer.errors
+        with mock.patch.object(LocationService, 'search_nominatim', side_effect=AssertionError("geocoded inline")):
+            coop = serializer.save()
+        address = coop.addresses.get()
+        assert address.latitude is None
+        assert address.geocode_job.status == GeocodeJob.Statuses.PENDING
+
+    def test_worker_geocodes_jobs(self):
+        """ Test the worker geocodes due jobs and finishes unknown addresses too """
+        found = self.create_address()
+        missing = self.create_address("Nowhere Rd")
+        GeocodeJob.objects.enqueue(found)
+        GeocodeJob.objects.enqueue(missing)
+        geocoder = FakeGeocoder()
+        assert self.get_service(geocoder).run_batch() == 2
+        found.refresh_from_db()
+        assert [found.latitude, found.longitude] == [41.88, -87.63]
+        statuses = GeocodeJob.objects.values_list('status', flat=True)
+        assert list(statuses) == [GeocodeJob.Statuses.DONE] * 2
+        assert self.get_service(geocoder).run_batch() == 0
+        assert len(geocoder.calls) == 2
+
+    def test_worker_retries_with_backoff(self):
+        """ Test failed calls are retried later, then given up on """
+        address = self.create_address()
+        GeocodeJob.objects.enqueue(address)
+        svc = self.get_service(FakeGeocoder(errors=1))
+        with self.settings(GEOCODE_RETRY_BACKOFF=30):
+            assert svc.run_batch() == 1
+        job = GeocodeJob.objects.get()
+        assert job.status == GeocodeJob.Statuses.PENDING
+        assert job.attempts == 1 and "unavailable" in job.last_error
+        assert job.run_after > timezone.now() + timedelta(seconds=25)
+        # Not due yet
+        assert svc.run_batch() == 0
+
+        GeocodeJob.objects.update(run_after=timezone.now())
+        assert svc.run_batch() == 1
+        assert GeocodeJob.objects.get().status == GeocodeJob.Statuses.DONE
+
+        GeocodeJob.objects.enqueue(address)
+        with self.settings(GEOCODE_MAX_ATTEMPTS=2, GEOCODE_RETRY_BACKOFF=0, GEOCODE_CACHE_ENABLED=False):
+            svc = self.get_service(FakeGeocoder(errors=10))
+            svc.run_batch()
+            svc.run_batch()
+        job = GeocodeJob.objects.get()
+        assert job.status == GeocodeJob.Statuses.FAILED
+        assert job.attempts == 2
+
+    def test_batch_fits_lease(self):
+        """ Test a worker claims no more jobs than it can finish within their lease """
+        for raw in ("1 Main St", "2 Main St", "3 Main St"):
+            GeocodeJob.objects.enqueue(self.create_address(raw))
+        svc = GeocodeQueueService(LocationService(geocoder=FakeGeocoder()), RateLimiter(0.5, sleep=lambda seconds: None))
+        with self.settings(GEOCODE_JOB_LEASE=4, GEOCODE_BATCH_SIZE=50):
+            assert svc.get_batch_size() == 1
+            assert svc.run_batch() == 1
+        with self.settings(GEOCODE_JOB_LEASE=300, GEOCODE_BATCH_SIZE=50):
+            assert svc.get_batch_size() == 50
+            assert svc.get_batch_size(10) == 10
+        assert self.get_service(FakeGeocoder()).get_batch_size(500) == 500
+
+    def test_claim_locks_only_jobs(self):
+        """ Test the claim query locks only the job rows, which Postgres allows with the outer joins """
+        from django.db.backends.postgresql.base import DatabaseWrapper
+        connection = DatabaseWrapper({**settings.DATABASES['default'], 'ENGINE': 'django.db.backends.postgresql', 'NAME': 'x'})
+        query = GeocodeJob.objects.get_due(timezone.now())[:10].query
+        with mock.patch.object(connection, 'get_autocommit', return_value=False):
+            sql, _ = query.get_compiler(connection=connection).as_sql()
+        assert 'LEFT OUTER JOIN "address_locality"' in sql
+        assert sql.endswith('FOR UPDATE OF "directory_geocodejob" SKIP LOCKED')
+
+    def test_rate_limiter(self):
+        """ Test calls are spaced out to the rate """
+        now = [100.0]
+        sleeps = []
+        limiter = RateLimiter(2, clock=lambda: now[0], sleep=sleeps.append)
+        for _ in range(3):
+            limiter.wait()
+        assert sleeps == [0.5, 1.0]
+
+    def test_run_geocode_worker_command(self):
+        """ Test the worker command drains the queue against a local geocoder """
+        standins = StandinService().start()
+        self.addCleanup(standins.stop)
+        GeocodeJob.objects.enqueue(self.create_address())
+        out = io.StringIO()
+        with self.settings(NOMINATIM_URL=standins.url, GEOCODE_RATE_LIMIT=0):
+            call_command('run_geocode_worker', '--once', stdout=out)
+        assert "Processed 1 geocode jobs." in out.getvalue()
+        assert GeocodeJob.objects.get().address.latitude is not None
+
+
+class GeocodeCacheTests(TestCase):
+
+    def test_normalize_address(self):
+        """ Test spellings of the same address share a cache key """
+        key = LocationService.normalize_address("1 North Main Street, Suite 2", "Chicago", "IL", "60601-1234", "United States")
+        assert key == "1 n main st ste 2|chicago|il|60601|us"
+        assert LocationService.normalize_address("  1 N. MAIN  st ste. 2", "chicago", "il", "60601", "US") == key
+        assert LocationService.normalize_address("1 N Main St", "Chicago", "IL", "60601", "US") != key
+
+    def test_cache_hits(self):
+        """ Test a cached address isn't geocoded again, and hits are recorded """
+        geocoder = FakeGeocoder()
+        svc = LocationService(geocoder=geocoder)
+        coords = svc.get_coords("1 North Main Street", "Chicago", "IL", "60601", "US")
+        assert coords == [41.88, -87.63]
+        assert svc.get_coords("1 n. main st", "CHICAGO", "IL", "60601-0001", "United States") == coords
+        assert len(geocoder.calls) == 1
+        entry = GeocodeCacheEntry.objects.get()
+        assert entry.hits == 1 and entry.lookups == 1 and entry.last_hit is not None
+
+    def test_not_found_cached(self):
+        """ Test "not found" is cached, for a shorter time, and errors aren't cached """
+        geocoder = FakeGeocoder(errors=1)
+        svc = LocationService(geocoder=geocoder)
+        with self.settings(GEOCODE_CACHE_TTL=1000, GEOCODE_CACHE_NOT_FOUND_TTL=10):
+            assert svc.get_coords("Nowhere Rd", "Chicago", "IL", "60601", "US") is None
+            assert not GeocodeCacheEntry.objects.exists()
+            assert svc.get_coords("Nowhere Rd", "Chicago", "IL", "60601", "US") is None
+            assert svc.get_coords("Nowhere Rd", "Chicago", "IL", "60601", "US") is None
+        assert len(geocoder.calls) == 2
+        entry = GeocodeCacheEntry.objects.get()
+        assert entry.coords is None and entry.hits == 1
+        assert entry.expires < timezone.now() + timedelta(seconds=11)
+
+    def test_cache_expires(self):
+        """ Test an expired entry is looked up again and refreshed """
+        geocoder = FakeGeocoder()
+        svc = LocationService(geocoder=geocoder)
+        svc.get_coords("1 Main St", "Chicago", "IL", "60601", "US")
+        GeocodeCacheEntry.objects.update(expires=timezone.now())
+        svc.get_coords("1 Main St", "Chicago", "IL", "60601", "US")
+        assert len(geocoder.calls) == 2
+        entry = GeocodeCacheEntry.objects.get()
+        assert entry.lookups == 2 and entry.expires > timezone.now()
+
+    def test_save_coords_uses_cache(self):
+        """ Test saving coordinates reuses an address cached under another locality """
+        address = AddressFactory(raw="1 Main St", formatted="1 Main St", latitude=None, longitude=None)
+        locality = address.locality
+        key = LocationService.normalize_address(
+            "1 Main Street", locality.name, locality.state.code, locality.postal_code, locality.state.country.name
+        )
+        GeocodeCacheEntry.objects.store(key, [41.5, -87.5], 60)
+        svc = LocationService(geocoder=FakeGeocoder(errors=1))
+        assert svc.save_coords(address, raise_errors=True) == [41.5, -87.5]
+        address.refresh_from_db()
+        assert [address.latitude, address.longitude] == [41.5, -87.5]
+
+    def test_parse_coop_csv_uses_cache(self):
+        """ Test the CSV import geocodes rows without coordinates through the cache """
+        parse_coop_csv = pytest.importorskip("directory.management.commands.parse_coop_csv")
+        csv_path = os.path.join(tempfile.mkdtemp(), "coops.csv")
+        with open(csv_path, "w") as f:
+            f.write("ID,ent-name,ent-adrs,ent-adrs-pub,ent-city,ent-zip,ent-st,lat,lon\n")
+            f.write("1,Coop One,1 Main Street,yes,Chicago,60601,IL,,\n")
+            f.write("2,Coop Two,1 main st,yes,chicago,60601,IL,,\n")
+        key = LocationService.normalize_address("1 Main St", "Chicago", "IL", "60601", "US")
+        GeocodeCacheEntry.objects.store(key, [41.5, -87.5], 60)
+        geocode = mock.patch.object(LocationService, 'search_nominatim', side_effect=AssertionError("not cached"))
+        out = io.StringIO()
+        with geocode, mock.patch('sys.stdout', out):
+            address_pks = parse_coop_csv.Command.get_address_pks(csv_path, {("Chicago", "60601", "Il"): 1})
+        assert address_pks == {'1': 1, '2': 2}
+        assert out.getvalue().count("latitude: 41.5") == 2
+        assert GeocodeCacheEntry.objects.get().hits == 2
+
+
+class GeocodeBackfillServiceTests(TestCase):
+
+    def setUp(self):
+        self.locality = LocalityFactory()
+        self.checkpoint_path = os.path.join(tempfile.mkdtemp(), "geocode_missing.checkpoint")
+        self.geocoder = FakeGeocoder()
+
+    def create_addresses(self, *raws):
+        return [
+            AddressFactory(locality=self.locality, raw=raw, formatted=raw, latitude=None, longitude=None)
+            for raw in raws
+        ]
+
+    def search(self, address_str):
+        if "broken" in address_str.lower():
+            raise IOError("Nominatim unavailable")
+        return self.geocoder(address_str)
+
+    def get_service(self, chunk_size=2):
+        return GeocodeBackfillService(
+            LocationService(geocoder=self.search),
+            workers=3,
+            rate=0,
+            chunk_size=chunk_size,
+            checkpoint_path=self.checkpoint_path
+        )
+
+    def test_backfill(self):
+        """ Test addresses without coordinates are geocoded in chunks and saved """
+        done = AddressFactory(locality=self.locality, raw="9 Done St", latitude=41.0, longitude=-87.0)
+        addresses = self.create_addresses("1 Main Street", "1 main st.", "2 Main St", "Nowhere Rd", "3 Broken St")
+        progress = []
+        stats = self.get_service().run(progress=lambda stats: progress.append(dict(stats)))
+        assert [stats[name] for name in GeocodeBackfillService.STATS] == [5, 3, 1, 1, 0]
+        assert stats['complete'] and stats['rate'] > 0
+        assert [p['processed'] for p in progress] == [2, 4, 5]
+        # The two spellings of 1 Main Street are looked up once
+        assert len(self.geocoder.calls) == 3
+        coords = [[a.latitude, a.longitude] for a in Address.objects.filter(id__in=[a.id for a in addresses]).order_by('id')]
+        assert coords == [[41.88, -87.63]] * 3 + [[None, None]] * 2
+        done.refresh_from_db()
+        assert [done.latitude, done.longitude] == [41.0, -87.0]
+        assert not os.path.exists(self.checkpoint_path)
+
+        # Another run retries what's left, using the cached "not found"
+        stats = self.get_service().run()
+        assert [stats[name] for name in GeocodeBackfillService.STATS] == [2, 0, 1, 1, 1]
+        assert len(self.geocoder.calls) == 3
+
+    def test_backfill_closes_geocode_jobs(self):
+        """ Test the backfill marks the addresses' queued geocode jobs done """
+        found, missing, broken = self.create_addresses("1 Main St", "Nowhere Rd", "3 Broken St")
+        for address in (found, missing, broken):
+            GeocodeJob.objects.enqueue(address)
+        self.get_service().run()
+        statuses = dict(GeocodeJob.objects.values_list('address_id', 'status'))
+        assert statuses == {
+            found.id: GeocodeJob.Statuses.DONE,
+            missing.id: GeocodeJob.Statuses.DONE,
+            broken.id: GeocodeJob.Statuses.PENDING,
+        }
+
+    def test_resume(self):
+        """ Test a stopped backfill resumes after the last saved chunk """
+        addresses = self.create_addresses("1 Main St", "2 Main St", "3 Main St", "4 Main St")
+        stats = self.get_service().run(limit=3)
+        assert stats['processed'] == 3 and not stats['complete']
+        with open(self.checkpoint_path) as f:
+            assert json.load(f)['last_id'] == addresses[2].id
+
+        stats = self.get_service().run()
+        assert stats['processed'] == 4 and stats['complete']
+        assert len(self.geocoder.calls) == 4
+        assert not os.path.exists(self.checkpoint_path)
+
+        # Restarting goes back past the checkpoint
+        Address.objects.update(latitude=None, longitude=None)
+        self.get_service().run(limit=1)
+        Address.objects.update(latitude=None, longitude=None)
+        stats = self.get_service().run(restart=True)
+        assert stats['processed'] == 4 and stats['cached'] == 4
 
+    def test_backfill_moves_cluster_points(self):
+        """ Test backfilled addresses of enabled coops are added to the clusters """
+        address, = self.create_addresses("1 Main St")
+        CoopFactory(addresses=[address])
+        cluster_svc = ClusterService(max_zoom=3)
+        assert cluster_svc.rebuild() == 0
+        with self.settings(MAP_CLUSTER_MAX_ZOOM=3):
+            self.get_service().run()
+        clusters = cluster_svc.get_clusters(3)
+        assert len(clusters) == 1 and clusters[0]['count'] == 1
+        assert clusters[0]['latitude'] == pytest.approx(41.88)
 
+    def test_geocode_missing_command(self):
+        """ Test the command backfills against a local geocoder and reports throughput """
+        standins = StandinService().start()
+        self.addCleanup(standins.stop)
+        addresses = self.create_addresses("1 Main St", "Nowhere Rd")
+        out = io.StringIO()
+        with self.settings(NOMINATIM_URL=standins.url):
+            call_command(
+                'geocode_missing', '--rate', '0', '--workers', '2', '--checkpoint', self.checkpoint_path, stdout=out
+            )
+        assert "2 addresses through id %d: 1 found, 1 not found" % addresses[1].id in out.getvalue()
+        assert "addresses/s" in out.getvalue() and "Done." in out.getvalue()
+        addresses[0].refresh_from_db()
+        assert 41.6 <= addresses[0].latitude <= 42.1
@@ -0,0 +1,376 @@
+import brotli
+import csv
+import gzip
+import io
+import json
+import os
+import pytest
+import tempfile
+from unittest import mock
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db.models.functions import Lower
+from django.test import TestCase
+from rest_framework.test import APIClient
+from .factories import CoopTypeFactory, CoopFactory, AddressFactory, LocalityFactory, PersonFactory
+from directory.models import Coop
+from directory.services.cluster_service import ClusterService
+from directory.services.nearby_service import NearbyIndex
+from directory.views import CoopList
+
+
+class ViewTests(TestCase):
+
+    def setUp(self):
+        # Give each test its own (empty) set of map snapshots
+        snapshot_settings = self.settings(MAP_SNAPSHOT_DIR=tempfile.mkdtemp(prefix='map_snapshots'))
+        snapshot_settings.enable()
+        self.addCleanup(snapshot_settings.disable)
+        caches[settings.REFERENCE_DATA_CACHE].clear()
+        self.client = APIClient()
+        self.locality = LocalityFactory()
+        self.coop_type = CoopTypeFactory(name="Grocery")
+
+    def create_coops(self, count):
+        """
+        Create "count" coops that share a locality (country names are unique
+        so each coop can't get its own state/country chain).
+        """
+        coops = []
+        for i in range(count):
+            address = AddressFactory(locality=self.locality)
+            coop = CoopFactory(name="Search Coop %s" % i, addresses=[address])
+            coop.types.add(self.coop_type)
+            coops.append(coop)
+        return coops
+
+    @pytest.mark.django_db
+    def test_coop_search_query_count(self):
+        """ Search query count must not grow with the number of coops returned """
+        self.create_coops(1)
+        with self.assertNumQueries(2):
+            response = self.client.get("/coops/", {"contains": "Search Coop"})
+        assert len(response.data['results']) == 1
+
+        self.create_coops(5)
+        with self.assertNumQueries(2):
+            response = self.client.get("/coops/", {"contains": "Search Coop"})
+        assert len(response.data['results']) == 6
+        locality = response.data['results'][0]['addresses'][0]['locality']
+        assert locality['state']['country']['code'] == self.locality.state.country.code
+
+    @pytest.mark.django_db
+    def test_coop_detail_query_count(self):
+        """ Coop detail reads types and addresses from the prefetch caches """
+        coop = self.create_coops(1)[0]
+        with self.assertNumQueries(3):
+            response = self.client.get("/coops/%s/" % coop.id)
+        assert response.data['name'] == coop.name
+        assert response.data['types'][0]['name'] == self.coop_type.name
+
+    @pytest.mark.django_db
+    def test_person_list_query_count(self):
+        """ People nest full coop output; query count must stay fixed """
+        coops = self.create_coops(3)
+        for coop in coops:
+            PersonFactory(coops=0).coops.set(coops)
+        with self.assertNumQueries(5):
+            response = self.client.get("/people/", {"paginate": "false"})
+        assert len(response.data) == 3
+        assert len(response.data[0]['coops']) == 3
+
+    @pytest.mark.django_db
+    def test_data_csv_matches_unstreamed_output(self):
+        """ Streamed /data CSV is byte-identical to writing each coop's addresses in turn """
+        coops = self.create_coops(3)
+        coops[0].types.add(CoopTypeFactory(name="Housing"))
+        coops[1].addresses.add(AddressFactory(locality=self.locality, route="Ave", street_number="9"))
+        coops[2].addresses.add(AddressFactory(locality=self.locality, latitude=None, longitude=None))
+
+        expected = io.StringIO()
+        writer = csv.writer(expected, quoting=csv.QUOTE_ALL)
+        writer.writerow(['name','address','city','postal code','type','website','lon','lat'])
+        for coop in Coop.objects.get_by_type(self.coop_type.name).order_by(Lower('name')):
+            for address in coop.addresses.all():
+                postal_code = address.locality.postal_code
+                city = address.locality.name + ", " + address.locality.state.code + " " + postal_code
+                coop_types = ', '.join([type.name for type in coop.types.all()])
+                if address.longitude and address.latitude:
+                    writer.writerow([coop.name, address.formatted, city, postal_code, coop_types, coop.web_site, address.longitude, address.latitude])
+
+        response = self.client.get("/data", {"type": self.coop_type.name})
+        assert response.streaming
+        content = b"".join(response.streaming_content).decode("utf-8")
+        assert content == expected.getvalue()
+        assert "Grocery, Housing" in content
+
+    @pytest.mark.django_db
+    def test_data_snapshot_etag(self):
+        """ A repeat /data request with the snapshot's ETag gets a 304 """
+        self.create_coops(2)
+        response = self.client.get("/data", {"type": self.coop_type.name})
+        etag = response['ETag']
+        assert response.status_code == 200
+        with self.assertNumQueries(0):
+            response = self.client.get("/data", {"type": self.coop_type.name}, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+    @pytest.mark.django_db
+    def test_data_contains_streamed(self):
+        """ "contains" searches of /data are streamed, not snapshotted """
+        self.create_coops(2)
+        response = self.client.get("/data", {"contains": self.coop_type.name[:3]})
+        assert response.streaming and not response.has_header('ETag')
+        assert "Search Coop 1" in b"".join(response.streaming_content).decode("utf-8")
+        assert os.listdir(settings.MAP_SNAPSHOT_DIR) == []
+
+    @pytest.mark.django_db
+    def test_data_json(self):
+        """ The JSON variant of /data carries the same rows as the CSV """
+        self.create_coops(2)
+        response = self.client.get("/data.json", {"type": self.coop_type.name})
+        rows = json.loads(b"".join(response.streaming_content))
+        assert [row['name'] for row in rows] == ["Search Coop 0", "Search Coop 1"]
+        assert rows[0]['type'] == self.coop_type.name
+        assert rows[0]['lat'] is not None and rows[0]['lon'] is not None
+
+    @pytest.mark.django_db
+    def test_coops_geojson_bbox(self):
+        """ Only addresses inside the bounding box come back as features """
+        inside = self.create_coops(1)[0]
+        outside = CoopFactory(
+            name="Far Coop",
+            addresses=[AddressFactory(locality=self.locality, latitude=10.0, longitude=10.0)]
+        )
+        outside.types.add(self.coop_type)
+        lat, lon = AddressFactory.latitude, AddressFactory.longitude
+        bbox = "%s,%s,%s,%s" % (lon - 1, lat - 1, lon + 1, lat + 1)
+        response = self.client.get("/coops.geojson", {"bbox": bbox, "type": self.coop_type.name})
+        collection = json.loads(b"".join(response.streaming_content))
+        assert collection['type'] == "FeatureCollection"
+        assert [f['properties']['id'] for f in collection['features']] == [inside.id]
+        assert collection['features'][0]['geometry']['coordinates'] == [lon, lat]
+
+        response = self.client.get("/coops.geojson", {"bbox": "1,2,3"})
+        assert response.status_code == 400
+
+    @pytest.mark.django_db
+    def test_coops_clusters(self):
+        """ Clusters collapse nearby coops into one marker with a count """
+        self.create_coops(3)
+        ClusterService().rebuild()
+        response = self.client.get("/coops/clusters", {"zoom": 2})
+        assert [cluster['count'] for cluster in response.data] == [3]
+
+        response = self.client.get("/coops/clusters.json", {"zoom": 2})
+        assert [cluster['count'] for cluster in response.data] == [3]
+
+        response = self.client.get("/coops/clusters", {"zoom": "x"})
+        assert response.status_code == 400
+
+    @pytest.mark.django_db
+    def test_coop_list_keyset_pagination(self):
+        """ Following "next" links walks every coop once, in lower(name), id order """
+        self.create_coops(3)
+        CoopFactory(name="search coop 1", addresses=[AddressFactory(locality=self.locality)])
+        names = []
+        params = {"contains": "search coop", "limit": 2}
+        url = "/coops/"
+        while url:
+            response = self.client.get(url, params)
+            assert len(response.data['results']) <= 2
+            names += [coop['name'] for coop in response.data['results']]
+            url, params = response.data['next'], None
+        assert names == ["Search Coop 0", "Search Coop 1", "search coop 1", "Search Coop 2"]
+
+        response = self.client.get("/coops/", {"contains": "search coop", "paginate": "false"})
+        assert len(response.data) == 4
+
+        response = self.client.get("/coops/", {"cursor": "not a cursor"})
+        assert response.status_code == 404
+
+    @pytest.mark.django_db
+    def test_reference_data_cached(self):
+        """ Warm reference-data requests cost no queries and honor If-None-Match """
+        response = self.client.get("/states/%s/" % self.locality.state.country.code)
+        states = json.loads(response.content)
+        assert states[0]['country']['code'] == self.locality.state.country.code
+        with self.assertNumQueries(0):
+            response = self.client.get("/states/%s/" % self.locality.state.country.code)
+        assert json.loads(response.content) == states
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/states/%s/" % self.locality.state.country.code,
+                HTTP_IF_NONE_MATCH=response['ETag']
+            )
+        assert response.status_code == 304
+
+    @pytest.mark.django_db
+    def test_data_precompressed(self):
+        """ /data is served from the precompressed snapshot the client accepts """
+        self.create_coops(20)
+        response = self.client.get("/data", {"type": self.coop_type.name})
+        raw = b"".join(response.streaming_content)
+        assert not response.has_header('Content-Encoding')
+        assert 'Accept-Encoding' in response['Vary']
+
+        response = self.client.get("/data", {"type": self.coop_type.name}, HTTP_ACCEPT_ENCODING="gzip, deflate, br")
+        assert response['Content-Encoding'] == 'br'
+        assert brotli.decompress(b"".join(response.streaming_content)) == raw
+
+        response = self.client.get("/data", {"type": self.coop_type.name}, HTTP_ACCEPT_ENCODING="gzip")
+        assert response['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(b"".join(response.streaming_content)) == raw
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/data", {"type": self.coop_type.name},
+                HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=response['ETag']
+            )
+        assert response.status_code == 304
+
+    @pytest.mark.django_db
+    def test_coop_list_compressed(self):
+        """ API responses are compressed per request when the client accepts it """
+        self.create_coops(5)
+        raw = self.client.get("/coops/", {"contains": "Search Coop"}).content
+        response = self.client.get("/coops/", {"contains": "Search Coop"}, HTTP_ACCEPT_ENCODING="br;q=0.5, gzip")
+        assert response['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.content) == raw
+
+    @pytest.mark.django_db
+    def test_reference_data_precompressed(self):
+        """ Reference data is served from the cached compressed bytes """
+        for i in range(20):
+            CoopTypeFactory(name="Coop Type %d" % i)
+        raw = self.client.get("/coop_types/").content
+        response = self.client.get("/coop_types/", HTTP_ACCEPT_ENCODING="br")
+        assert response['Content-Encoding'] == 'br'
+        assert brotli.decompress(response.content) == raw
+
+    @pytest.mark.django_db
+    def test_person_list_fields(self):
+        """ "fields"/"expand" trim the person list and its queries """
+        person = PersonFactory(coops=0)
+        person.coops.add(*self.create_coops(2))
+        with self.assertNumQueries(2):
+            response = self.client.get("/people/", {"fields": "id,first_name,coops", "expand": ""})
+        assert set(response.data['results'][0]) == {'id', 'first_name', 'coops'}
+
+        response = self.client.get("/people/", {"fields": "nickname"})
+        assert response.status_code == 400
+
+    @pytest.mark.django_db
+    def test_coop_batch_get(self):
+        """ "ids" returns many coop details in one request and a fixed number of queries """
+        coops = self.create_coops(2)
+        with self.assertNumQueries(3):
+            response = self.client.get("/coops/", {"ids": "%s,%s" % (coops[1].id, coops[0].id)})
+        assert [coop['name'] for coop in response.data] == ["Search Coop 1", "Search Coop 0"]
+        assert response.data[0]['types'] == [{'id': self.coop_type.id, 'name': "Grocery"}]
+
+        coops += self.create_coops(5)
+        with self.assertNumQueries(3):
+            response = self.client.get("/coops/", {"ids": ",".join(str(coop.id) for coop in coops) + ",0"})
+        assert len(response.data) == 7
+
+        assert self.client.get("/coops/", {"ids": "1,x"}).status_code == 400
+        with self.settings(COOP_BATCH_MAX_IDS=2):
+            assert self.client.get("/coops/", {"ids": "1,2,3"}).status_code == 400
+
+    @pytest.mark.django_db
+    def test_coops_nearby(self):
+        """ /coops/nearby returns the closest coops with their distance """
+        NearbyIndex._instance = None
+        self.addCleanup(setattr, NearbyIndex, '_instance', None)
+        coop = self.create_coops(1)[0]
+        lat, lon = AddressFactory.latitude, AddressFactory.longitude
+        assert self.client.get("/coops/nearby", {"lat": lat, "lon": lon}).status_code == 404
+        nearby_settings = self.settings(NEARBY_INDEX_ENABLED=True)
+        nearby_settings.enable()
+        self.addCleanup(nearby_settings.disable)
+        response = self.client.get("/coops/nearby", {"lat": lat, "lon": lon + 0.001, "radius_km": 1})
+        assert [(c['id'], c['name']) for c in response.data] == [(coop.id, coop.name)]
+        assert 0 < response.data[0]['distance_km'] < 0.1
+        response = self.client.get("/coops/nearby.json", {"lat": lat, "lon": lon + 0.001, "radius_km": 1})
+        assert [c['id'] for c in response.data] == [coop.id]
+
+        assert self.client.get("/coops/nearby", {"lat": lat}).status_code == 400
+        assert self.client.get("/coops/nearby", {"lat": 100, "lon": 0}).status_code == 400
+        assert self.client.get("/coops/nearby", {"lat": 0, "lon": 0, "radius_km": 100000}).status_code == 400
+
+    @pytest.mark.django_db
+    def test_request_timing(self):
+        """ Requests report their query count and timings, warning when over budget """
+        self.create_coops(3)
+        timing_settings = self.settings(REQUEST_TIMING_HEADER_TOKEN="secret", REQUEST_LOG_SAMPLE_RATE=1.0)
+        with timing_settings, self.assertLogs('directory.requests', level='INFO') as logs:
+            response = self.client.get("/coops/", {"contains": "Search Coop"}, HTTP_X_REQUEST_TIMING="secret")
+        timing = response['Server-Timing']
+        assert 'db;dur=' in timing and 'desc="2 queries"' in timing
+        assert 'serialize;dur=' in timing and 'render;dur=' in timing
+        record = json.loads(logs.records[0].getMessage())
+        assert record['queries'] == 2
+        assert not record['over_budget']
+
+        with mock.patch.object(CoopList, 'query_budget', {'GET': 1}):
+            with self.assertLogs('directory.requests', level='WARNING') as logs:
+                response = self.client.get("/coops/", {"contains": "Search Coop"})
+        assert json.loads(logs.records[0].getMessage())['over_budget']
+        # Without the token the timings aren't sent
+        assert not response.has_header('Server-Timing')
+
+    @pytest.mark.django_db
+    def test_request_timing_logs_only_slow_requests(self):
+        """ Requests within budget are only logged when slow, unless sampled """
+        with mock.patch('directory.middleware.logger') as logger:
+            self.client.get("/coop_types/")
+            logger.log.assert_not_called()
+            with self.settings(REQUEST_LOG_SLOW_MS=0):
+                self.client.get("/coop_types/")
+            logger.log.assert_called_once()
+
+    @pytest.mark.django_db
+    def test_metrics(self):
+        """ /metrics reports request counts and query histograms per view """
+        with self.settings(NEARBY_INDEX_ENABLED=True):
+            self.client.get("/coops/nearby", {"lat": 100, "lon": 0})
+        response = self.client.get("/metrics")
+        assert response['Content-Type'].startswith('text/plain')
+        content = response.content.decode()
+        assert 'directory_requests_total{method="GET",status="400",view="coops_nearby"}' in content
+        assert 'directory_request_db_queries_bucket{le="0.0",view="coops_nearby"}' in content
+        assert self.client.get("/metrics.json").status_code == 200
+
+        with self.settings(METRICS_ENABLED=False):
+            assert self.client.get("/metrics").status_code == 404
+
+    @pytest.mark.django_db
+    def test_metrics_restricted(self):
+        """ /metrics is only served to allowed addresses or with the bearer token """
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.0/8'], METRICS_BEARER_TOKEN="secret"):
+            assert self.client.get("/metrics", REMOTE_ADDR="10.1.2.3").status_code == 200
+            assert self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code == 404
+            assert self.client.get("/metrics", REMOTE_ADDR="8.8.8.8", HTTP_AUTHORIZATION="Bearer wrong").status_code == 404
+            assert self.client.get("/metrics", REMOTE_ADDR="8.8.8.8", HTTP_AUTHORIZATION="Bearer secret").status_code == 200
+        with self.settings(METRICS_BEARER_TOKEN=""):
+            assert self.client.get("/metrics", REMOTE_ADDR="8.8.8.8", HTTP_AUTHORIZATION="Bearer ").status_code == 404
+
+    @pytest.mark.django_db
+    def test_profiled_request(self):
+        """ Requests sending the profile token are profiled and summarized """
+        profile_settings = self.settings(
+            PROFILE_ENABLED=True,
+            PROFILE_HEADER_TOKEN="secret",
+            PROFILE_DIR=tempfile.mkdtemp(prefix='profiles')
+        )
+        with profile_settings:
+            assert 'X-Profile-File' not in self.client.get("/coops/", HTTP_X_PROFILE="wrong")
+            response = self.client.get("/coops/", HTTP_X_PROFILE="secret")
+            assert response['X-Profile-File'].startswith('directory.views.CoopList-')
+
+            out = io.StringIO()
+            call_command('summarize_profiles', '--view', 'CoopList', stdout=out)
+        assert out.getvalue().startswith("1 profiles:")
+        assert 'get' in out.getvalue()